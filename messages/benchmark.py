@@ -0,0 +1,291 @@
+#!/usr/bin/python
+'''	Microbenchmarks for the hot paths of the message relay.
+
+	Usage: python benchmark.py [benchmark ...]
+	Runs every benchmark when none are named.
+'''
+import sys, os, time, timeit
+
+from twisted.internet.address import IPv4Address
+
+
+def referenceMask(buf, key):
+	'''	The original byte-at-a-time masking routine, kept as a baseline
+	'''
+	key = [ord(i) for i in key]
+	buf = list(buf)
+	for i, char in enumerate(buf):
+		buf[i] = chr(ord(char) ^ key[i % 4])
+	return ''.join(buf)
+
+
+def timeThroughput(func, size, budget=0.2):
+	'''	Return the throughput of func in bytes per second, running it for
+		roughly budget seconds
+		@input func: Callable processing a buffer of size bytes
+		@input size (int): Number of bytes processed per call
+	'''
+	timer = timeit.Timer(func)
+	number = 1
+	while True:
+		elapsed = min(timer.repeat(repeat=3, number=number))
+		if elapsed >= budget or number >= 1000000: break
+		number *= 10
+	return size * number / elapsed
+
+
+def benchMask():
+	'''	Throughput of WebSocket payload unmasking by frame size
+		Covers frames from 10 bytes up to several megabytes.
+	'''
+	from websockets import _mask
+
+	key = os.urandom(4)
+	print '%10s %16s %16s %8s' % ('bytes', 'reference MB/s', '_mask MB/s', 'speedup')
+	for size in (10, 100, 1000, 10000, 100000, 1000000, 4000000):
+		buf = os.urandom(size)
+		assert _mask(buf, key) == referenceMask(buf, key)
+		reference = timeThroughput(lambda: referenceMask(buf, key), size)
+		fast = timeThroughput(lambda: _mask(buf, key), size)
+		print '%10d %16.2f %16.2f %7.1fx' % (size, reference / 1e6, fast / 1e6,
+			fast / reference)
+
+
+class NullTransport(object):
+	'''	Transport which discards everything written to it
+	'''
+	disconnecting = False
+
+	def write(self, data): pass
+
+	def writeSequence(self, data): pass
+
+	def registerProducer(self, producer, streaming): pass
+
+	def getPeer(self): return IPv4Address('TCP', '127.0.0.1', 0)
+
+
+def relayConnections(count, users=1):
+	'''	Build a relay factory with count WebSocket connections spread over users
+		@return: The factory and the list of connections
+	'''
+	from websockets import _WebSocketsFactory
+	from messagerelay.messageserver import MessengerConnectionFactory
+
+	factory = MessengerConnectionFactory()
+	wrapper = _WebSocketsFactory(factory)
+	connections = []
+	for i in xrange(count):
+		websocket = wrapper.buildProtocol(None)
+		websocket.makeConnection(NullTransport())
+		connection = websocket.wrappedProtocol
+		connection.username = 'user%d' % (i % users)
+		factory.addClientConnection(connection.username, connection)
+		connections.append(connection)
+	return factory, connections
+
+
+def benchBroadcast():
+	'''	Fanout of one message to a 200 participant conversation
+		Compares encoding and framing per connection with a single prepared frame.
+	'''
+	import json
+	from twisted.python import log
+	log.msg = lambda *args, **kwargs: None
+
+	factory, connections = relayConnections(200, users=200)
+	recipients = [connection.username for connection in connections]
+	mdata = {'opcode' : 'message-create', 'message' : {'cid' : 'c' * 32,
+		'message' : {'id' : 'm' * 32, 'text' : 'x' * 200}}}
+
+	def perConnection():
+		for recipient in recipients:
+			for connection in factory.connections.get(recipient, []):
+				connection.sendLine(json.dumps(mdata))
+
+	print '%20s %16s' % ('', 'broadcasts/s')
+	for name, func in (('per connection', perConnection),
+			('prepared frame', lambda: factory.broadcast(recipients, mdata))):
+		print '%20s %16.1f' % (name, timeThroughput(func, 1))
+
+
+def benchCoalesce():
+	'''	Messages per second per core over loopback, with and without coalescing
+		Each reactor iteration writes a burst of ten 100 byte messages.
+	'''
+	from twisted.internet import reactor, protocol, defer
+	from twisted.python import log
+	from websockets import _WebSocketsFactory
+	log.msg = lambda *args, **kwargs: None
+
+	total, burst, payload = 200000, 10, 'x' * 100
+	expected = total * (len(payload) + 2)
+
+	class Burster(protocol.Protocol):
+		'''	Writes bursts of messages, one burst per reactor iteration
+		'''
+		def connectionMade(self):
+			self.sent = 0
+			reactor.callLater(0, self.writeBurst)
+
+		def writeBurst(self):
+			for i in xrange(burst): self.transport.write(payload)
+			self.sent += burst
+			if self.sent < total: reactor.callLater(0, self.writeBurst)
+
+	class Counter(protocol.Protocol):
+		'''	Counts received bytes, firing done once everything has arrived
+		'''
+		def __init__(self, done):
+			self.done, self.received = done, 0
+
+		def dataReceived(self, data):
+			self.received += len(data)
+			if self.received >= expected:
+				self.transport.loseConnection()
+				self.done.callback(None)
+
+	@defer.inlineCallbacks
+	def run():
+		print '%16s %14s %14s %14s' % ('coalesce delay', 'messages/s', 'writes', 'saved')
+		for delay in (None, 0, 0.002):
+			factory = _WebSocketsFactory(protocol.Factory.forProtocol(Burster),
+				coalesceDelay=delay)
+			port = reactor.listenTCP(0, factory, interface='127.0.0.1')
+			done = defer.Deferred()
+			started = time.clock()
+			protocol.ClientCreator(reactor, Counter, done).connectTCP('127.0.0.1',
+				port.getHost().port)
+			yield done
+			elapsed = time.clock() - started
+			yield port.stopListening()
+			print '%16s %14.0f %14d %14d' % (delay, total / elapsed,
+				factory.transportWrites, factory.framesWritten - factory.transportWrites)
+
+	run().addErrback(log.err).addBoth(lambda ignored: reactor.stop())
+	reactor.run()
+
+
+def benchTimers():
+	'''	Cost of keeping a login deadline and a ping timer per connection
+		Schedules and then cancels two timers for 100k connections.
+	'''
+	from twisted.internet import reactor
+	from messagerelay.heartbeat import TimerWheel
+
+	count = 100000
+	wheel = TimerWheel()
+
+	def delayedCalls():
+		calls = [(reactor.callLater(2, int), reactor.callLater(30, int)) for i in xrange(count)]
+		for login, ping in calls:
+			login.cancel()
+			ping.cancel()
+
+	def timerWheel():
+		timers = [(wheel.schedule(2, int), wheel.schedule(30, int)) for i in xrange(count)]
+		for login, ping in timers:
+			wheel.cancel(login)
+			wheel.cancel(ping)
+
+	print '%20s %16s' % ('', 'connections/s')
+	for name, func in (('reactor.callLater', delayedCalls), ('timer wheel', timerWheel)):
+		print '%20s %16.0f' % (name, timeThroughput(func, count, budget=1))
+	wheel.stop()
+
+
+class LegacyRegistry(object):
+	'''	The original list based connection pool of MessengerConnectionFactory, kept
+		as a baseline
+	'''
+
+	def __init__(self):
+		self.connections = {}
+		self.userdata = {}
+
+	def addClientConnection(self, username, connection):
+		if username in self.connections.keys(): self.connections[username].append(connection)
+		else: self.connections[username] = [connection, ]
+
+		if username not in self.userdata.keys():
+			self.userdata[username] = {
+				'id' : username,
+				'displayname' : connection.displayname,
+			}
+
+	def removeClientConnection(self, username, connection):
+		if username in self.connections.keys():
+			try: self.connections[username].remove(connection)
+			except ValueError: pass
+
+		if len(self.connections.get(username, [])) == 0:
+			try: self.connections.pop(username)
+			except KeyError: pass
+			if username in self.userdata.keys(): self.userdata.pop(username)
+
+
+def indexSize(*indexes):
+	'''	Size of dictionaries and of the lists or sets they hold, but not of the
+		connections they index
+	'''
+	size = 0
+	for index in indexes:
+		size += sys.getsizeof(index)
+		for value in index.itervalues():
+			if isinstance(value, (list, set)): size += sys.getsizeof(value)
+	return size
+
+
+def benchRegistry():
+	'''	Index memory and add/remove cost of the connection registry at 100k connections
+		Compares the registry with the original list based pool, holding 100k
+		connections of 25k users, each connecting from four devices. Memory is that
+		of the indexes, per connection; the connections themselves are the same.
+	'''
+	from messagerelay.messageserver import MessengerConnection, MessengerConnectionFactory
+
+	count, devices = 100000, 4
+	factory = MessengerConnectionFactory()
+	legacy = LegacyRegistry()
+	connections = [MessengerConnection(factory) for i in xrange(count)]
+	for i, connection in enumerate(connections):
+		connection.username = 'user%d' % (i // devices)
+		connection.ipaddr = '10.%d.%d.%d' % (i >> 16, (i >> 8) & 0xff, i & 0xff)
+
+	# Populate both pools directly, the legacy pool would take minutes to fill
+	for connection in connections:
+		legacy.connections.setdefault(connection.username, []).append(connection)
+		legacy.userdata[connection.username] = {'id' : connection.username}
+		factory.addClientConnection(connection.username, connection)
+
+	def churn(pool, connection):
+		pool.removeClientConnection(connection.username, connection)
+		pool.addClientConnection(connection.username, connection)
+
+	registry = factory.registry
+	sizes = {
+		'legacy' : indexSize(legacy.connections),
+		'registry' : indexSize(registry.by_user, registry.by_ip, registry.users),
+	}
+	sample = connections[count // 2]
+	print '%10s %18s %18s' % ('', 'index bytes/conn', 'add+remove/s')
+	for name, pool in (('legacy', legacy), ('registry', factory)):
+		print '%10s %18d %18.0f' % (name, sizes[name] // count,
+			timeThroughput(lambda: churn(pool, sample), 1))
+	factory.heartbeat.wheel.stop()
+
+
+benchmarks = {
+	'mask' : benchMask,
+	'broadcast' : benchBroadcast,
+	'coalesce' : benchCoalesce,
+	'registry' : benchRegistry,
+	'timers' : benchTimers,
+}
+
+
+if __name__ == '__main__':
+	sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+	for name in sys.argv[1:] or sorted(benchmarks.keys()):
+		print '== %s: %s' % (name, benchmarks[name].__doc__.split('\n')[0].strip())
+		benchmarks[name]()
@@ -0,0 +1,28 @@
+import json, urllib
+
+from twisted.internet import reactor
+from twisted.web.client import Agent, readBody
+from twisted.web.http_headers import Headers
+
+
+class DjangoError(Exception):
+	'''	Django answered a relay request with an error status
+	'''
+
+
+def getJSON(url, params={}, token='', clock=reactor):
+	'''	Request a JSON document from one of Django's relay endpoints
+		@input url (str): Endpoint URL, without query string
+		@input params (dictionary, default={}): Query string parameters
+		@input token (str, default=''): Shared secret identifying the relay, sent as
+			X-Relay-Token
+		@return: Deferred firing with the parsed document
+	'''
+	if params: url = '%s?%s' % (url, urllib.urlencode(params))
+	d = Agent(clock).request('GET', url, Headers({'X-Relay-Token' : [token]}))
+
+	def received(response):
+		if response.code != 200: raise DjangoError('HTTP %d from %s' % (response.code, url))
+		return readBody(response).addCallback(json.loads)
+
+	return d.addCallback(received)
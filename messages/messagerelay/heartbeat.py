@@ -0,0 +1,135 @@
+import math
+
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+from twisted.python import log
+
+
+class Timer(object):
+	'''	A callback scheduled on a TimerWheel
+	'''
+	__slots__ = ('callback', 'args', 'slot', 'rounds')
+
+	def __init__(self, callback, args, slot, rounds):
+		self.callback = callback
+		self.args = args
+		self.slot = slot
+		self.rounds = rounds
+
+
+class TimerWheel(object):
+	'''	Hashed timer wheel: timers are hashed into a ring of slots by their expiry
+		tick, so scheduling and cancelling are O(1) set operations. A single looping
+		call advances the wheel one slot per tick, firing the timers due in that slot;
+		timers further away than one revolution wait out the remaining rounds.
+	'''
+
+	def __init__(self, resolution=0.5, slots=512, clock=reactor):
+		''' @input resolution (float, default=0.5): Seconds per tick, which is also
+				the precision of the timers
+			@input slots (int, default=512): Number of slots in the wheel
+			@input clock (default=reactor): Provider of callLater driving the wheel
+		'''
+		self.resolution = resolution
+		self.wheel = [set() for i in xrange(slots)]
+		self.tick = 0
+		self.loop = LoopingCall.withCount(self.advance)
+		self.loop.clock = clock
+
+	def __len__(self):
+		return sum(len(slot) for slot in self.wheel)
+
+	def schedule(self, delay, callback, *args):
+		'''	Call callback(*args) once delay seconds have passed
+			@return: Timer which can be passed to cancel
+		'''
+		if not self.loop.running: self.loop.start(self.resolution, now=False)
+		ticks = max(1, int(math.ceil(delay / self.resolution)))
+		slot = (self.tick + ticks) % len(self.wheel)
+		timer = Timer(callback, args, slot, (ticks - 1) // len(self.wheel))
+		self.wheel[slot].add(timer)
+		return timer
+
+	def cancel(self, timer):
+		'''	Cancel a timer, if it has not fired yet
+		'''
+		if timer is not None: self.wheel[timer.slot].discard(timer)
+
+	def advance(self, count=1):
+		'''	Move the wheel on by count ticks, firing the timers which are due
+		'''
+		for i in xrange(count):
+			self.tick += 1
+			slot = self.wheel[self.tick % len(self.wheel)]
+			due = [timer for timer in slot if timer.rounds == 0]
+			for timer in slot: timer.rounds -= 1
+			slot.difference_update(due)
+			for timer in due:
+				try: timer.callback(*timer.args)
+				except Exception: log.err()
+
+	def stop(self):
+		'''	Stop advancing the wheel
+		'''
+		if self.loop.running: self.loop.stop()
+
+
+class Heartbeat(object):
+	'''	Drives the timed checks of every relay connection from one timer wheel:
+		the login deadline, periodic server PINGs, and eviction of connections which
+		do not answer a PING in time.
+	'''
+
+	def __init__(self, settings={}, clock=reactor):
+		''' @input settings (dictionary, default={}): Relay settings, as read from
+				webrtc-python.config
+		'''
+		self.login_deadline = float(settings.get('login_deadline', 2))
+		self.ping_interval = float(settings.get('ping_interval', 30))
+		self.pong_timeout = float(settings.get('pong_timeout', 10))
+		self.wheel = TimerWheel(float(settings.get('heartbeat_resolution', 0.5)), clock=clock)
+
+	def watch(self, connection):
+		'''	Start the login deadline and pings of a new connection
+		'''
+		connection.timers = {
+			'login' : self.wheel.schedule(self.login_deadline, self.loginExpired, connection),
+			'ping' : self.wheel.schedule(self.ping_interval, self.ping, connection),
+		}
+
+	def forget(self, connection):
+		'''	Cancel the timers of a closed connection
+		'''
+		for timer in connection.timers.values(): self.wheel.cancel(timer)
+		connection.timers = {}
+
+	def loginExpired(self, connection):
+		'''	Close connections which have not identified their user in time
+		'''
+		connection.timers.pop('login', None)
+		log.msg('Checking connection credentials: %s' % connection.cdata)
+		if not connection.username: connection.transport.loseConnection()
+
+	def ping(self, connection):
+		'''	Ping the client and schedule the next ping. Clients which can't be pinged
+			are left alone.
+		'''
+		if not hasattr(connection.transport, 'ping'): return
+		connection.transport.ping()
+		if 'pong' not in connection.timers:
+			connection.timers['pong'] = self.wheel.schedule(self.pong_timeout,
+				self.pongExpired, connection)
+		connection.timers['ping'] = self.wheel.schedule(self.ping_interval, self.ping, connection)
+
+	def pong(self, connection):
+		'''	The client answered, stop waiting for it
+		'''
+		self.wheel.cancel(connection.timers.pop('pong', None))
+
+	def pongExpired(self, connection):
+		'''	Evict a client which did not answer a ping in time, without waiting for
+			the kernel to notice that the peer is gone
+		'''
+		connection.timers.pop('pong', None)
+		log.msg('No answer to ping, evicting connection: %s' % connection.cdata)
+		connection.transport.abortConnection()
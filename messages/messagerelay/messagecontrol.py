@@ -1,41 +1,221 @@
 import traceback
 import json
+import hmac
 
 from twisted.web.resource import Resource
+from twisted.protocols.basic import Int32StringReceiver
+from twisted.internet.protocol import ServerFactory
 
 from twisted.python import log
 
+# relay_token of the development configuration, refused unless debug is set
+DEVELOPMENT_TOKEN = 'development-relay-token'
+
+
+def controlToken(settings):
+	'''	Shared secret Django identifies itself with on the control interfaces, and
+		the relay with when it calls Django
+		@input settings (dictionary): Relay settings, as read from webrtc-python.config
+		@raise ValueError if relay_token is not set, or is the development token and
+			debug is not set
+	'''
+	token = settings.get('relay_token')
+	if not token: raise ValueError('relay_token must be set')
+	debug = str(settings.get('debug', '')).lower() in ('true', 'yes', 'on', '1')
+	if token == DEVELOPMENT_TOKEN and not debug:
+		raise ValueError('relay_token is the development token: set a secret one, or set '
+			'debug for development')
+	return token.encode('utf-8') if isinstance(token, unicode) else token
+
+
+def tokenMatches(token, expected):
+	'''	Compare a token sent by Django in constant time
+	'''
+	if isinstance(token, unicode): token = token.encode('utf-8')
+	return isinstance(token, str) and hmac.compare_digest(token, expected)
+
+
+def processControl(websockets, mdata, verbose=True):
+	'''	Carry out a control request from Django: a relay control operation, a
+		publication to a topic, or a message for a list of recipients
+		@input websockets (MessengerConnectionFactory): Factory of the client connections
+		@input mdata (dictionary): Parsed control request
+		@input verbose (bool, default=True): Log the request
+		@return: Number of connections the message was written to, or None for
+			relay control operations
+	'''
+	recipients = mdata.pop('recipients', [])
+	topic = mdata.pop('topic', None)
+	if websockets.controlReceived(mdata):
+		if verbose: log.msg('Control operation: %s' % mdata.get('opcode'))
+		return None
+	if topic is not None:
+		delivered = websockets.publish(topic, mdata)
+		if verbose: log.msg('Published message data to %d connection(s) of %s' % (
+			delivered, topic))
+	else:
+		delivered = websockets.broadcast(recipients, mdata)
+		if verbose: log.msg('Forwarded message data to %d connection(s) of %d user(s)' % (
+			delivered, len(recipients)))
+	return delivered
+
+
+def processBatch(websockets, events):
+	'''	Carry out a batch of control requests in order. A request which fails does
+		not stop the ones after it. The batch is logged as a whole, logging each
+		request would cost more than carrying it out.
+		@input events (list): Parsed control requests
+		@return: List holding the result of each request, with its status and the
+			number of connections it was written to
+	'''
+	results = []
+	total = 0
+	for mdata in events:
+		try:
+			delivered = processControl(websockets, mdata, verbose=False)
+			results.append({ 'status' : 'success', 'delivered' : delivered })
+			total += delivered or 0
+		except Exception as err:
+			log.err()
+			results.append({ 'status' : 'fail', 'error' : unicode(err) })
+	log.msg('Processed a batch of %d control request(s), %d message(s) written' % (
+		len(events), total))
+	return results
+
+
+def processRequest(websockets, mdata, response):
+	'''	Carry out a single control request, or a batch of them given as "events",
+		adding the outcome to response
+	'''
+	if 'events' in mdata: response['results'] = processBatch(websockets, mdata['events'])
+	else: response['delivered'] = processControl(websockets, mdata)
+	response['status'] = 'success'
+
 
 class WebSocketControl(Resource):
 	'''	Twisted web socket control resource: Provides a REST interface for Django
-		to forward messages to connected clients
+		to forward messages to connected clients. A request may hold a single control
+		request, or a batch of them as {"events" : [...]}, which is answered with the
+		result of each one in "results". Requests without the relay token in their
+		X-Relay-Token header are refused.
 	'''
 
-	def __init__(self, siteroot, websockets, *args, **kwargs):
+	def __init__(self, siteroot, websockets, token, *args, **kwargs):
 		super(type(self), self).__init__(*args, **kwargs)
 		self.siteroot = siteroot
 		self.websockets = websockets
+		self.token = token
 		log.msg('Initializing control interface')
 
+	def render(self, request):
+		if not tokenMatches(request.getHeader('X-Relay-Token') or '', self.token):
+			request.setResponseCode(403)
+			return json.dumps({ 'status' : 'fail', 'error' : 'Invalid relay token' })
+		return Resource.render(self, request)
+
+	def render_GET(self, request):
+		''' Report the outbound queue depth of every connection, and how many
+			socket writes have been saved by coalescing frames
+		'''
+		response = { 'status' : 'success', 'connections' : self.websockets.queueDepths() }
+		messages = self.siteroot.children.get('messages')
+		if hasattr(messages, 'writeStats'): response['writes'] = messages.writeStats()
+		request.setHeader('Content-Type', 'application/json')
+		return json.dumps(response)
+
 	def render_POST(self, request):
 		# Parse request
 		response = {}
 		rdata = request.content.getvalue()
-		try:
-			mdata = json.loads(rdata)
-			recipients = mdata.pop('recipients', [])
-			for recipient in recipients:
-				if recipient in self.websockets.connections.keys():
-					socket_connections = self.websockets.connections.get(recipient, [])
-					for connection in socket_connections:
-						try: connection.sendLine(json.dumps(mdata))
-						except: print traceback.print_exc()
-						log.msg('Forwarding message data to user (%s)' % recipient)
-			response['status'] = 'success'
+		try: processRequest(self.websockets, json.loads(rdata), response)
 		except Exception as err:
 			response['status'] = 'fail'
 			response['error'] = unicode(err)
 			response['details'] = traceback.format_exc()
 		
 
-		return json.dumps(response)
\ No newline at end of file
+		return json.dumps(response)
+
+
+class ControlChannel(Int32StringReceiver):
+	'''	Persistent control connection from Django. Each frame is a JSON control
+		request prefixed by its length as a 32 bit big-endian integer, the same
+		request Django would POST to the control resource. Requests are processed in
+		order as they arrive, so clients can pipeline them; a request carrying an
+		"ack" id is answered with a frame holding that id, its status and the number
+		of connections the message was written to, or the results of a batch.
+
+		The first frame must be the handshake {"opcode" : "control-auth", "token" :
+		<relay_token>}, which is answered with its status. A wrong token closes the
+		channel. Until then frames are limited to HANDSHAKE_LENGTH bytes.
+	'''
+	HANDSHAKE_LENGTH = 4096
+
+	def __init__(self, websockets, max_length, token):
+		self.websockets = websockets
+		self.max_length = max_length
+		self.token = token
+		self.authenticated = False
+		self.MAX_LENGTH = self.HANDSHAKE_LENGTH
+
+	def stringReceived(self, rdata):
+		''' Event fired for every complete control request
+		'''
+		if not self.authenticated: return self.handshakeReceived(rdata)
+		ack = None
+		response = {}
+		try:
+			mdata = json.loads(rdata)
+			ack = mdata.pop('ack', None)
+			processRequest(self.websockets, mdata, response)
+		except Exception as err:
+			log.err()
+			response['status'] = 'fail'
+			response['error'] = unicode(err)
+		if ack is not None:
+			response['ack'] = ack
+			self.sendString(json.dumps(response))
+
+	def handshakeReceived(self, rdata):
+		''' Event fired for the first frame, which must carry the relay token
+		'''
+		try: mdata = json.loads(rdata)
+		except ValueError: mdata = None
+		if isinstance(mdata, dict) and mdata.get('opcode') == 'control-auth' and \
+				tokenMatches(mdata.get('token'), self.token):
+			self.authenticated = True
+			self.MAX_LENGTH = self.max_length
+			self.sendString(json.dumps({ 'status' : 'success' }))
+			return
+		log.msg('Control channel from %s sent no valid token, closing it' % (
+			self.transport.getPeer(), ))
+		self.sendString(json.dumps({ 'status' : 'fail', 'error' : 'Invalid relay token' }))
+		self.transport.loseConnection()
+
+	def lengthLimitExceeded(self, length):
+		''' Event fired when a request is longer than the channel accepts; the stream
+			can't be resynchronised, so the connection is closed
+		'''
+		log.msg('Control request of %d bytes exceeds %d, closing control channel' % (
+			length, self.MAX_LENGTH))
+		self.transport.loseConnection()
+
+
+class ControlChannelFactory(ServerFactory):
+	'''	Accept persistent control connections from Django, on a TCP port or a Unix
+		domain socket
+	'''
+
+	def __init__(self, websockets, token, max_length=16777216):
+		''' @input websockets (MessengerConnectionFactory): Factory of the client connections
+			@input token (str): Relay token Django must send in its handshake
+			@input max_length (int, default=16MiB): Largest control request accepted
+		'''
+		self.websockets = websockets
+		self.token = token
+		self.max_length = max_length
+
+	def buildProtocol(self, addr):
+		'''	Return a new instance of a protocol connection
+		'''
+		return ControlChannel(self.websockets, self.max_length, self.token)
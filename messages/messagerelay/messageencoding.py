@@ -0,0 +1,179 @@
+import json, re
+
+from twisted.python import log
+
+try: import msgpack
+except ImportError:
+	msgpack = None
+	log.msg('msgpack is not installed, MessagePack encoding disabled')
+
+# Largest document a client may send, or leave incomplete between messages
+MAX_DOCUMENT_SIZE = 1048576
+
+
+class JSONDecoder(object):
+	'''	Splits a stream of newline-delimited JSON documents. Clients may batch
+		several documents into one WebSocket message, or split a document across
+		messages. An object or array is complete as soon as its brackets close, so
+		clients which send one bare request per message keep working; other values
+		need their newline, as "12" followed by "34" is the start of 1234.
+
+		Only the data received since the last call is scanned, for newlines and for
+		the brackets and strings which tell where a document ends, and a document is
+		parsed once, when it is complete.
+	'''
+	# What matters outside and inside strings. Strings which end within the data
+	# are skipped whole, and a backslash is matched with the character it escapes,
+	# unless the data ends between them.
+	STRUCTURE = re.compile(r'"[^"\\\n]*(?:\\.[^"\\\n]*)*"|[\n"\[\]{}]')
+	STRING = re.compile(r'\\.?|["\n]')
+
+	def __init__(self, max_size=MAX_DOCUMENT_SIZE):
+		self.max_size = max_size
+		# Parts of the incomplete document, received in earlier calls
+		self.pending = []
+		self.size = 0
+		# Nesting of the incomplete document, and whether it is inside a string,
+		# right after a backslash, or too long and being skipped
+		self.depth = 0
+		self.string = False
+		self.escaped = False
+		self.discarding = False
+
+	def feed(self, data):
+		''' Add data received from the client
+			@return: List of documents, each either a parsed document or the
+				ValueError raised while parsing it
+		'''
+		documents = []
+		start = pos = 0
+		if self.escaped and data[:1] not in ('', '\n'): pos = 1
+		self.escaped = False
+		while True:
+			match = (self.STRING if self.string else self.STRUCTURE).search(data, pos)
+			if match is None: break
+			char, pos = match.group(), match.end()
+			if char == '\n':
+				self.endDocument(documents, data[start:pos - 1])
+				start = pos
+			elif self.string:
+				if char == '"': self.string = False
+				elif char == '\\' and pos == len(data): self.escaped = True
+			elif char[0] == '"': self.string = len(char) == 1
+			elif char in '[{': self.depth += 1
+			else:
+				self.depth -= 1
+				if self.depth <= 0:
+					self.endDocument(documents, data[start:pos])
+					start = pos
+		self.keep(documents, data[start:])
+		return documents
+
+	def keep(self, documents, data):
+		''' Buffer the start of a document, skipping it once it is too long
+		'''
+		if self.discarding or not data: return
+		self.pending.append(data)
+		self.size += len(data)
+		if self.size > self.max_size:
+			self.pending, self.size = [], 0
+			self.discarding = True
+			documents.append(ValueError('Document exceeds %d bytes' % self.max_size))
+
+	def endDocument(self, documents, data):
+		''' Parse a complete document, made of the buffered data and its end
+		'''
+		if not self.discarding:
+			line = ''.join(self.pending) + data
+			if line.strip(): documents.append(self.parse(line))
+		self.pending, self.size = [], 0
+		self.depth = 0
+		self.string = self.escaped = self.discarding = False
+
+	def parse(self, line):
+		if len(line) > self.max_size: return ValueError('Document exceeds %d bytes' % self.max_size)
+		try: return json.loads(line)
+		except ValueError as e: return e
+
+
+class MessagePackDecoder(object):
+	'''	Splits a stream of MessagePack documents, which delimit themselves
+	'''
+
+	def __init__(self, max_size=MAX_DOCUMENT_SIZE):
+		self.max_size = max_size
+		self.unpacker = self.createUnpacker()
+
+	def createUnpacker(self):
+		return msgpack.Unpacker(raw=False, max_buffer_size=self.max_size)
+
+	def feed(self, data):
+		''' Add data received from the client
+			@return: List of documents, each either a parsed document or the
+				ValueError raised while parsing it
+		'''
+		documents = []
+		try:
+			self.unpacker.feed(data)
+			documents.extend(self.unpacker)
+		except Exception as e:
+			# The stream can't be resynchronised, drop whatever is buffered
+			self.unpacker = self.createUnpacker()
+			documents.append(ValueError(str(e) or e.__class__.__name__))
+		return documents
+
+
+class JSONEncoding(object):
+	'''	Default encoding: JSON documents, one per line, sent in text frames
+	'''
+	name = 'json'
+	binary = False
+	delimiter = '\r\n'
+
+	def encode(self, mdata):
+		''' Serialize a message, including its delimiter
+		'''
+		return json.dumps(mdata) + self.delimiter
+
+	def decode(self, data):
+		''' Parse a single message
+		'''
+		return json.loads(data)
+
+	def decoder(self, max_size=MAX_DOCUMENT_SIZE):
+		''' Create a decoder for the stream of messages sent by one client
+		'''
+		return JSONDecoder(max_size)
+
+
+class MessagePackEncoding(object):
+	'''	Compact binary encoding: MessagePack documents sent in binary frames.
+		Strings are packed as MessagePack strings and unpacked to unicode, so
+		messages look the same to the relay as decoded JSON.
+	'''
+	name = 'msgpack'
+	binary = True
+	delimiter = ''
+
+	def encode(self, mdata):
+		''' Serialize a message
+		'''
+		return msgpack.packb(mdata, use_bin_type=False)
+
+	def decode(self, data):
+		''' Parse a single message
+		'''
+		return msgpack.unpackb(data, raw=False)
+
+	def decoder(self, max_size=MAX_DOCUMENT_SIZE):
+		''' Create a decoder for the stream of messages sent by one client
+		'''
+		return MessagePackDecoder(max_size)
+
+
+# Default encoding, used by clients which do not ask for one
+JSON = JSONEncoding()
+
+# Encodings available to clients, by the WebSocket subprotocol which selects them
+ENCODINGS = { JSON.name : JSON }
+if msgpack is not None: ENCODINGS[MessagePackEncoding.name] = MessagePackEncoding()
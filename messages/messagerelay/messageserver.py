@@ -1,4 +1,5 @@
 import os, sys, json, itertools, traceback
+from collections import deque
 
 from twisted.internet import reactor
 from twisted.internet import threads
@@ -7,6 +8,26 @@ from twisted.protocols.basic import LineReceiver
 from twisted.internet.protocol import ServerFactory
 from twisted.internet import protocol
 
+from websockets import PreparedFrame
+
+from .messageencoding import JSON, ENCODINGS, MAX_DOCUMENT_SIZE
+from .heartbeat import Heartbeat
+from .registry import ConnectionRegistry
+from .presence import Presence
+from .rooms import Rooms
+from .djangoapi import getJSON
+
+# WebSocket close code sent to clients which do not keep up with their messages
+CLOSE_POLICY_VIOLATION = 1008
+
+# Opcodes of presence updates, which may be dropped or merged when a client falls behind
+PRESENCE_OPCODES = ('user-activelist', 'user-presence')
+
+# Outbound queue overflow policies
+OVERFLOW_DROP_PRESENCE = 'drop-presence'
+OVERFLOW_MERGE = 'merge'
+OVERFLOW_DISCONNECT = 'disconnect'
+
 class EchoProtocol(protocol.Protocol):
 	def dataReceived(self, data):
 		print "recieved data: ", data
@@ -26,6 +47,12 @@ class MessengerConnection(LineReceiver):
 		a connected client
 	'''
 
+	# Client operations: opcode -> name of the method handling the request
+	operations = {
+		'user-identity' : 'requestIdentity',
+		'user-active' : 'requestActiveUsers',
+	}
+
 	def __init__(self, factory):
 		self.factory = factory
 		self.ctype = None
@@ -34,6 +61,30 @@ class MessengerConnection(LineReceiver):
 		self.username = None
 		self.displayname = None
 		self.cdata = ''
+		# Encoding of messages exchanged with the client, chosen during the handshake
+		self.encoding = JSON
+		# Splits the data sent by the client into documents
+		self.decoder = None
+		# Heartbeat timers of the connection, by purpose
+		self.timers = {}
+		# Messages waiting for the transport to drain, as [size, opcode, payload]
+		self.outbound = deque()
+		self.outbound_bytes = 0
+		self.paused = False
+		# Set when a presence message was dropped, so the next one is a snapshot
+		self.presence_stale = False
+
+	def requestIdentity(self, mdata):
+		''' Client operation: identify the user of the connection
+		'''
+		self.identifyUser(mdata.get('user-identify', {}))
+
+	def requestActiveUsers(self, mdata):
+		''' Client operation: list the active users, or the changes to them since the
+			version given in "since"
+		'''
+		if mdata.get('since') is None: self.activeUserList()
+		else: self.sendMessage(self.factory.presence.since(mdata['since'], self.username))
 
 	def identifyUser(self, userid):
 		''' Add user information to the connection
@@ -48,8 +99,117 @@ class MessengerConnection(LineReceiver):
 	def activeUserList(self):
 		''' Send client a list of active users
 		'''
-		self.sendLine(json.dumps({ 'opcode' : 'user-activelist', 'users' : self.factory.activeUsers() }))
+		self.sendMessage(self.factory.presence.snapshot(self.username))
 		
+	def sendMessage(self, mdata):
+		''' Serialize a message with the connection's encoding and send it to the client
+			@input mdata (dictionary): Message to send
+		'''
+		self.queueOutbound(self.encoding.encode(mdata), mdata.get('opcode'))
+
+	def sendLine(self, line, opcode=None):
+		''' Send a line to the client, queueing it while the transport is paused
+			@input line (str): Line to send, without delimiter
+			@input opcode (default=None): Opcode of the message, used to decide what
+				to discard when the outbound queue overflows
+		'''
+		self.queueOutbound(line + self.delimiter, opcode)
+
+	def sendPrepared(self, frame, opcode=None):
+		''' Send a message which has been prepared for broadcast
+			@input frame (PreparedFrame): Message to send, already encoded
+			@input opcode (default=None): Opcode of the message
+		'''
+		self.queueOutbound(frame, opcode)
+
+	def writeOutbound(self, payload):
+		''' Write a line or prepared frame to the transport
+		'''
+		if not isinstance(payload, PreparedFrame): self.transport.write(payload)
+		elif hasattr(self.transport, 'writePrepared'): self.transport.writePrepared(payload)
+		else: self.transport.write(payload.data)
+
+	def queueOutbound(self, payload, opcode=None):
+		''' Write a message, or add it to the outbound queue if the transport has
+			asked us to pause or earlier messages are still waiting. Messages for a
+			connection which is closing, such as one disconnected for overflowing, are
+			dropped.
+		'''
+		if self.transport.disconnecting: return
+		if not self.paused and not self.outbound:
+			self.writeOutbound(payload)
+			return
+
+		size = len(payload.data if isinstance(payload, PreparedFrame) else payload)
+		self.outbound.append([size, opcode, payload])
+		self.outbound_bytes += size
+		if self.factory.outboundAboveHigh(len(self.outbound), self.outbound_bytes):
+			self.outboundOverflow()
+
+	def outboundOverflow(self):
+		''' Apply the factory's overflow policy to a queue which has passed its high
+			watermark. Presence updates are discarded until the queue is back under its
+			low watermark; if that is not enough the client is disconnected.
+		'''
+		policy = self.factory.outbound_overflow
+		if policy == OVERFLOW_DROP_PRESENCE:
+			# Drop the oldest presence updates first
+			for entry in list(self.outbound):
+				if not self.factory.outboundAboveLow(len(self.outbound), self.outbound_bytes): break
+				if entry[1] in PRESENCE_OPCODES: self.discardOutbound(entry)
+		elif policy == OVERFLOW_MERGE:
+			# Only the most recent update of each kind is worth sending
+			latest = set()
+			for entry in reversed(list(self.outbound)):
+				if entry[1] not in PRESENCE_OPCODES: continue
+				if entry[1] in latest: self.discardOutbound(entry)
+				else: latest.add(entry[1])
+
+		if self.factory.outboundAboveHigh(len(self.outbound), self.outbound_bytes):
+			log.msg('Outbound queue overflow (%d messages, %d bytes), disconnecting: %s' % (
+				len(self.outbound), self.outbound_bytes, self.cdata))
+			self.outbound.clear()
+			self.outbound_bytes = 0
+			self.transport.loseConnection(CLOSE_POLICY_VIOLATION, 'Outbound queue overflow')
+
+	def discardOutbound(self, entry):
+		''' Remove a message from the outbound queue without sending it
+		'''
+		self.outbound.remove(entry)
+		self.outbound_bytes -= entry[0]
+		if entry[1] in PRESENCE_OPCODES: self.presence_stale = True
+
+	def queueDepth(self):
+		''' Report the state of the outbound queue
+		'''
+		return {
+			'peer' : self.cdata,
+			'user' : self.username,
+			'paused' : self.paused,
+			'messages' : len(self.outbound),
+			'bytes' : self.outbound_bytes,
+		}
+
+	def pauseProducing(self):
+		''' Event fired when the transport's send buffer is full
+		'''
+		self.paused = True
+
+	def resumeProducing(self):
+		''' Event fired when the transport's send buffer has drained. Writes queued
+			messages until the queue is empty or the transport pauses us again.
+		'''
+		self.paused = False
+		while self.outbound and not self.paused:
+			size, opcode, payload = self.outbound.popleft()
+			self.outbound_bytes -= size
+			self.writeOutbound(payload)
+
+	def stopProducing(self):
+		''' Event fired when the transport goes away
+		'''
+		self.outbound.clear()
+		self.outbound_bytes = 0
 
 	def connectionMade(self):
 		'''	Event fired when a client connection is made to the server.
@@ -59,32 +219,50 @@ class MessengerConnection(LineReceiver):
 		# Add connection information
 		cpeer = self.transport.getPeer()
 		self.ipaddr = cpeer.host
-		self.port = cpeer.port
-		self.cdata = ':'.join((str(self.ipaddr), str(self.port)))
+		self.cport = cpeer.port
+		self.cdata = ':'.join((str(self.ipaddr), str(self.cport)))
 		log.msg('Client connection created: %s' % self.cdata)
-		# Terminate connection if no user id provided
-		def loginrequired():
-			log.msg('Checking connection credentials: %s' % self.cdata)
-			if not self.username: self.transport.loseConnection()
-		reactor.callLater(2, loginrequired)
+		# Use the encoding the client asked for, sending binary frames if it needs them
+		self.encoding = ENCODINGS.get(getattr(self.transport, 'subprotocol', None), JSON)
+		if self.encoding.binary: self.transport.binary = True
+		self.decoder = self.encoding.decoder(self.factory.max_document_size)
+		# Let the transport tell us when the client stops keeping up
+		self.transport.registerProducer(self, True)
+		# Terminate connection if no user id provided, and ping it while it lasts
+		self.factory.heartbeat.watch(self)
+
+	def pongReceived(self, data):
+		''' Event fired when the client answers a ping
+		'''
+		self.factory.heartbeat.pong(self)
 
 	def dataReceived(self, data):
-		''' Event fired when the server receives data sent by the client
+		''' Event fired when the server receives data sent by the client. The data
+			may hold several documents, or only part of one.
 		'''
-		try: mdata = json.loads(data)
-		except: self.sendLine(json.dumps({'error' : 'parse-error', 'message' : 'Unable to parse request'}))
-		
-		# Retrieve operation code
-		opcode = mdata.get('opcode')
-		# Client operations
-		if opcode == 'user-identity': self.identifyUser(mdata.get('user-identify', {}))
-		elif opcode == 'user-active': self.activeUserList()
+		for mdata in self.decoder.feed(data):
+			if isinstance(mdata, dict): self.documentReceived(mdata)
+			else:
+				log.msg('Unable to parse request from %s: %s' % (self.cdata, mdata))
+				self.sendMessage({'error' : 'parse-error', 'message' : 'Unable to parse request'})
+
+	def documentReceived(self, mdata):
+		''' Dispatch a request to the method handling its opcode
+			@input mdata (dictionary): Request sent by the client
+		'''
+		operation = self.operations.get(mdata.get('opcode'))
+		if operation is None:
+			log.msg('Unknown opcode from %s: %r' % (self.cdata, mdata.get('opcode')))
+			return
+		try: getattr(self, operation)(mdata)
+		except Exception: log.err()
 
 	def connectionLost(self, reason): 
 		'''	Event fired when a client connection is closed.
 			Useful for performing cleanup and removing persistent objects from the factory.
 		'''
 		log.msg('Connection Terminated: %s' % self.cdata)
+		self.factory.heartbeat.forget(self)
 		self.factory.removeClientConnection(self.username, self)
 		
 
@@ -95,45 +273,190 @@ class MessengerConnectionFactory(ServerFactory):
 
 	protocol = MessengerConnection
 
-	def __init__(self, root_site=None):
+	# WebSocket subprotocols clients can use to pick a message encoding
+	subprotocols = tuple(ENCODINGS.keys())
+
+	# Control operations sent by Django: opcode -> name of the handling method
+	controls = {
+		'presence-contacts' : 'updateContacts',
+		'room-join' : 'joinRoom',
+		'room-leave' : 'leaveRoom',
+		'room-delete' : 'deleteRoom',
+		'room-sync' : 'syncRooms',
+	}
+
+	def __init__(self, root_site=None, settings={}):
 		''' @input root_site (default=None): Reference which can be used to access the
 				root resource of the site
+			@input settings (dictionary, default={}): Relay settings, as read from
+				webrtc-python.config
 		'''
 
 		self.root_site = root_site
-		self.connections = {}
-		self.userdata = {}
+		# Outbound queue watermarks and overflow policy for slow clients
+		self.outbound_high_bytes = int(settings.get('outbound_high_bytes', 1048576))
+		self.outbound_low_bytes = int(settings.get('outbound_low_bytes', 262144))
+		self.outbound_high_messages = int(settings.get('outbound_high_messages', 1000))
+		self.outbound_low_messages = int(settings.get('outbound_low_messages', 250))
+		self.outbound_overflow = settings.get('outbound_overflow', OVERFLOW_DROP_PRESENCE)
+		# Largest document accepted from a client
+		self.max_document_size = int(settings.get('max_document_size', MAX_DOCUMENT_SIZE))
+		# Login deadlines, pings and pong timeouts of all connections
+		self.heartbeat = Heartbeat(settings)
+		# Identified connections, by user and by address
+		self.registry = ConnectionRegistry()
+		self.connections = self.registry.by_user
+		self.userdata = self.registry.userdata
+		# Versioned presence of the connected users, pushed to clients as it changes
+		self.presence = Presence(self, settings)
+		# Conversation rooms, loaded from Django by loadRooms
+		self.rooms = Rooms()
+		self.rooms_url = settings.get('rooms_url')
+		self.relay_token = settings.get('relay_token', '')
+		self.rooms_retry = float(settings.get('rooms_retry', 5))
 		log.msg('Creating root messenger factory')
 
 	def addClientConnection(self, username, connection):
 		'''	Add client connection to the pool of clients, indexed by username
 		'''
-		if username in self.connections.keys(): self.connections[username].append(connection)
-		else: self.connections[username] = [connection, ]
-
-		if username not in self.userdata.keys():
-			self.userdata[username] = { 
-				'id' : username, 
-				'displayname' : connection.displayname,
-			}
+		previous = self.registry.user(connection)
+		if previous is not None and previous != username:
+			self.removeClientConnection(previous, connection)
+		if self.registry.add(username, connection):
+			self.presence.join(self.userdata[username])
+		self.rooms.connectionAdded(username, connection)
 
 	def removeClientConnection(self, username, connection):
 		''' Remove client connection from the pool of clients
 		'''
-		# Remove connection from pool
-		if username in self.connections.keys():
-			try: self.connections[username].remove(connection)
-			except ValueError:
-				log.msg('Connection not in pool for %s' % username)
-
-		# Remove user name from pool list if no connections available
-		if len(self.connections.get(username, [])) == 0:
+		if connection not in self.registry:
+			if username is not None: log.msg('Connection not in pool for %s' % username)
+			return
+		username = self.registry.user(connection)
+		self.rooms.connectionRemoved(username, connection)
+		if self.registry.remove(connection):
 			log.msg('User (%s) no longer connected' % username)
-			try: self.connections.pop(username)
-			except KeyError:
-				log.msg('Unable to find any connections for user (%s)' % str(username))
-			# Remove user connection data from userdata
-			if username in self.userdata.keys(): self.userdata.pop(username)
+			self.presence.leave(username)
+
+	def broadcast(self, recipients, mdata):
+		''' Send data to every connection of the recipients. The data is serialized
+			and framed once per encoding in use, and the same buffer is written to
+			each connection.
+			@input recipients: Usernames which should receive the data
+			@input mdata: Data to send, must be serializable to JSON
+			@return: Number of connections the data was written to
+		'''
+		return self.sendToConnections((connection for recipient in recipients
+			for connection in self.registry.connectionsOf(recipient)), mdata)
+
+	def publish(self, topic, mdata):
+		''' Send data to every live connection subscribed to a topic, such as
+			"conversation:<id>" for the participants of a conversation
+			@return: Number of connections the data was written to
+		'''
+		return self.sendToConnections(self.rooms.connections(topic), mdata)
+
+	def sendToConnections(self, connections, mdata):
+		''' Send data to connections, serializing and framing it once per encoding
+			in use and writing the same buffer to each connection
+			@return: Number of connections the data was written to
+		'''
+		frames = {}
+		delivered = 0
+		for connection in connections:
+			encoding = connection.encoding
+			if encoding.name not in frames:
+				frames[encoding.name] = PreparedFrame(encoding.encode(mdata), encoding.binary)
+			try:
+				connection.sendPrepared(frames[encoding.name], mdata.get('opcode'))
+				delivered += 1
+			except Exception: log.err()
+		return delivered
+
+	def pushPresence(self, recipients, mdata, snapshot):
+		''' Send a presence message to every connection of the recipients. Connections
+			which have dropped an earlier presence message are sent a snapshot instead.
+			@input snapshot: Callable returning the snapshot for a username
+		'''
+		frames = {}
+		for recipient in recipients:
+			for connection in self.registry.connectionsOf(recipient):
+				try:
+					if connection.presence_stale:
+						connection.presence_stale = False
+						connection.sendMessage(snapshot(recipient))
+						continue
+					encoding = connection.encoding
+					if encoding.name not in frames:
+						frames[encoding.name] = PreparedFrame(encoding.encode(mdata), encoding.binary)
+					connection.sendPrepared(frames[encoding.name], mdata['opcode'])
+				except Exception: log.err()
+
+	def controlReceived(self, mdata):
+		''' Handle a control request from Django which is meant for the relay itself
+			rather than for clients
+			@return: False if the opcode is not a relay control operation
+		'''
+		operation = self.controls.get(mdata.get('opcode'))
+		if operation is None: return False
+		getattr(self, operation)(mdata.get('message', {}))
+		return True
+
+	def updateContacts(self, contacts):
+		''' Control operation: contacts of users whose conversations have changed
+		'''
+		self.presence.updateContacts(contacts)
+
+	def joinRoom(self, rdata):
+		''' Control operation: participants added to a conversation
+		'''
+		self.rooms.join(rdata['conversation'], rdata.get('participants', ()), self.registry)
+
+	def leaveRoom(self, rdata):
+		''' Control operation: participants removed from a conversation
+		'''
+		self.rooms.leave(rdata['conversation'], rdata.get('participants', ()), self.registry)
+
+	def deleteRoom(self, rdata):
+		''' Control operation: conversation deleted
+		'''
+		self.rooms.delete(rdata['conversation'])
+
+	def syncRooms(self, rdata):
+		''' Control operation: participants of every conversation
+		'''
+		self.rooms.sync(rdata.get('rooms', {}), self.registry)
+
+	def loadRooms(self):
+		''' Fetch the participants of every conversation from Django, retrying with
+			backoff until it answers
+		'''
+		if not self.rooms_url: return
+		d = getJSON(self.rooms_url, token=self.relay_token)
+		d.addCallback(self.syncRooms)
+
+		def failed(failure):
+			log.msg('Unable to load conversation rooms, retrying in %ds: %s' % (
+				self.rooms_retry, failure.getErrorMessage()))
+			reactor.callLater(self.rooms_retry, self.loadRooms)
+			self.rooms_retry = min(self.rooms_retry * 2, 60)
+
+		return d.addErrback(failed)
+
+	def outboundAboveHigh(self, messages, nbytes):
+		''' Check whether an outbound queue has passed its high watermark
+		'''
+		return messages > self.outbound_high_messages or nbytes > self.outbound_high_bytes
+
+	def outboundAboveLow(self, messages, nbytes):
+		''' Check whether an outbound queue is still above its low watermark
+		'''
+		return messages > self.outbound_low_messages or nbytes > self.outbound_low_bytes
+
+	def queueDepths(self):
+		''' Report the outbound queue of every identified connection
+		'''
+		return [connection.queueDepth() for connection in self.registry.connections()]
 
 	def activeUsers(self):
 		return self.userdata.values()
@@ -0,0 +1,53 @@
+import os, shlex
+
+from twisted.internet import reactor
+from twisted.internet.protocol import ProcessProtocol
+from twisted.python import log
+from twisted.python.procutils import which
+
+
+class OutboxPoller(ProcessProtocol):
+	'''	Runs the Django outbox dispatcher ("manage.py relay_outbox") alongside the
+		relay, restarting it whenever it exits until the reactor stops. Its output
+		goes to the relay log.
+	'''
+
+	def __init__(self, command, directory, restart_delay=5.0):
+		'''	@input command (string): Command line of the dispatcher
+			@input directory (string): Directory it is run from
+			@input restart_delay (float, default=5.0): Seconds before it is started
+				again once it exits
+		'''
+		self.args = shlex.split(command)
+		self.directory = directory
+		self.restart_delay = restart_delay
+		self.stopping = False
+		self.restart = None
+
+	def start(self):
+		self.restart = None
+		executable = self.args[0]
+		if not os.path.dirname(executable):
+			found = which(executable)
+			if not found:
+				log.msg('Unable to start the outbox dispatcher: %s was not found' % executable)
+				return
+			executable = found[0]
+		log.msg('Starting the outbox dispatcher: %s' % ' '.join(self.args))
+		reactor.spawnProcess(self, executable, self.args, env=os.environ, path=self.directory)
+
+	def stop(self):
+		self.stopping = True
+		if self.restart is not None and self.restart.active(): self.restart.cancel()
+		if self.transport is not None and self.transport.pid is not None:
+			self.transport.signalProcess('INT')
+
+	def outReceived(self, data):
+		for line in data.splitlines(): log.msg('outbox: %s' % line)
+
+	errReceived = outReceived
+
+	def processEnded(self, reason):
+		log.msg('The outbox dispatcher exited: %s' % reason.value)
+		if not self.stopping:
+			self.restart = reactor.callLater(self.restart_delay, self.start)
@@ -0,0 +1,210 @@
+from collections import deque
+
+from twisted.internet import reactor
+from twisted.python import log
+
+from .djangoapi import getJSON
+
+
+class Presence(object):
+	'''	Versioned set of the users with at least one connection. Every join and leave
+		bumps the version and is recorded in a bounded change log, from which clients
+		can catch up with the changes since a version they know. Changes are pushed to
+		connected clients at most once per interval, coalesced per user, so a burst of
+		reconnects turns into one message rather than one broadcast per connection.
+
+		When contacts_url is configured, presence is scoped: each user only sees the
+		users they share a conversation with. Their contacts are fetched from Django
+		when they connect and replaced by the control channel as conversations change.
+
+		Pushed changes give the final state of each user, so clients can apply them
+		idempotently. Connections which had a presence message dropped by their
+		outbound queue receive a full snapshot with the next push.
+	'''
+
+	def __init__(self, factory, settings={}, clock=reactor):
+		''' @input factory (MessengerConnectionFactory): Factory whose registry holds
+				the connected users, and which sends the changes
+			@input settings (dictionary, default={}): Relay settings, as read from
+				webrtc-python.config
+		'''
+		self.factory = factory
+		self.clock = clock
+		self.interval = float(settings.get('presence_interval', 1))
+		self.version = 0
+		# (version, opcode, user data) of the most recent changes
+		self.changes = deque(maxlen=int(settings.get('presence_log_size', 1000)))
+		# Version last pushed to clients, and the call which will push the next one
+		self.pushed = 0
+		self.pushCall = None
+		# Where and how to ask Django for the contacts of a user
+		self.contacts_url = settings.get('contacts_url')
+		self.relay_token = settings.get('relay_token', '')
+		self.scoped = bool(self.contacts_url)
+		# username -> contacts, for connected users
+		self.contacts = {}
+		# username -> connected users who have them as a contact
+		self.watchers = {}
+
+	def join(self, userdata):
+		'''	Record that a user has opened their first connection
+		'''
+		self.record('user-join', userdata)
+		if self.scoped: self.fetchContacts(userdata['id'])
+
+	def leave(self, username):
+		'''	Record that a user has closed their last connection
+		'''
+		self.record('user-leave', {'id' : username})
+		if username in self.contacts:
+			self.replaceContacts(username, set())
+			del self.contacts[username]
+
+	def record(self, opcode, userdata):
+		self.version += 1
+		self.changes.append((self.version, opcode, userdata))
+		if self.pushCall is None:
+			self.pushCall = self.clock.callLater(self.interval, self.push)
+
+	def visible(self, username):
+		'''	Users whose presence a user may see, or None if presence is not scoped or
+			no user is given
+		'''
+		if not self.scoped or username is None: return None
+		return self.contacts.get(username, ())
+
+	def fetchContacts(self, username):
+		'''	Ask Django for the contacts of a user who has just connected
+		'''
+		d = getJSON(self.contacts_url, {'user' : username}, self.relay_token, self.clock)
+		d.addCallback(lambda rdata: self.setContacts(username, rdata['contacts'], True))
+		d.addErrback(lambda failure: log.msg('Unable to fetch contacts of %s: %s' % (
+			username, failure.getErrorMessage())))
+		return d
+
+	def replaceContacts(self, username, contacts):
+		'''	Replace the contacts of a user in the indexes
+			@return: The previous contacts
+		'''
+		previous = self.contacts.get(username, set())
+		for contact in previous - contacts:
+			watchers = self.watchers[contact]
+			watchers.discard(username)
+			if not watchers: del self.watchers[contact]
+		for contact in contacts - previous:
+			self.watchers.setdefault(contact, set()).add(username)
+		self.contacts[username] = contacts
+		return previous
+
+	def setContacts(self, username, contacts, fetched=False):
+		'''	Replace the contacts of a connected user, telling them about the users who
+			came into or went out of view. After the initial fetch they are sent a
+			full snapshot instead.
+		'''
+		if not self.factory.registry.connected(username): return
+		# Updates racing the initial fetch are covered by its answer
+		if not fetched and username not in self.contacts: return
+		contacts = set(contacts)
+		contacts.discard(username)
+		previous = self.replaceContacts(username, contacts)
+
+		if fetched:
+			self.factory.pushPresence([username], self.snapshot(username), self.snapshot)
+			return
+		userdata = self.factory.userdata
+		changes = [{'opcode' : 'user-join', 'user' : userdata[contact]}
+			for contact in contacts - previous if contact in userdata]
+		changes.extend({'opcode' : 'user-leave', 'user' : {'id' : contact}}
+			for contact in previous - contacts if contact in userdata)
+		if changes: self.factory.pushPresence([username], self.message(self.version, changes),
+			self.snapshot)
+
+	def updateContacts(self, contacts):
+		'''	Contacts sent by Django through the control channel after conversations
+			changed, as a dictionary of usernames to lists of contacts
+		'''
+		if not self.scoped: return
+		for username, usercontacts in contacts.iteritems():
+			self.setContacts(username, usercontacts)
+
+	def snapshot(self, username=None):
+		'''	Full presence, for clients which do not know any version
+		'''
+		visible = self.visible(username)
+		if visible is None: users = self.factory.activeUsers()
+		else:
+			userdata = self.factory.userdata
+			users = [userdata[contact] for contact in visible if contact in userdata]
+		return {
+			'opcode' : 'user-activelist',
+			'version' : self.version,
+			'users' : users,
+		}
+
+	def message(self, since, changes):
+		return {
+			'opcode' : 'user-presence',
+			'since' : since,
+			'version' : self.version,
+			'changes' : changes,
+		}
+
+	def delta(self, since, username=None):
+		'''	Changes since a version, or None if the change log no longer reaches back
+			that far. A user who joined and left again since then is left out.
+		'''
+		if since > self.version: return None
+		if since < self.version and (not self.changes or since < self.changes[0][0] - 1):
+			return None
+
+		visible = self.visible(username)
+		first, last = {}, {}
+		for version, opcode, userdata in self.changes:
+			if version <= since: continue
+			if visible is not None and userdata['id'] not in visible: continue
+			first.setdefault(userdata['id'], opcode)
+			last[userdata['id']] = (version, opcode, userdata)
+
+		return [{'opcode' : opcode, 'user' : userdata}
+			for version, opcode, userdata in sorted(last.values())
+			if opcode == first[userdata['id']]]
+
+	def since(self, version, username=None):
+		'''	Changes since a version, or a snapshot if they are no longer available
+		'''
+		try: version = int(version)
+		except (TypeError, ValueError): return self.snapshot(username)
+		changes = self.delta(version, username)
+		if changes is None: return self.snapshot(username)
+		return self.message(version, changes)
+
+	def push(self):
+		'''	Send the changes since the last push to the clients who can see them
+		'''
+		self.pushCall = None
+		since, self.pushed = self.pushed, self.version
+		changes = self.delta(since)
+		if changes is None:
+			recipients = list(self.factory.registry.by_user)
+			if self.scoped:
+				for username in recipients:
+					self.factory.pushPresence([username], self.snapshot(username), self.snapshot)
+			else: self.factory.pushPresence(recipients, self.snapshot(), self.snapshot)
+		elif not self.scoped:
+			if changes: self.factory.pushPresence(list(self.factory.registry.by_user),
+				self.message(since, changes), self.snapshot)
+		else:
+			# Each watcher only hears about their own contacts
+			audience = {}
+			for change in changes:
+				for watcher in self.watchers.get(change['user']['id'], ()):
+					audience.setdefault(watcher, []).append(change)
+			for watcher, watched in audience.iteritems():
+				self.factory.pushPresence([watcher], self.message(since, watched), self.snapshot)
+		log.msg('Presence version %d pushed' % self.version)
+
+	def stop(self):
+		'''	Cancel the pending push
+		'''
+		if self.pushCall is not None and self.pushCall.active(): self.pushCall.cancel()
+		self.pushCall = None
@@ -0,0 +1,92 @@
+from twisted.python import log
+
+
+class ConnectionRegistry(object):
+	'''	Index of the identified client connections. Connections are kept in sets,
+		indexed by user and by IP address, with a reverse index from connection to
+		user, so adding, removing and looking up connections are all O(1).
+	'''
+
+	def __init__(self):
+		# username -> set of connections
+		self.by_user = {}
+		# IP address -> set of connections
+		self.by_ip = {}
+		# connection -> username
+		self.users = {}
+		# username -> public user data, for users with at least one connection
+		self.userdata = {}
+
+	def __len__(self):
+		return len(self.users)
+
+	def __contains__(self, connection):
+		return connection in self.users
+
+	def add(self, username, connection):
+		'''	Add a connection of username to the registry
+			@return: True if this is the first connection of the user
+		'''
+		previous = self.users.get(connection)
+		if previous == username: return False
+		if previous is not None: self.remove(connection)
+		self.users[connection] = username
+		self.by_ip.setdefault(connection.ipaddr, set()).add(connection)
+
+		connections = self.by_user.get(username)
+		if connections is not None:
+			connections.add(connection)
+			return False
+		self.by_user[username] = set((connection, ))
+		self.userdata[username] = {
+			'id' : username,
+			'displayname' : connection.displayname,
+		}
+		return True
+
+	def remove(self, connection):
+		'''	Remove a connection from the registry
+			@return: True if this was the last connection of its user
+		'''
+		username = self.users.pop(connection, None)
+		if username is None: return False
+
+		addresses = self.by_ip.get(connection.ipaddr)
+		if addresses is not None:
+			addresses.discard(connection)
+			if not addresses: del self.by_ip[connection.ipaddr]
+
+		connections = self.by_user.get(username)
+		if connections is None:
+			log.msg('Unable to find any connections for user (%s)' % str(username))
+			return False
+		connections.discard(connection)
+		if connections: return False
+		del self.by_user[username]
+		self.userdata.pop(username, None)
+		return True
+
+	def user(self, connection):
+		'''	Return the user of a connection, or None if it is not registered
+		'''
+		return self.users.get(connection)
+
+	def connectionsOf(self, username):
+		'''	Return the connections of a user
+		'''
+		return self.by_user.get(username, ())
+
+	def connectionsFrom(self, ipaddr):
+		'''	Return the connections opened from an IP address
+		'''
+		return self.by_ip.get(ipaddr, ())
+
+	def connected(self, username):
+		'''	Check whether a user has at least one connection
+		'''
+		return username in self.by_user
+
+	def connections(self):
+		'''	Iterate over every registered connection
+		'''
+		return self.users.iterkeys()
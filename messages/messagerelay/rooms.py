@@ -0,0 +1,85 @@
+from twisted.python import log
+
+
+# Prefix of the topics which publish to the participants of a conversation
+CONVERSATION_TOPIC = 'conversation:'
+
+
+class Rooms(object):
+	'''	Conversation rooms: the participants of every conversation, and the live
+		connections of those participants. Publishing to a room is a single lookup
+		of its connection set, which is kept current as participants connect and
+		disconnect.
+	'''
+
+	def __init__(self):
+		# conversation id -> usernames of the participants
+		self.members = {}
+		# conversation id -> live connections of the participants
+		self.live = {}
+		# username -> conversation ids, for every participant
+		self.rooms_of = {}
+
+	def __len__(self):
+		return len(self.members)
+
+	def join(self, cid, usernames, registry):
+		'''	Add participants to a room, creating it if needed
+			@input registry (ConnectionRegistry): Connections of the participants
+		'''
+		members = self.members.setdefault(cid, set())
+		live = self.live.setdefault(cid, set())
+		for username in usernames:
+			if username in members: continue
+			members.add(username)
+			self.rooms_of.setdefault(username, set()).add(cid)
+			live.update(registry.connectionsOf(username))
+
+	def leave(self, cid, usernames, registry):
+		'''	Remove participants from a room, deleting it once it is empty
+		'''
+		members = self.members.get(cid)
+		if members is None: return
+		live = self.live[cid]
+		for username in usernames:
+			if username not in members: continue
+			members.discard(username)
+			self.forgetRoom(username, cid)
+			live.difference_update(registry.connectionsOf(username))
+		if not members: self.delete(cid)
+
+	def delete(self, cid):
+		'''	Remove a room and its participants
+		'''
+		for username in self.members.pop(cid, ()): self.forgetRoom(username, cid)
+		self.live.pop(cid, None)
+
+	def forgetRoom(self, username, cid):
+		rooms = self.rooms_of.get(username)
+		if rooms is None: return
+		rooms.discard(cid)
+		if not rooms: del self.rooms_of[username]
+
+	def sync(self, rooms, registry):
+		'''	Replace every room with the participants sent by Django
+			@input rooms (dictionary): Conversation ids to lists of usernames
+		'''
+		self.members, self.live, self.rooms_of = {}, {}, {}
+		for cid, usernames in rooms.iteritems(): self.join(cid, usernames, registry)
+		log.msg('Synchronized %d conversation rooms' % len(self.members))
+
+	def connectionAdded(self, username, connection):
+		'''	Add a new connection of a user to the rooms of the user
+		'''
+		for cid in self.rooms_of.get(username, ()): self.live[cid].add(connection)
+
+	def connectionRemoved(self, username, connection):
+		'''	Remove a closed connection from the rooms of its user
+		'''
+		for cid in self.rooms_of.get(username, ()): self.live[cid].discard(connection)
+
+	def connections(self, topic):
+		'''	Live connections subscribed to a topic
+		'''
+		if not topic.startswith(CONVERSATION_TOPIC): return ()
+		return self.live.get(topic[len(CONVERSATION_TOPIC):], ())
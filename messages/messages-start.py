@@ -5,29 +5,73 @@ from configobj import ConfigObj
 from twisted.internet import reactor
 from twisted.web.server import Site
 from twisted.web.resource import Resource
-from websockets import WebSocketsResource
+from websockets import WebSocketsResource, PerMessageDeflateOptions
 from twisted.python import log
 
 from messagerelay.messageserver import MessengerConnectionFactory
-from messagerelay.messagecontrol import WebSocketControl
+from messagerelay.messagecontrol import WebSocketControl, ControlChannelFactory, controlToken
+from messagerelay.outbox import OutboxPoller
 
 log.startLogging(sys.stdout)
 
+def setting_bool(settings, key, default=False):
+	'''	Read a boolean setting, which older config files may leave out
+	'''
+	return settings.as_bool(key) if key in settings else default
+
 if __name__ == '__main__':
 
 	# Load server settings
 	mdir = os.path.dirname(__file__)
 	settings = ConfigObj(os.path.join(mdir, 'webrtc-python.config'))
+	try: token = controlToken(settings)
+	except ValueError as err: sys.exit('Refusing to start: %s' % err)
 
 	# Configure Twisted Web
 	siteroot = Resource()
 	reactor.listenTCP(int(settings.get('port')), Site(siteroot), interface=settings.get('server'))
 
+	# Configure compression for clients which support it, off unless configured
+	deflate = None
+	if setting_bool(settings, 'deflate'):
+		deflate = PerMessageDeflateOptions(
+			minimumSize=int(settings.get('deflate_min_size', 128)),
+			maxContexts=int(settings['deflate_max_contexts'])
+				if settings.get('deflate_max_contexts') else None,
+			serverMaxWindowBits=int(settings.get('deflate_window_bits', 15)),
+			clientMaxWindowBits=int(settings.get('deflate_window_bits', 15)),
+			serverNoContextTakeover=setting_bool(settings, 'deflate_no_context_takeover'))
+
 	# Add websocket connection protocol/factory as a resource
-	websocket_messages = MessengerConnectionFactory(root_site=siteroot)
-	siteroot.putChild('messages', WebSocketsResource(websocket_messages))
+	websocket_messages = MessengerConnectionFactory(root_site=siteroot, settings=settings)
+	siteroot.putChild('messages', WebSocketsResource(websocket_messages,
+		maxFrameSize=int(settings['max_frame_size']) if settings.get('max_frame_size') else None,
+		maxMessageSize=int(settings.get('max_message_size', 16777216)),
+		streamFragments=setting_bool(settings, 'stream_fragments'), deflate=deflate,
+		coalesceDelay=float(settings['coalesce_delay']) if settings.get('coalesce_delay') else None))
 
 	# Add control interface
-	siteroot.putChild('control', WebSocketControl(siteroot, websocket_messages))
+	siteroot.putChild('control', WebSocketControl(siteroot, websocket_messages, token))
+
+	# Add the persistent control channel, on a Unix domain socket or a TCP port
+	control_channel = ControlChannelFactory(websocket_messages, token,
+		int(settings.get('control_max_length', 16777216)))
+	if settings.get('control_socket'):
+		reactor.listenUNIX(settings['control_socket'], control_channel)
+	elif settings.get('control_port'):
+		reactor.listenTCP(int(settings['control_port']), control_channel,
+			interface=settings.get('control_interface', '127.0.0.1'))
+
+	# Run the Django outbox dispatcher, which delivers the control requests Django
+	# writes to its outbox, alongside the relay
+	if settings.get('outbox_command'):
+		outbox = OutboxPoller(settings['outbox_command'],
+			os.path.join(mdir, settings.get('outbox_directory', '.')),
+			float(settings.get('outbox_restart_delay', 5)))
+		reactor.callWhenRunning(outbox.start)
+		reactor.addSystemEventTrigger('before', 'shutdown', outbox.stop)
+
+	# Load conversation rooms once the reactor is running
+	reactor.callWhenRunning(websocket_messages.loadRooms)
 
 	reactor.run()
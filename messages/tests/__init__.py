@@ -0,0 +1,4 @@
+"""
+Unit tests of the message relay. Run them from the messages directory with
+C{trial tests}.
+"""
@@ -0,0 +1,176 @@
+import json, struct
+from StringIO import StringIO
+
+from twisted.internet.address import IPv4Address
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial.unittest import TestCase
+from twisted.web.resource import Resource
+from twisted.web.test.requesthelper import DummyRequest
+
+from messagerelay.messagecontrol import (DEVELOPMENT_TOKEN, ControlChannelFactory,
+	WebSocketControl, controlToken, tokenMatches)
+
+
+class Factory(object):
+	'''	Stand-in for MessengerConnectionFactory, recording the messages it is asked
+		to forward
+	'''
+
+	def __init__(self):
+		self.forwarded = []
+
+	def controlReceived(self, mdata):
+		return False
+
+	def broadcast(self, recipients, mdata):
+		delivered = len(recipients)
+		self.forwarded.append((recipients, mdata))
+		return delivered
+
+
+def frame(mdata):
+	rdata = mdata if isinstance(mdata, str) else json.dumps(mdata)
+	return struct.pack('!I', len(rdata)) + rdata
+
+
+class ControlTokenTests(TestCase):
+	'''	Relay token read from the settings
+	'''
+
+	def testToken(self):
+		'''	The token is required, and the development one only allowed under debug
+		'''
+		self.assertEquals(controlToken({ 'relay_token' : u'secret' }), 'secret')
+		self.assertEquals(controlToken({ 'relay_token' : DEVELOPMENT_TOKEN, 'debug' : 'True' }),
+			DEVELOPMENT_TOKEN)
+		self.assertRaises(ValueError, controlToken, {})
+		self.assertRaises(ValueError, controlToken, { 'relay_token' : DEVELOPMENT_TOKEN })
+		self.assertRaises(ValueError, controlToken,
+			{ 'relay_token' : DEVELOPMENT_TOKEN, 'debug' : 'False' })
+
+	def testMatches(self):
+		'''	Only the same token matches, whatever its type
+		'''
+		self.assertTrue(tokenMatches('secret', 'secret'))
+		self.assertTrue(tokenMatches(u'secret', 'secret'))
+		for token in ('wrong', '', None, 42, ['secret']):
+			self.assertFalse(tokenMatches(token, 'secret'))
+
+
+class ControlChannelTests(TestCase):
+	'''	Handshake and requests of a control channel from Django
+	'''
+
+	def setUp(self):
+		self.websockets = Factory()
+		self.channel = ControlChannelFactory(self.websockets, 'secret', max_length=1024) \
+			.buildProtocol(None)
+		self.transport = StringTransport(peerAddress=IPv4Address('TCP', '127.0.0.1', 4000))
+		self.channel.makeConnection(self.transport)
+
+	def received(self):
+		'''	Frames written by the relay since the last call
+		'''
+		rdata, frames = self.transport.value(), []
+		self.transport.clear()
+		while rdata:
+			length, = struct.unpack('!I', rdata[:4])
+			frames.append(json.loads(rdata[4:4 + length]))
+			rdata = rdata[4 + length:]
+		return frames
+
+	def testHandshake(self):
+		'''	Requests are carried out once the channel is authenticated
+		'''
+		self.channel.dataReceived(frame({ 'opcode' : 'control-auth', 'token' : 'secret' }))
+		self.assertEquals(self.received(), [{ 'status' : 'success' }])
+		self.channel.dataReceived(frame({ 'opcode' : 'message', 'recipients' : ['alice'],
+			'ack' : 1 }))
+		self.assertEquals(self.received(), [{ 'status' : 'success', 'delivered' : 1, 'ack' : 1 }])
+		self.assertEquals(self.websockets.forwarded, [(['alice'], { 'opcode' : 'message' })])
+		self.assertFalse(self.transport.disconnecting)
+
+	def testRefused(self):
+		'''	A wrong token, a missing handshake or a request sent in its place closes
+			the channel without carrying out anything
+		'''
+		for rdata in ({ 'opcode' : 'control-auth', 'token' : 'wrong' },
+				{ 'opcode' : 'control-auth' },
+				{ 'opcode' : 'message', 'recipients' : ['alice'], 'ack' : 1 },
+				'not json'):
+			self.setUp()
+			self.channel.dataReceived(frame(rdata))
+			self.assertEquals(self.received(), [{ 'status' : 'fail', 'error' : 'Invalid relay token' }])
+			self.assertTrue(self.transport.disconnecting)
+			self.assertEquals(self.websockets.forwarded, [])
+
+	def testBatch(self):
+		'''	A batch is answered with the result of each request in order, and a
+			request which fails does not stop the ones after it
+		'''
+		self.channel.dataReceived(frame({ 'opcode' : 'control-auth', 'token' : 'secret' }))
+		self.received()
+		self.channel.dataReceived(frame({ 'ack' : 7, 'events' : [
+			{ 'opcode' : 'message', 'recipients' : ['alice', 'bob'] },
+			{ 'opcode' : 'message', 'recipients' : 5 },
+			'not a request',
+			{ 'opcode' : 'message', 'recipients' : ['carol'] }] }))
+		[response] = self.received()
+		self.assertEquals((response['ack'], response['status']), (7, 'success'))
+		self.assertEquals([result['status'] for result in response['results']],
+			['success', 'fail', 'fail', 'success'])
+		self.assertEquals([result.get('delivered') for result in response['results']],
+			[2, None, None, 1])
+		self.assertEquals(self.websockets.forwarded, [(['alice', 'bob'], { 'opcode' : 'message' }),
+			(['carol'], { 'opcode' : 'message' })])
+		self.assertEquals(len(self.flushLoggedErrors(TypeError, AttributeError)), 2)
+
+	def testLength(self):
+		'''	Frames are limited to HANDSHAKE_LENGTH until the handshake, and to the
+			factory's max_length after it
+		'''
+		self.channel.dataReceived(struct.pack('!I', self.channel.HANDSHAKE_LENGTH + 1))
+		self.assertTrue(self.transport.disconnecting)
+
+		self.setUp()
+		self.channel.dataReceived(frame({ 'opcode' : 'control-auth', 'token' : 'secret' }))
+		self.assertEquals(self.channel.MAX_LENGTH, 1024)
+		self.channel.dataReceived(struct.pack('!I', 1025))
+		self.assertTrue(self.transport.disconnecting)
+
+
+class WebSocketControlTests(TestCase):
+	'''	Control requests POSTed by Django
+	'''
+
+	def setUp(self):
+		self.websockets = Factory()
+		self.resource = WebSocketControl(Resource(), self.websockets, 'secret')
+
+	def post(self, mdata, token='secret'):
+		request = DummyRequest([''])
+		request.method = 'POST'
+		request.content = StringIO(json.dumps(mdata))
+		if token is not None: request.requestHeaders.setRawHeaders('X-Relay-Token', [token])
+		return request, json.loads(self.resource.render(request))
+
+	def testBatch(self):
+		'''	A batch gets one result per request, in order, whether each succeeded
+			or failed
+		'''
+		request, response = self.post({ 'events' : [
+			{ 'opcode' : 'message', 'recipients' : 5 },
+			{ 'opcode' : 'message', 'recipients' : ['alice'] }] })
+		self.assertEquals(response['status'], 'success')
+		self.assertEquals([(result['status'], result.get('delivered')) for result in response['results']],
+			[('fail', None), ('success', 1)])
+		self.assertEquals(len(self.flushLoggedErrors(TypeError)), 1)
+
+	def testRefused(self):
+		'''	Requests without the relay token are refused, batched or not
+		'''
+		for token in (None, 'wrong'):
+			request, response = self.post({ 'events' : [
+				{ 'opcode' : 'message', 'recipients' : ['alice'] }] }, token)
+			self.assertEquals((request.responseCode, response['status']), (403, 'fail'))
+		self.assertEquals(self.websockets.forwarded, [])
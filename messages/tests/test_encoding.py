@@ -0,0 +1,105 @@
+import json
+
+from twisted.trial.unittest import TestCase
+
+from messagerelay.messageencoding import JSONDecoder, MessagePackDecoder, msgpack
+
+
+class JSONDecoderTests(TestCase):
+	'''	Splitting of the newline-delimited JSON documents sent by a client
+	'''
+
+	def setUp(self):
+		self.decoder = JSONDecoder(max_size=64)
+
+	def feed(self, *chunks):
+		return [self.decoder.feed(chunk) for chunk in chunks]
+
+	def testBatched(self):
+		'''	Several documents in one message, and bare objects and arrays without
+			their newline, are each decoded
+		'''
+		self.assertEquals(self.feed('{"a" : 1}\r\n{"b" : 2}\n', '{"c" : 3}', '[4] [5]'),
+			[[{'a' : 1}, {'b' : 2}], [{'c' : 3}], [[4], [5]]])
+
+	def testSplit(self):
+		'''	A document split across messages is decoded when its last part arrives
+		'''
+		self.assertEquals(self.feed('{"a" : ', '[1, {"b" ', ': 2}]', '}\n'),
+			[[], [], [], [{'a' : [1, {'b' : 2}]}]])
+
+	def testValuesWaitForNewline(self):
+		'''	Values other than objects and arrays may continue in the next message,
+			so they are only decoded at their newline
+		'''
+		self.assertEquals(self.feed('12', '34', '\n'), [[], [], [1234]])
+
+	def testStrings(self):
+		'''	Brackets, quotes and backslashes within strings do not end a document,
+			even when an escape is split across messages
+		'''
+		self.assertEquals(self.feed('{"a" : "}]\\', '"', '\\\\"}'),
+			[[], [], [{'a' : '}]"\\'}]])
+
+	def testMalformed(self):
+		'''	A malformed document is reported, and the ones after it still decoded
+		'''
+		[[error, document]] = self.feed('{"a" : 1\n{"b" : 2}\n')
+		self.assertIsInstance(error, ValueError)
+		self.assertEquals(document, {'b' : 2})
+
+	def testTooLong(self):
+		'''	A document longer than max_size is reported once, then skipped until it
+			ends
+		'''
+		[[error], skipped, [document]] = self.feed('{"a" : "%s' % ('x' * 64), 'x' * 64,
+			'"}{"b" : 2}')
+		self.assertEquals(str(error), 'Document exceeds 64 bytes')
+		self.assertEquals((skipped, document), ([], {'b' : 2}))
+
+	def testParsedOnce(self):
+		'''	A document received in many small messages is parsed once, when it is
+			complete, rather than each time a part arrives
+		'''
+		loads = json.loads
+		parsed = []
+		def counting(data):
+			parsed.append(len(data))
+			return loads(data)
+		self.patch(json, 'loads', counting)
+
+		self.decoder = JSONDecoder()
+		data = json.dumps({ 'opcode' : 'user-identity', 'items' : ['x' * 8] * 1000 })
+		documents = []
+		for offset in xrange(0, len(data), 16):
+			documents.extend(self.decoder.feed(data[offset:offset + 16]))
+		self.assertEquals(documents, [loads(data)])
+		self.assertEquals(parsed, [len(data)])
+
+
+class MessagePackDecoderTests(TestCase):
+	'''	Splitting of the MessagePack documents sent by a client
+	'''
+	if msgpack is None: skip = 'msgpack is not installed'
+
+	def setUp(self):
+		self.decoder = MessagePackDecoder(max_size=64)
+
+	def testSplit(self):
+		'''	Documents are decoded once complete, several at a time or across
+			messages, with strings as unicode
+		'''
+		data = msgpack.packb({ 'opcode' : 'user-active' }) + msgpack.packb([1, 2])
+		self.assertEquals(self.decoder.feed(data[:5]), [])
+		documents = self.decoder.feed(data[5:])
+		self.assertEquals(documents, [{ 'opcode' : 'user-active' }, [1, 2]])
+		self.assertIsInstance(documents[0].keys()[0], unicode)
+
+	def testMalformed(self):
+		'''	A malformed or oversized document is reported, and the stream starts
+			again with the next message
+		'''
+		for data in ('\xc1', msgpack.packb('x' * 100)):
+			[error] = self.decoder.feed(data)
+			self.assertIsInstance(error, ValueError)
+			self.assertEquals(self.decoder.feed(msgpack.packb({ 'a' : 1 })), [{ 'a' : 1 }])
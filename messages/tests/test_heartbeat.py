@@ -0,0 +1,148 @@
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from messagerelay.heartbeat import TimerWheel, Heartbeat
+
+
+class TimerWheelTests(TestCase):
+	'''	Timers of a wheel with 0.5 second ticks and 8 slots, driven by a fake clock
+	'''
+
+	def setUp(self):
+		self.clock = Clock()
+		self.wheel = TimerWheel(0.5, slots=8, clock=self.clock)
+		self.fired = []
+		self.addCleanup(self.wheel.stop)
+
+	def fire(self, name):
+		self.fired.append((name, self.clock.seconds()))
+
+	def testFires(self):
+		'''	Timers fire on the first tick at or after their delay, in a single pass
+		'''
+		self.wheel.schedule(1, self.fire, 'a')
+		self.wheel.schedule(0.7, self.fire, 'b')
+		self.wheel.schedule(0, self.fire, 'c')
+		self.clock.pump([0.5] * 4)
+		self.assertEquals(sorted(self.fired), [('a', 1.0), ('b', 1.0), ('c', 0.5)])
+		self.assertEquals(len(self.wheel), 0)
+
+	def testRounds(self):
+		'''	Timers further away than one revolution wait out their rounds
+		'''
+		self.wheel.schedule(4, self.fire, 'one round')
+		self.wheel.schedule(9, self.fire, 'two rounds')
+		self.clock.pump([0.5] * 20)
+		self.assertEquals(self.fired, [('one round', 4.0), ('two rounds', 9.0)])
+
+	def testCancel(self):
+		'''	A cancelled timer never fires, and cancelling it again or cancelling
+			None does nothing
+		'''
+		timer = self.wheel.schedule(1, self.fire, 'cancelled')
+		self.wheel.schedule(1, self.fire, 'kept')
+		self.wheel.cancel(timer)
+		self.wheel.cancel(timer)
+		self.wheel.cancel(None)
+		self.clock.pump([0.5] * 4)
+		self.assertEquals(self.fired, [('kept', 1.0)])
+
+	def testReschedule(self):
+		'''	A timer is moved by cancelling it and scheduling it again, also from
+			within a callback
+		'''
+		timer = self.wheel.schedule(1, self.fire, 'moved')
+		self.clock.advance(0.5)
+		self.wheel.cancel(timer)
+		self.wheel.schedule(2, self.fire, 'moved')
+
+		repeats = []
+		def again():
+			self.fire('repeat')
+			repeats.append(None)
+			if len(repeats) < 2: self.wheel.schedule(1, again)
+		self.wheel.schedule(1, again)
+		self.clock.pump([0.5] * 8)
+		self.assertEquals(sorted(self.fired), [('moved', 2.5), ('repeat', 1.5), ('repeat', 2.5)])
+
+	def testFailingCallback(self):
+		'''	A timer which raises does not keep the others of its slot from firing
+		'''
+		self.wheel.schedule(0.5, lambda: 1 / 0)
+		self.wheel.schedule(0.5, self.fire, 'after')
+		self.clock.advance(0.5)
+		self.assertEquals(self.fired, [('after', 0.5)])
+		self.assertEquals(len(self.flushLoggedErrors(ZeroDivisionError)), 1)
+
+	def testCatchUp(self):
+		'''	Ticks missed while the reactor was busy are caught up at once
+		'''
+		self.wheel.schedule(1, self.fire, 'late')
+		self.clock.advance(0.5)
+		self.clock.advance(2)
+		self.assertEquals(self.fired, [('late', 2.5)])
+
+
+class Transport(object):
+	'''	Transport of a connection under heartbeat, recording what was done to it
+	'''
+
+	def __init__(self):
+		self.pings = 0
+		self.closed = None
+
+	def ping(self): self.pings += 1
+	def loseConnection(self): self.closed = 'lost'
+	def abortConnection(self): self.closed = 'aborted'
+
+
+class Connection(object):
+	def __init__(self):
+		self.transport = Transport()
+		self.username = None
+		self.cdata = None
+
+
+class HeartbeatTests(TestCase):
+	'''	Login deadline, pings and pong timeouts of connections
+	'''
+
+	def setUp(self):
+		self.clock = Clock()
+		self.heartbeat = Heartbeat({ 'login_deadline' : 2, 'ping_interval' : 5,
+			'pong_timeout' : 2, 'heartbeat_resolution' : 0.5 }, clock=self.clock)
+		self.addCleanup(self.heartbeat.wheel.stop)
+		self.connection = Connection()
+		self.heartbeat.watch(self.connection)
+
+	def testLoginDeadline(self):
+		'''	Connections which have not identified their user in time are closed
+		'''
+		self.clock.pump([0.5] * 4)
+		self.assertEquals(self.connection.transport.closed, 'lost')
+
+	def testPingPong(self):
+		'''	Clients are pinged, and those which answer are kept
+		'''
+		self.connection.username = 'alice'
+		for i in xrange(3):
+			self.clock.pump([0.5] * 10)
+			self.heartbeat.pong(self.connection)
+		self.assertEquals(self.connection.transport.pings, 3)
+		self.assertEquals(self.connection.transport.closed, None)
+
+	def testPongTimeout(self):
+		'''	Clients which do not answer a ping in time are evicted
+		'''
+		self.connection.username = 'alice'
+		self.clock.pump([0.5] * 14)
+		self.assertEquals(self.connection.transport.closed, 'aborted')
+
+	def testForget(self):
+		'''	Closed connections have all of their timers cancelled
+		'''
+		self.heartbeat.forget(self.connection)
+		self.clock.pump([0.5] * 20)
+		self.assertEquals((self.connection.transport.pings, self.connection.transport.closed),
+			(0, None))
+		self.assertEquals(len(self.heartbeat.wheel), 0)
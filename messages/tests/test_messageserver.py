@@ -0,0 +1,428 @@
+import json
+
+from twisted.internet import defer
+from twisted.internet.error import ConnectionDone, ConnectionRefusedError
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial.unittest import TestCase
+
+from websockets import (_CONTROLS, _FrameParser, PerMessageDeflateOptions,
+	WebSocketsResource)
+from messagerelay import messageserver
+from messagerelay.messageencoding import msgpack
+from messagerelay.messageserver import MessengerConnectionFactory, CLOSE_POLICY_VIOLATION
+from messagerelay.heartbeat import Heartbeat
+from messagerelay.presence import Presence
+
+from .test_websockets import _clientFrame
+
+
+class Transport(StringTransport):
+	'''	Client connection, recording every write made to it
+	'''
+
+	def __init__(self):
+		StringTransport.__init__(self)
+		self.writes = []
+
+	def write(self, data):
+		self.writes.append(data)
+		StringTransport.write(self, data)
+
+	def writeSequence(self, seq):
+		self.writes.append(list(seq))
+		StringTransport.write(self, ''.join(seq))
+
+
+class Request(object):
+	'''	WebSocket handshake request, as WebSocketsResource.render sees it
+	'''
+	method = 'GET'
+
+	def __init__(self, transport, headers):
+		self.transport = transport
+		self.headers = dict((name.lower(), value) for name, value in headers.iteritems())
+		self.responseHeaders = {}
+		self.code = 200
+
+	def getHeader(self, name): return self.headers.get(name.lower())
+	def setHeader(self, name, value): self.responseHeaders[name.lower()] = value
+	def setResponseCode(self, code): self.code = code
+	def write(self, data): pass
+	def isSecure(self): return False
+
+
+class Client(object):
+	'''	Client of the relay: decodes the frames it is sent the way a browser does
+	'''
+
+	def __init__(self, request, transport):
+		self.request = request
+		self.transport = transport
+		# Neither is set when the handshake was refused
+		self.protocol = getattr(transport, 'protocol', None)
+		self.connection = getattr(self.protocol, 'wrappedProtocol', None)
+		# Inflates with a context of its own, kept across messages
+		self.inflater = None
+		if 'sec-websocket-extensions' in request.responseHeaders:
+			response, self.inflater = PerMessageDeflateOptions().negotiate(
+				request.responseHeaders['sec-websocket-extensions'])
+		self.parser = _FrameParser(deflate=self.inflater)
+
+	def send(self, mdata):
+		if self.connection.encoding.binary:
+			self.protocol.dataReceived(_clientFrame(msgpack.packb(mdata), opcode=0x2))
+		else: self.protocol.dataReceived(_clientFrame(json.dumps(mdata)))
+
+	def disconnect(self):
+		self.protocol.connectionLost(Failure(ConnectionDone()))
+
+	def frames(self):
+		'''	Frames sent to the client since the last call, as (opcode, payload)
+		'''
+		data = self.transport.value()
+		self.transport.clear()
+		del self.transport.writes[:]
+		return [(opcode, payload if opcode == _CONTROLS.CLOSE else payload.tobytes())
+			for opcode, payload in self.parser.feed(data)]
+
+	def received(self):
+		'''	Messages sent to the client since the last call
+		'''
+		messages = []
+		for opcode, payload in self.frames():
+			if opcode == _CONTROLS.BINARY: messages.append(msgpack.unpackb(payload, raw=False))
+			elif opcode == _CONTROLS.NORMAL: messages.append(json.loads(payload))
+		return messages
+
+
+class RelayCase(TestCase):
+	'''	Relay serving clients through WebSocketsResource, driven by a fake clock
+	'''
+	settings = {}
+	resourceOptions = {}
+
+	def setUp(self):
+		self.clock = Clock()
+		self.factory = MessengerConnectionFactory(settings=self.settings)
+		self.factory.heartbeat = Heartbeat(self.settings, clock=self.clock)
+		self.factory.presence = Presence(self.factory, self.settings, clock=self.clock)
+		self.addCleanup(self.factory.heartbeat.wheel.stop)
+		self.addCleanup(self.factory.presence.stop)
+		self.resource = WebSocketsResource(self.factory, **self.resourceOptions)
+		self.resource._factory.reactor = self.clock
+
+	def handshake(self, protocol=None, extensions=None):
+		'''	Open a WebSocket connection to the relay
+			@return: Client of the connection
+		'''
+		headers = { 'Upgrade' : 'websocket', 'Connection' : 'Upgrade',
+			'Sec-WebSocket-Key' : 'dGhlIHNhbXBsZSBub25jZQ==', 'Sec-WebSocket-Version' : '13' }
+		if protocol is not None: headers['Sec-WebSocket-Protocol'] = protocol
+		if extensions is not None: headers['Sec-WebSocket-Extensions'] = extensions
+		transport = Transport()
+		request = Request(transport, headers)
+		self.resource.render(request)
+		return Client(request, transport)
+
+	def connect(self, username, protocol=None, extensions=None):
+		'''	Open a connection and identify its user
+			@return: Client of the connection
+		'''
+		client = self.handshake(protocol, extensions)
+		client.send({ 'opcode' : 'user-identity', 'user-identify' : { 'id' : username } })
+		client.frames()
+		return client
+
+
+class BroadcastTests(RelayCase):
+	'''	Messages broadcast to clients using different encodings and compression
+	'''
+	message = { 'opcode' : 'message-create', 'message' : { 'text' : 'hello ' * 40 } }
+
+	def setUp(self):
+		RelayCase.setUp(self)
+		self.resource._deflate = PerMessageDeflateOptions(minimumSize=64)
+		prepared = self.prepared = []
+		base = messageserver.PreparedFrame
+		class PreparedFrame(base):
+			def __init__(self, *args, **kwargs):
+				base.__init__(self, *args, **kwargs)
+				prepared.append(self)
+		self.patch(messageserver, 'PreparedFrame', PreparedFrame)
+
+	def testOneFramePerEncoding(self):
+		'''	A broadcast is encoded once per encoding in use, and clients which
+			compress every message on its own share one compressed frame
+		'''
+		plain = [self.connect('alice'), self.connect('bob')]
+		shared = [self.connect(username, extensions='permessage-deflate; server_no_context_takeover')
+			for username in ('carol', 'dave')]
+		own = self.connect('erin', extensions='permessage-deflate')
+		clients = plain + shared + [own]
+		if msgpack is not None: clients.append(self.connect('frank', protocol='msgpack'))
+
+		delivered = self.factory.broadcast([client.connection.username for client in clients],
+			self.message)
+		self.assertEquals(delivered, len(clients))
+		self.assertEquals(sorted(frame.data for frame in self.prepared),
+			sorted(set(client.connection.encoding.encode(self.message) for client in clients)))
+		[first], [second] = [client.transport.writes for client in plain]
+		self.assertIdentical(first, second)
+		[first], [second] = [client.transport.writes for client in shared]
+		self.assertIdentical(first, second)
+		self.assertNotEquals(plain[0].transport.writes, shared[0].transport.writes)
+		for client in clients:
+			self.assertEquals(client.received(), [self.message])
+
+	def testContextTakeover(self):
+		'''	Clients which keep a compression context are sent frames compressed
+			with their own context, which they inflate with theirs
+		'''
+		clients = [self.connect(username, extensions='permessage-deflate')
+			for username in ('alice', 'bob')]
+		self.factory.broadcast(['alice'], self.message)
+		clients[0].received()
+		self.factory.broadcast(['alice', 'bob'], self.message)
+		[again], [first] = [client.transport.writes for client in clients]
+		self.assertTrue(len(again) < len(first))
+		for client in clients:
+			self.assertEquals(client.received(), [self.message])
+
+	def testUnidentified(self):
+		'''	Only identified connections of the recipients are sent a broadcast
+		'''
+		alice, bob = self.connect('alice'), self.connect('bob')
+		anonymous = self.handshake()
+		self.assertEquals(self.factory.broadcast(['alice', 'nobody'], self.message), 1)
+		self.assertEquals(alice.received(), [self.message])
+		self.assertEquals((bob.received(), anonymous.received()), ([], []))
+
+
+class OutboundQueueTests(RelayCase):
+	'''	Outbound queues of clients which stop reading, with watermarks of 4 and 2
+		messages
+	'''
+	settings = { 'outbound_high_messages' : '4', 'outbound_low_messages' : '2' }
+
+	def presence(self, version):
+		return { 'opcode' : 'user-presence', 'since' : version - 1, 'version' : version,
+			'changes' : [] }
+
+	def message(self, number):
+		return { 'opcode' : 'message-create', 'message' : { 'number' : number } }
+
+	def stalled(self):
+		'''	Connect a client whose transport has asked the relay to pause
+		'''
+		client = self.connect('alice')
+		client.connection.pauseProducing()
+		return client
+
+	def testQueued(self):
+		'''	Messages wait while the transport is paused, and are written in order
+			once it drains
+		'''
+		client = self.stalled()
+		for number in xrange(3): client.connection.sendMessage(self.message(number))
+		self.assertEquals(client.received(), [])
+		self.assertEquals(client.connection.queueDepth()['messages'], 3)
+		client.connection.resumeProducing()
+		self.assertEquals(client.received(), [self.message(number) for number in xrange(3)])
+		self.assertEquals((client.connection.outbound_bytes, client.connection.queueDepth()['messages']),
+			(0, 0))
+
+	def testDropPresence(self):
+		'''	By default the oldest presence updates are dropped until the queue is back
+			under its low watermark, and the client is then sent a snapshot instead
+			of the next update
+		'''
+		client = self.stalled()
+		for mdata in (self.presence(1), self.message(1), self.presence(2), self.message(2),
+				self.presence(3)):
+			client.connection.sendMessage(mdata)
+		client.connection.resumeProducing()
+		self.assertEquals(client.received(), [self.message(1), self.message(2)])
+		self.assertFalse(client.transport.disconnecting)
+
+		self.factory.pushPresence(['alice'], self.presence(4), self.factory.presence.snapshot)
+		[snapshot] = client.received()
+		self.assertEquals(snapshot['opcode'], 'user-activelist')
+		self.factory.pushPresence(['alice'], self.presence(5), self.factory.presence.snapshot)
+		self.assertEquals(client.received(), [self.presence(5)])
+
+	def testMerge(self):
+		'''	With the merge policy only the latest presence update of each kind is
+			kept
+		'''
+		self.factory.outbound_overflow = 'merge'
+		client = self.stalled()
+		snapshot = { 'opcode' : 'user-activelist', 'version' : 1, 'users' : [] }
+		for mdata in (snapshot, self.presence(2), self.message(1), self.presence(3),
+				self.message(2)):
+			client.connection.sendMessage(mdata)
+		client.connection.resumeProducing()
+		self.assertEquals(client.received(),
+			[snapshot, self.message(1), self.presence(3), self.message(2)])
+
+	def testDisconnect(self):
+		'''	A queue which dropping presence updates can't bring down closes the
+			connection with a policy violation, and nothing is sent after the close
+		'''
+		client = self.stalled()
+		for number in xrange(5): client.connection.sendMessage(self.message(number))
+		self.assertTrue(client.transport.disconnecting)
+		client.connection.sendMessage(self.message(5))
+		client.connection.resumeProducing()
+		self.assertEquals(client.frames(), [(_CONTROLS.CLOSE,
+			(CLOSE_POLICY_VIOLATION, 'Outbound queue overflow'))])
+		self.assertEquals(client.connection.queueDepth()['messages'], 0)
+
+	def testDisconnectPolicy(self):
+		'''	With the disconnect policy even presence updates are kept, and the client
+			is disconnected as soon as its queue overflows
+		'''
+		self.factory.outbound_overflow = 'disconnect'
+		client = self.stalled()
+		for version in xrange(1, 5): client.connection.sendMessage(self.presence(version))
+		self.assertFalse(client.transport.disconnecting)
+		client.connection.sendMessage(self.presence(5))
+		self.assertTrue(client.transport.disconnecting)
+
+	def testByteWatermark(self):
+		'''	The queue also overflows when its messages take more bytes than the high
+			watermark
+		'''
+		self.factory.outbound_high_bytes = 100
+		client = self.stalled()
+		client.connection.sendMessage(self.message('x' * 40))
+		self.assertFalse(client.transport.disconnecting)
+		client.connection.sendMessage(self.message('y' * 40))
+		self.assertTrue(client.transport.disconnecting)
+
+
+class EncodingTests(RelayCase):
+	'''	Message encodings chosen by clients through the WebSocket subprotocol
+	'''
+	if msgpack is None: skip = 'msgpack is not installed'
+
+	message = { 'opcode' : 'message-create', 'message' : { 'cid' : 'c1', 'text' : u'h\xe9llo' } }
+
+	def testNegotiation(self):
+		'''	The first subprotocol offered which the relay knows is chosen and
+			answered, and clients offering none get JSON
+		'''
+		for offered, chosen in (('msgpack', 'msgpack'), ('x-unknown, msgpack, json', 'msgpack'),
+				('json', 'json'), (None, None)):
+			client = self.handshake(offered)
+			self.assertEquals(client.request.code, 101)
+			self.assertEquals(client.request.responseHeaders.get('sec-websocket-protocol'), chosen)
+			self.assertEquals(client.connection.encoding.name, chosen or 'json')
+			self.assertEquals(client.protocol.binary, chosen == 'msgpack')
+
+	def testUnknownSubprotocol(self):
+		'''	A client offering only subprotocols the relay does not know is refused
+		'''
+		client = self.handshake('x-unknown, soap')
+		self.assertEquals(client.request.code, 400)
+		self.assertEquals(client.request.responseHeaders.get('sec-websocket-protocol'), None)
+		self.assertIdentical(client.protocol, None)
+
+	def testSameBroadcast(self):
+		'''	JSON and MessagePack clients receive the same broadcast, the latter in
+			binary frames
+		'''
+		text, binary = self.connect('alice'), self.connect('bob', 'msgpack')
+		self.assertEquals(self.factory.broadcast(['alice', 'bob'], self.message), 2)
+		[(opcode, payload)] = text.frames()
+		self.assertEquals((opcode, json.loads(payload)), (_CONTROLS.NORMAL, self.message))
+		[(opcode, payload)] = binary.frames()
+		self.assertEquals((opcode, msgpack.unpackb(payload, raw=False)),
+			(_CONTROLS.BINARY, self.message))
+
+	def testBinaryRequests(self):
+		'''	MessagePack clients send their requests in binary frames, and are
+			answered in MessagePack
+		'''
+		client = self.connect('bob', 'msgpack')
+		self.assertEquals(self.factory.registry.user(client.connection), 'bob')
+		client.send({ 'opcode' : 'user-active' })
+		[snapshot] = client.received()
+		self.assertEquals((snapshot['opcode'], [user['id'] for user in snapshot['users']]),
+			('user-activelist', ['bob']))
+		client.protocol.dataReceived(_clientFrame('\xc1', opcode=0x2))
+		self.assertEquals(client.received(),
+			[{ 'error' : 'parse-error', 'message' : 'Unable to parse request' }])
+
+
+class RoomTests(RelayCase):
+	'''	Conversation rooms kept from Django's control requests, and publishing to
+		their live connections
+	'''
+	settings = { 'rooms_url' : 'http://django/api/relay/rooms/', 'relay_token' : 'secret' }
+	message = { 'opcode' : 'message-create', 'message' : { 'cid' : 'c1', 'text' : 'hello' } }
+
+	def control(self, opcode, **message):
+		self.assertTrue(self.factory.controlReceived({ 'opcode' : opcode, 'message' : message }))
+
+	def publish(self, cid):
+		return self.factory.publish('conversation:' + cid, self.message)
+
+	def testSync(self):
+		'''	Rooms synchronized from Django are published to the live connections of
+			their participants, and only theirs
+		'''
+		alice = [self.connect('alice'), self.connect('alice')]
+		bob, erin = self.connect('bob'), self.connect('erin')
+		self.control('room-sync', rooms={ 'c1' : ['alice', 'bob', 'carol'], 'c2' : ['carol'] })
+		self.assertEquals(len(self.factory.rooms), 2)
+		self.assertEquals(self.publish('c1'), 3)
+		for client in alice + [bob]: self.assertEquals(client.received(), [self.message])
+		self.assertEquals(erin.received(), [])
+		self.assertEquals((self.publish('c2'), self.publish('unknown')), (0, 0))
+		self.assertEquals(self.factory.publish('c1', self.message), 0)
+
+		self.control('room-sync', rooms={ 'c2' : ['carol', 'erin'] })
+		self.assertEquals((self.publish('c1'), self.publish('c2')), (0, 1))
+
+	def testMembership(self):
+		'''	Participants joining and leaving, connecting and disconnecting, are
+			reflected in what a room is published to
+		'''
+		alice, bob = self.connect('alice'), self.connect('bob')
+		self.control('room-join', conversation='c1', participants=['alice', 'carol'])
+		self.assertEquals(self.publish('c1'), 1)
+		carol = self.connect('carol')
+		self.control('room-join', conversation='c1', participants=['bob'])
+		self.assertEquals(self.publish('c1'), 3)
+
+		self.control('room-leave', conversation='c1', participants=['bob'])
+		alice.disconnect()
+		for client in (bob, carol): client.received()
+		self.assertEquals(self.publish('c1'), 1)
+		self.assertEquals((bob.received(), carol.received()), ([], [self.message]))
+
+		self.control('room-delete', conversation='c1')
+		self.assertEquals((self.publish('c1'), len(self.factory.rooms)), (0, 0))
+		self.assertEquals(self.factory.rooms.rooms_of, {})
+
+	def testLoadRooms(self):
+		'''	The relay loads the rooms from Django with its token, retrying until
+			Django answers
+		'''
+		answers = [defer.fail(ConnectionRefusedError()),
+			defer.succeed({ 'rooms' : { 'c1' : ['alice'] } })]
+		requested = []
+		def getJSON(url, params={}, token='', clock=None):
+			requested.append((url, token))
+			return answers.pop(0)
+		self.patch(messageserver, 'getJSON', getJSON)
+		self.patch(messageserver, 'reactor', self.clock)
+
+		alice = self.connect('alice')
+		self.factory.loadRooms()
+		self.assertEquals(len(self.factory.rooms), 0)
+		self.clock.advance(self.factory.rooms_retry)
+		self.assertEquals(requested, [(self.settings['rooms_url'], 'secret')] * 2)
+		self.assertEquals(self.publish('c1'), 1)
@@ -0,0 +1,195 @@
+from twisted.internet import defer
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from messagerelay import presence
+from messagerelay.presence import Presence
+from messagerelay.registry import ConnectionRegistry
+
+
+class Connection(object):
+	def __init__(self, displayname=''):
+		self.ipaddr = '127.0.0.1'
+		self.displayname = displayname
+
+
+class Factory(object):
+	'''	Stand-in for MessengerConnectionFactory, recording the presence messages
+		it is asked to push
+	'''
+
+	def __init__(self):
+		self.registry = ConnectionRegistry()
+		self.userdata = self.registry.userdata
+		self.pushed = []
+
+	def activeUsers(self):
+		return self.userdata.values()
+
+	def pushPresence(self, recipients, mdata, snapshot):
+		self.pushed.append((sorted(recipients), mdata))
+
+
+class PresenceCase(TestCase):
+	'''	Presence of users connecting to a stand-in factory, pushed once per second
+	'''
+	settings = { 'presence_interval' : 1, 'presence_log_size' : 4 }
+
+	def setUp(self):
+		self.clock = Clock()
+		self.factory = Factory()
+		self.presence = Presence(self.factory, self.settings, clock=self.clock)
+		self.addCleanup(self.presence.stop)
+		self.connections = {}
+
+	def connect(self, username):
+		connection = self.connections[username] = Connection(username.title())
+		if self.factory.registry.add(username, connection):
+			self.presence.join(self.factory.userdata[username])
+
+	def disconnect(self, username):
+		if self.factory.registry.remove(self.connections.pop(username)):
+			self.presence.leave(username)
+
+
+class PresenceTests(PresenceCase):
+	'''	Versioned presence, pushed as deltas
+	'''
+
+	def testCoalesced(self):
+		'''	Changes within an interval are pushed together, once, to every user
+		'''
+		self.connect('alice')
+		self.connect('bob')
+		self.assertEquals(self.factory.pushed, [])
+		self.clock.advance(1)
+		self.assertEquals(self.factory.pushed, [(['alice', 'bob'], {
+			'opcode' : 'user-presence', 'since' : 0, 'version' : 2,
+			'changes' : [
+				{'opcode' : 'user-join', 'user' : {'id' : 'alice', 'displayname' : 'Alice'}},
+				{'opcode' : 'user-join', 'user' : {'id' : 'bob', 'displayname' : 'Bob'}}]})])
+		self.clock.advance(5)
+		self.assertEquals(len(self.factory.pushed), 1)
+
+	def testFinalState(self):
+		'''	A user who joins and leaves within an interval is left out, and a user
+			who leaves and comes back is only reported once
+		'''
+		self.connect('alice')
+		self.clock.advance(1)
+		self.disconnect('alice')
+		self.connect('alice')
+		self.connect('bob')
+		self.disconnect('bob')
+		self.clock.advance(1)
+		self.assertEquals(len(self.factory.pushed), 1)
+		self.assertEquals(self.presence.delta(1), [])
+
+	def testSince(self):
+		'''	Clients catch up from a version they know, or get a snapshot when it is
+			unknown or older than the change log
+		'''
+		for username in ('alice', 'bob', 'carol'): self.connect(username)
+		self.disconnect('bob')
+		since = self.presence.since(2)
+		self.assertEquals((since['opcode'], since['since'], since['version']),
+			('user-presence', 2, 4))
+		self.assertEquals([(change['opcode'], change['user']['id']) for change in since['changes']],
+			[('user-join', 'carol'), ('user-leave', 'bob')])
+		self.assertEquals(self.presence.since(4)['changes'], [])
+
+		for version in (None, 'x', 5):
+			snapshot = self.presence.since(version)
+			self.assertEquals(snapshot['opcode'], 'user-activelist')
+			self.assertEquals(sorted(user['id'] for user in snapshot['users']), ['alice', 'carol'])
+
+		for username in ('dave', 'erin'): self.connect(username)
+		self.assertEquals(self.presence.since(1)['opcode'], 'user-activelist')
+		self.assertEquals(self.presence.since(2)['opcode'], 'user-presence')
+
+	def testLogOverflow(self):
+		'''	When more changes happen within an interval than the log keeps, everyone
+			is pushed a snapshot
+		'''
+		for username in ('alice', 'bob', 'carol', 'dave', 'erin'): self.connect(username)
+		self.clock.advance(1)
+		[(recipients, mdata)] = self.factory.pushed
+		self.assertEquals(mdata['opcode'], 'user-activelist')
+		self.assertEquals(len(mdata['users']), 5)
+
+
+class ScopedPresenceTests(PresenceCase):
+	'''	Presence scoped to contacts, fetched from a stand-in for Django
+	'''
+	settings = { 'presence_interval' : 1, 'presence_log_size' : 4,
+		'contacts_url' : 'http://django/api/presence/contacts/' }
+	contacts = {
+		'alice' : ['bob', 'carol'],
+		'bob' : ['alice'],
+		'carol' : ['alice'],
+		'dave' : [],
+		'erin' : [],
+	}
+
+	def setUp(self):
+		self.patch(presence, 'getJSON', self.getJSON)
+		PresenceCase.setUp(self)
+
+	def getJSON(self, url, params={}, token='', clock=None):
+		return defer.succeed({ 'contacts' : self.contacts[params['user']] })
+
+	def pushedTo(self, username):
+		return [mdata for recipients, mdata in self.factory.pushed if username in recipients]
+
+	def testScoped(self):
+		'''	Each user is sent a snapshot of their contacts when they connect, then
+			only hears about their contacts
+		'''
+		self.connect('alice')
+		self.connect('dave')
+		self.assertEquals(self.factory.pushed, [
+			(['alice'], {'opcode' : 'user-activelist', 'version' : 1, 'users' : []}),
+			(['dave'], {'opcode' : 'user-activelist', 'version' : 2, 'users' : []})])
+		self.connect('bob')
+		del self.factory.pushed[:]
+		self.clock.advance(1)
+		self.assertEquals(sorted(self.factory.pushed), [
+			(['alice'], {'opcode' : 'user-presence', 'since' : 0, 'version' : 3,
+				'changes' : [{'opcode' : 'user-join', 'user' : {'id' : 'bob', 'displayname' : 'Bob'}}]}),
+			(['bob'], {'opcode' : 'user-presence', 'since' : 0, 'version' : 3,
+				'changes' : [{'opcode' : 'user-join', 'user' : {'id' : 'alice', 'displayname' : 'Alice'}}]})])
+		self.assertEquals(self.pushedTo('dave'), [])
+
+	def testScopedSince(self):
+		'''	Catching up and snapshots only cover the user's contacts
+		'''
+		for username in ('alice', 'bob', 'dave'): self.connect(username)
+		self.assertEquals([user['id'] for user in self.presence.snapshot('bob')['users']],
+			['alice'])
+		self.assertEquals([change['user']['id'] for change in self.presence.since(0, 'alice')['changes']],
+			['bob'])
+		self.assertEquals(self.presence.since(0, 'dave')['changes'], [])
+
+	def testUpdateContacts(self):
+		'''	Contacts changed by Django bring users into and out of view
+		'''
+		for username in ('alice', 'bob', 'dave'): self.connect(username)
+		del self.factory.pushed[:]
+		self.presence.updateContacts({ 'dave' : ['alice'], 'alice' : ['carol', 'dave'] })
+		self.assertEquals(sorted(self.factory.pushed), [
+			(['alice'], {'opcode' : 'user-presence', 'since' : 3, 'version' : 3,
+				'changes' : [{'opcode' : 'user-join', 'user' : {'id' : 'dave', 'displayname' : 'Dave'}},
+					{'opcode' : 'user-leave', 'user' : {'id' : 'bob'}}]}),
+			(['dave'], {'opcode' : 'user-presence', 'since' : 3, 'version' : 3,
+				'changes' : [{'opcode' : 'user-join', 'user' : {'id' : 'alice', 'displayname' : 'Alice'}}]})])
+		self.assertEquals(self.presence.watchers['alice'], set(['bob', 'dave']))
+		self.assertNotIn('bob', self.presence.watchers)
+
+	def testLeave(self):
+		'''	Users who disconnect stop watching their contacts
+		'''
+		self.connect('alice')
+		self.connect('bob')
+		self.disconnect('alice')
+		self.assertNotIn('alice', self.presence.contacts)
+		self.assertEquals(self.presence.watchers, {'alice' : set(['bob'])})
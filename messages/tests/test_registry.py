@@ -0,0 +1,71 @@
+from twisted.trial.unittest import TestCase
+
+from messagerelay.registry import ConnectionRegistry
+
+
+class Connection(object):
+	def __init__(self, ipaddr='10.0.0.1', displayname=''):
+		self.ipaddr = ipaddr
+		self.displayname = displayname
+
+
+class ConnectionRegistryTests(TestCase):
+	'''	Indexes of the registry as connections come and go
+	'''
+
+	def setUp(self):
+		self.registry = ConnectionRegistry()
+
+	def testFirstAndLast(self):
+		'''	Adding tells whether a connection is its user's first, and removing
+			whether it was the last
+		'''
+		first, second = Connection(displayname='Alice'), Connection('10.0.0.2')
+		self.assertTrue(self.registry.add('alice', first))
+		self.assertFalse(self.registry.add('alice', second))
+		self.assertEquals(set(self.registry.connectionsOf('alice')), set((first, second)))
+		self.assertEquals(self.registry.userdata['alice'], {'id' : 'alice', 'displayname' : 'Alice'})
+		self.assertEquals(len(self.registry), 2)
+
+		self.assertFalse(self.registry.remove(first))
+		self.assertTrue(self.registry.connected('alice'))
+		self.assertTrue(self.registry.remove(second))
+		self.assertFalse(self.registry.connected('alice'))
+		self.assertEquals((self.registry.by_user, self.registry.by_ip, self.registry.users,
+			self.registry.userdata), ({}, {}, {}, {}))
+
+	def testAddresses(self):
+		'''	Connections are indexed by address, and addresses without connections
+			are dropped
+		'''
+		first, second, other = Connection(), Connection(), Connection('10.0.0.2')
+		self.registry.add('alice', first)
+		self.registry.add('bob', second)
+		self.registry.add('bob', other)
+		self.assertEquals(set(self.registry.connectionsFrom('10.0.0.1')), set((first, second)))
+		self.registry.remove(other)
+		self.assertEquals(self.registry.connectionsFrom('10.0.0.2'), ())
+		self.assertNotIn('10.0.0.2', self.registry.by_ip)
+
+	def testReidentify(self):
+		'''	A connection identifying as another user moves to that user, and
+			identifying as the same user again changes nothing
+		'''
+		connection = Connection()
+		self.registry.add('alice', connection)
+		self.assertFalse(self.registry.add('alice', connection))
+		self.assertTrue(self.registry.add('bob', connection))
+		self.assertEquals(self.registry.user(connection), 'bob')
+		self.assertFalse(self.registry.connected('alice'))
+		self.assertEquals(list(self.registry.connectionsOf('bob')), [connection])
+		self.assertEquals(len(self.registry), 1)
+
+	def testUnknown(self):
+		'''	Unregistered connections and users are looked up without errors
+		'''
+		connection = Connection()
+		self.assertFalse(self.registry.remove(connection))
+		self.assertNotIn(connection, self.registry)
+		self.assertEquals(self.registry.user(connection), None)
+		self.assertEquals(self.registry.connectionsOf('nobody'), ())
+		self.assertEquals(list(self.registry.connections()), [])
@@ -0,0 +1,648 @@
+"""
+Tests for L{websockets}.
+"""
+
+from base64 import b64encode
+from struct import pack
+import zlib
+
+from twisted.internet.protocol import Factory, Protocol
+from twisted.internet.task import Clock
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial.unittest import TestCase
+
+from websockets import (_CONTROLS, _DEFLATE_TAIL, _FrameParser, _WSException,
+                        _WSMessageTooBig, _MASK_WIDE_MINIMUM, _makeFrame,
+                        _mask, _parseFrames, PerMessageDeflateOptions,
+                        PreparedFrame, WebSocketsResource)
+
+
+
+def _clientFrame(payload, opcode=0x1, fin=True, key="\x01\x02\x03\x04",
+                 flags=0):
+    """
+    Make a frame the way a client sends it: masked, with the smallest length
+    encoding.
+    """
+    length = len(payload)
+    if length > 0xffff:
+        header = "\xff%s" % pack(">Q", length)
+    elif length > 0x7d:
+        header = "\xfe%s" % pack(">H", length)
+    else:
+        header = chr(0x80 | length)
+    first = (0x80 if fin else 0) | flags | opcode
+    return chr(first) + header + key + _mask(payload, key)
+
+
+
+def _bytes(frames):
+    """
+    Turn the payloads handed out by a parser into strings.
+    """
+    return [(opcode, payload if opcode == _CONTROLS.CLOSE else
+             payload.tobytes()) for opcode, payload in frames]
+
+
+
+class MaskTests(TestCase):
+    """
+    Tests for L{_mask}.
+    """
+
+    def _naiveMask(self, buf, key):
+        return "".join(chr(ord(c) ^ ord(key[i % 4])) for i, c in enumerate(buf))
+
+
+    def testLengths(self):
+        """
+        Buffers of every length, on both sides of the byte by byte cut-off,
+        are masked like XORing every byte with its key byte.
+        """
+        key = "\x9a\x00\xff\x3c"
+        data = "".join(chr(i) for i in range(256)) * 2
+        for length in range(0, _MASK_WIDE_MINIMUM * 4 + 3):
+            self.assertEqual(_mask(data[:length], key),
+                             self._naiveMask(data[:length], key))
+
+
+    def testRoundTrip(self):
+        """
+        Masking twice with the same key gives back the original buffer.
+        """
+        data = "The quick brown fox jumps over the lazy dog" * 100
+        key = "\x12\x34\x56\x78"
+        self.assertEqual(_mask(_mask(data, key), key), data)
+
+
+    def testMemoryview(self):
+        """
+        A slice of a buffer can be masked without copying it first.
+        """
+        buf = bytearray("xxabcdefghijklmnopqrstuvwxyzxx")
+        key = "\x01\x02\x03\x04"
+        self.assertEqual(_mask(memoryview(buf)[2:-2], key),
+                         self._naiveMask("abcdefghijklmnopqrstuvwxyz", key))
+
+
+
+class FrameParserTests(TestCase):
+    """
+    Tests for L{_FrameParser}.
+    """
+
+    def testWholeFrame(self):
+        """
+        A frame received in one piece is unmasked and handed out.
+        """
+        parser = _FrameParser()
+        frames = parser.feed(_clientFrame("Hello, world!"))
+        self.assertEqual(_bytes(frames), [(_CONTROLS.NORMAL, "Hello, world!")])
+        self.assertEqual(parser.pending(), "")
+
+
+    def testSeveralFrames(self):
+        """
+        All the frames completed by one read are handed out in order, and the
+        start of the next one is kept.
+        """
+        data = (_clientFrame("one") + _clientFrame("two", opcode=0x2) +
+                _clientFrame("three"))
+        parser = _FrameParser()
+        frames = parser.feed(data[:-2])
+        self.assertEqual(_bytes(frames), [(_CONTROLS.NORMAL, "one"),
+                                          (_CONTROLS.BINARY, "two")])
+        self.assertEqual(parser.pending(), data[-11:-2])
+        self.assertEqual(_bytes(parser.feed(data[-2:])),
+                         [(_CONTROLS.NORMAL, "three")])
+
+
+    def testByteByByte(self):
+        """
+        A frame which arrives one byte at a time is only handed out once its
+        last byte arrives, whichever part of the header a read ends in.
+        """
+        for payload in ("x" * 5, "x" * 300, "x" * 70000):
+            data = _clientFrame(payload)
+            parser = _FrameParser()
+            for i, byte in enumerate(data[:-1]):
+                self.assertEqual(parser.feed(byte), [])
+            self.assertEqual(parser.pending(), data[:-1])
+            self.assertEqual(_bytes(parser.feed(data[-1])),
+                             [(_CONTROLS.NORMAL, payload)])
+
+
+    def testShortReads(self):
+        """
+        Reads ending inside the extended length or the masking key are
+        buffered until the header is complete.
+        """
+        data = _clientFrame("y" * 70000)
+        for cut in (1, 3, 9, 12):
+            parser = _FrameParser()
+            self.assertEqual(parser.feed(data[:cut]), [])
+            self.assertEqual(parser.feed(data[cut:20]), [])
+            self.assertEqual(_bytes(parser.feed(data[20:])),
+                             [(_CONTROLS.NORMAL, "y" * 70000)])
+
+
+    def test16BitLength(self):
+        """
+        Payloads of 126 to 65535 bytes have a 16 bit length.
+        """
+        for length in (0x7e, 300, 0xffff):
+            data = _clientFrame("a" * length)
+            self.assertEqual(data[1], "\xfe")
+            self.assertEqual(_parseFrames(data),
+                             ([(_CONTROLS.NORMAL, "a" * length)], ""))
+
+
+    def test64BitLength(self):
+        """
+        Payloads of more than 65535 bytes have a 64 bit length.
+        """
+        data = _clientFrame("b" * 0x10000)
+        self.assertEqual(data[1], "\xff")
+        self.assertEqual(_parseFrames(data),
+                         ([(_CONTROLS.NORMAL, "b" * 0x10000)], ""))
+
+
+    def testMakeFrameLengths(self):
+        """
+        L{_makeFrame} uses the smallest length encoding, and its frames parse
+        back to their payload.
+        """
+        for length, header in ((0x7d, "\x81\x7d"),
+                               (0x7e, "\x81\x7e\x00\x7e"),
+                               (0x10000, "\x81\x7f" + pack(">Q", 0x10000))):
+            frame = _makeFrame("c" * length)
+            self.assertEqual(frame[:len(header)], header)
+            self.assertEqual(_parseFrames(frame),
+                             ([(_CONTROLS.NORMAL, "c" * length)], ""))
+
+
+    def testHeldPayload(self):
+        """
+        A payload which is still being looked at stays valid while more data
+        is parsed.
+        """
+        parser = _FrameParser()
+        parser._compactThreshold = 1
+        [(opcode, first)] = parser.feed(_clientFrame("first"))
+        for i in range(3):
+            parser.feed(_clientFrame("next %d" % i))
+        self.assertEqual(first.tobytes(), "first")
+
+
+    def testOversizeFrame(self):
+        """
+        A frame larger than C{maxFrameSize} is rejected as soon as its header
+        arrives.
+        """
+        parser = _FrameParser(maxFrameSize=300)
+        self.assertEqual(_bytes(parser.feed(_clientFrame("d" * 300))),
+                         [(_CONTROLS.NORMAL, "d" * 300)])
+        error = self.assertRaises(_WSMessageTooBig, parser.feed,
+                                  _clientFrame("d" * 301)[:8])
+        self.assertEqual(error.code, 1009)
+
+
+    def testOversizeLength(self):
+        """
+        A 64 bit length beyond C{maxMessageSize} is rejected without waiting
+        for any of the payload.
+        """
+        parser = _FrameParser(maxMessageSize=1024)
+        self.assertRaises(_WSMessageTooBig, parser.feed,
+                          "\x81\xff" + pack(">Q", 2 ** 40) + "abcd")
+
+
+    def testUnknownOpcode(self):
+        """
+        Frames with an opcode RFC 6455 doesn't define are rejected.
+        """
+        error = self.assertRaises(_WSException, _FrameParser().feed,
+                                  _clientFrame("", opcode=0x3))
+        self.assertEqual(error.code, 1002)
+
+
+    def testReservedFlag(self):
+        """
+        Frames with a reserved flag set are rejected when no extension was
+        negotiated.
+        """
+        self.assertRaises(_WSException, _FrameParser().feed,
+                          _clientFrame("e", flags=0x40))
+
+
+
+class FragmentTests(TestCase):
+    """
+    Tests for the reassembly of fragmented messages by L{_FrameParser}.
+    """
+
+    def _fragments(self, payloads, opcode=0x1):
+        """
+        Frames carrying a message split into payloads.
+        """
+        frames = []
+        for i, payload in enumerate(payloads):
+            frames.append(_clientFrame(payload, opcode=opcode if i == 0 else 0,
+                                       fin=i == len(payloads) - 1))
+        return frames
+
+
+    def testReassembly(self):
+        """
+        A fragmented message is handed out whole once its final fragment
+        arrives, with the opcode of its first frame.
+        """
+        parser = _FrameParser()
+        first, middle, last = self._fragments(["frag", "ment", "ed"], 0x2)
+        self.assertEqual(parser.feed(first), [])
+        self.assertEqual(parser.feed(middle), [])
+        self.assertEqual(_bytes(parser.feed(last)),
+                         [(_CONTROLS.BINARY, "fragmented")])
+
+
+    def testInterleavedControlFrames(self):
+        """
+        Control frames between the fragments of a message are handed out
+        straight away, and don't disturb the message.
+        """
+        first, last = self._fragments(["Hello, ", "world"])
+        data = (first + _clientFrame("ping", opcode=0x9) + last +
+                _clientFrame("pong", opcode=0xa))
+        parser = _FrameParser()
+        frames = []
+        for i in range(0, len(data), 3):
+            frames.extend(parser.feed(data[i:i + 3]))
+        self.assertEqual(_bytes(frames), [(_CONTROLS.PING, "ping"),
+                                          (_CONTROLS.NORMAL, "Hello, world"),
+                                          (_CONTROLS.PONG, "pong")])
+
+
+    def testInterleavedClose(self):
+        """
+        A close frame between fragments is handed out with its code and
+        reason.
+        """
+        first, last = self._fragments(["a", "b"])
+        close = _clientFrame(pack(">H", 1001) + "going away", opcode=0x8)
+        self.assertEqual(_bytes(_FrameParser().feed(first + close)),
+                         [(_CONTROLS.CLOSE, (1001, "going away"))])
+
+
+    def testStreaming(self):
+        """
+        A streaming parser hands out every fragment as it arrives.
+        """
+        parser = _FrameParser(streaming=True)
+        frames = []
+        for frame in self._fragments(["one", "two", "three"]):
+            frames.extend(parser.feed(frame))
+        self.assertEqual(_bytes(frames), [(_CONTROLS.NORMAL, "one"),
+                                          (_CONTROLS.NORMAL, "two"),
+                                          (_CONTROLS.NORMAL, "three")])
+
+
+    def testMessageSizeOverFragments(self):
+        """
+        C{maxMessageSize} applies to the sum of the fragments of a message, and
+        is checked from the header of the fragment which goes over it.
+        """
+        parser = _FrameParser(maxMessageSize=10)
+        first, second = self._fragments(["x" * 6, "y" * 5])
+        parser.feed(first)
+        self.assertRaises(_WSMessageTooBig, parser.feed, second[:6])
+
+
+    def testFragmentedControlFrame(self):
+        """
+        Control frames must not be fragmented, or longer than 125 bytes.
+        """
+        self.assertRaises(_WSException, _FrameParser().feed,
+                          _clientFrame("ping", opcode=0x9, fin=False))
+        self.assertRaises(_WSException, _FrameParser().feed,
+                          _clientFrame("p" * 126, opcode=0x9))
+
+
+    def testOutOfSequence(self):
+        """
+        A continuation frame outside of a message, and a new message before the
+        final fragment of the last one, are rejected.
+        """
+        self.assertRaises(_WSException, _FrameParser().feed,
+                          _clientFrame("orphan", opcode=0x0))
+        first, last = self._fragments(["a", "b"])
+        self.assertRaises(_WSException, _FrameParser().feed,
+                          first + _clientFrame("new"))
+
+
+
+class PerMessageDeflateTests(TestCase):
+    """
+    Tests for L{PerMessageDeflateOptions} and L{_PerMessageDeflate}.
+    """
+
+    message = "{\"opcode\": \"message-create\", \"text\": \"hello again\"}" * 4
+
+
+    def _inflate(self, payloads, decompressor=None):
+        """
+        Inflate the payloads of consecutive messages the way a client does.
+        """
+        if decompressor is None:
+            decompressor = zlib.decompressobj(-15)
+        return [decompressor.decompress(payload + _DEFLATE_TAIL)
+                for payload in payloads]
+
+
+    def _clientCompress(self, messages):
+        """
+        Compress consecutive messages the way a client does, with context
+        takeover.
+        """
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        return [(compressor.compress(message) +
+                 compressor.flush(zlib.Z_SYNC_FLUSH))[:-4]
+                for message in messages]
+
+
+    def testNegotiate(self):
+        """
+        The first acceptable offer is accepted and counts as a live context,
+        and no offer is accepted once C{maxContexts} are live.
+        """
+        options = PerMessageDeflateOptions(maxContexts=1)
+        response, deflate = options.negotiate(
+            "x-webkit-deflate-frame, permessage-deflate; "
+            "client_max_window_bits; server_max_window_bits=10")
+        response = response.split("; ")
+        self.assertEqual(response[0], "permessage-deflate")
+        self.assertEqual(sorted(response[1:]), ["client_max_window_bits=15",
+                                                "server_max_window_bits=10"])
+        self.assertEqual(deflate.serverWindowBits, 10)
+        self.assertEqual(options.liveContexts, 1)
+        self.assertIdentical(options.negotiate("permessage-deflate"), None)
+        deflate.close()
+        self.assertEqual(options.liveContexts, 0)
+
+
+    def testDeclineUnknownParameters(self):
+        """
+        Offers with unknown parameters or impossible window sizes are declined.
+        """
+        options = PerMessageDeflateOptions()
+        self.assertIdentical(options.negotiate(
+            "permessage-deflate; unknown=1"), None)
+        self.assertIdentical(options.negotiate(
+            "permessage-deflate; server_max_window_bits=8"), None)
+        self.assertEqual(options.liveContexts, 0)
+
+
+    def testContextTakeover(self):
+        """
+        With context takeover, the compressor is kept across messages, so a
+        repeated message compresses to less the second time, and the client
+        needs its own context to inflate it.
+        """
+        response, deflate = PerMessageDeflateOptions().negotiate(
+            "permessage-deflate")
+        first, second = deflate.compress(self.message), deflate.compress(
+            self.message)
+        self.assertTrue(len(second) < len(first))
+        self.assertEqual(self._inflate([first, second]),
+                         [self.message, self.message])
+
+
+    def testNoContextTakeover(self):
+        """
+        Without context takeover, every message is compressed on its own, and
+        inflates with a fresh context.
+        """
+        response, deflate = PerMessageDeflateOptions().negotiate(
+            "permessage-deflate; server_no_context_takeover")
+        self.assertIn("server_no_context_takeover", response)
+        first, second = deflate.compress(self.message), deflate.compress(
+            self.message)
+        self.assertEqual(first, second)
+        self.assertEqual(self._inflate([second]), [self.message])
+
+
+    def testInflateWithTakeover(self):
+        """
+        Compressed messages from a client which keeps its context are inflated
+        with one context kept across messages, also when fragmented.
+        """
+        response, deflate = PerMessageDeflateOptions().negotiate(
+            "permessage-deflate")
+        parser = _FrameParser(deflate=deflate)
+        first, second = self._clientCompress([self.message, self.message])
+        frames = parser.feed(_clientFrame(first, flags=0x40))
+        frames += parser.feed(_clientFrame(second[:3], fin=False, flags=0x40))
+        frames += parser.feed(_clientFrame(second[3:], opcode=0x0))
+        self.assertEqual(_bytes(frames), [(_CONTROLS.NORMAL, self.message),
+                                          (_CONTROLS.NORMAL, self.message)])
+
+
+    def testInflatedSizeLimit(self):
+        """
+        A small compressed payload which inflates past C{maxMessageSize} is
+        rejected without inflating all of it.
+        """
+        response, deflate = PerMessageDeflateOptions().negotiate(
+            "permessage-deflate", maxMessageSize=1000)
+        [bomb] = self._clientCompress(["\x00" * 100000])
+        parser = _FrameParser(maxMessageSize=1000, deflate=deflate)
+        self.assertRaises(_WSMessageTooBig, parser.feed,
+                          _clientFrame(bomb, flags=0x40))
+
+
+
+class PreparedFrameTests(TestCase):
+    """
+    Tests for L{PreparedFrame}.
+    """
+
+    message = "{\"opcode\": \"message-create\", \"text\": \"hello again\"}" * 4
+
+
+    def _deflate(self, offer):
+        """
+        Negotiate permessage-deflate the way a connection does.
+        """
+        response, deflate = PerMessageDeflateOptions(minimumSize=64).negotiate(
+            offer)
+        return deflate
+
+
+    def testSharedFrame(self):
+        """
+        Connections using the same codec are handed the very same frame, built
+        once, in a binary frame for binary messages.
+        """
+        prepared = PreparedFrame(self.message)
+        frame = prepared.frameFor(None)
+        self.assertIdentical(prepared.frameFor(None), frame)
+        self.assertEqual(frame, _makeFrame(self.message))
+        self.assertEqual(prepared.frameFor("base64"),
+                         _makeFrame(b64encode(self.message)))
+        self.assertEqual(PreparedFrame(self.message, binary=True).frameFor(None),
+                         _makeFrame(self.message, _opcode=_CONTROLS.BINARY))
+
+
+    def testSharedCompression(self):
+        """
+        Connections compressing every message on its own with the same window
+        share one compressed frame, which inflates with a fresh context, while
+        another window gets a frame of its own. Messages too short to compress
+        share the uncompressed frame.
+        """
+        prepared = PreparedFrame(self.message)
+        offer = "permessage-deflate; server_no_context_takeover"
+        frame = prepared.frameFor(None, self._deflate(offer))
+        self.assertIdentical(prepared.frameFor(None, self._deflate(offer)), frame)
+        self.assertNotIdentical(
+            prepared.frameFor(None, self._deflate(
+                offer + "; server_max_window_bits=9")), frame)
+
+        [(opcode, payload)] = _FrameParser(
+            deflate=self._deflate("permessage-deflate")).feed(frame)
+        self.assertEqual(payload.tobytes(), self.message)
+
+        short = PreparedFrame("{}")
+        self.assertIdentical(short.frameFor(None, self._deflate(offer)),
+                             short.frameFor(None))
+
+
+    def testContextTakeover(self):
+        """
+        Connections keeping a compression context get a frame compressed with
+        their own context for every message, which is never shared.
+        """
+        prepared = PreparedFrame(self.message)
+        first, second = (self._deflate("permessage-deflate"),
+                         self._deflate("permessage-deflate"))
+        again = prepared.frameFor(None, first)
+        self.assertEqual(prepared.frameFor(None, second), again)
+        self.assertTrue(len(prepared.frameFor(None, first)) < len(again))
+        self.assertEqual(prepared._frames, {})
+
+
+
+class _RecordingTransport(StringTransport):
+    """
+    A transport which remembers each write made to it.
+    """
+
+    def __init__(self):
+        StringTransport.__init__(self)
+        self.writes = []
+
+
+    def write(self, data):
+        self.writes.append([data])
+        StringTransport.write(self, data)
+
+
+    def writeSequence(self, seq):
+        self.writes.append(list(seq))
+        StringTransport.write(self, "".join(seq))
+
+
+
+class CoalescingTests(TestCase):
+    """
+    Tests for the coalescing of outgoing frames by L{_WebSocketsProtocol}.
+    """
+
+    def _connect(self, coalesceDelay=0, coalesceBytes=1024):
+        """
+        Connect a protocol through a resource which coalesces its frames,
+        driven by a fake clock.
+        """
+        self.clock = Clock()
+        self.resource = WebSocketsResource(
+            Factory.forProtocol(Protocol), coalesceDelay=coalesceDelay,
+            coalesceBytes=coalesceBytes)
+        self.resource._factory.reactor = self.clock
+        protocol = self.resource._factory.buildProtocol(None)
+        self.transport = _RecordingTransport()
+        protocol.makeConnection(self.transport)
+        return protocol
+
+
+    def _frames(self):
+        """
+        Parse everything written to the transport.
+        """
+        frames, pending = _parseFrames(self.transport.value())
+        self.assertEqual(pending, "")
+        return frames
+
+
+    def testOneWritePerTurn(self):
+        """
+        Frames written within one reactor turn reach the transport in a single
+        write once the turn is over, in the order they were written, and the
+        saved write is counted.
+        """
+        protocol = self._connect()
+        protocol.write("first")
+        protocol.writePrepared(PreparedFrame("second"))
+        protocol.ping("third")
+        self.assertEqual(self.transport.writes, [])
+        self.clock.advance(0)
+        self.assertEqual(len(self.transport.writes), 1)
+        self.assertEqual(self._frames(), [(_CONTROLS.NORMAL, "first"),
+                                          (_CONTROLS.NORMAL, "second"),
+                                          (_CONTROLS.PING, "third")])
+        self.assertEqual(self.resource.writeStats(),
+                         {"frames": 3, "writes": 1, "saved": 2})
+
+        protocol.write("fourth")
+        self.clock.advance(0)
+        self.assertEqual(len(self.transport.writes), 2)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def testByteLimit(self):
+        """
+        Frames are written without waiting for the turn to end once
+        C{coalesceBytes} of them are queued.
+        """
+        protocol = self._connect(coalesceBytes=100)
+        protocol.write("x" * 60)
+        self.assertEqual(self.transport.writes, [])
+        protocol.write("y" * 60)
+        self.assertEqual(len(self.transport.writes), 1)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertEqual(self._frames(), [(_CONTROLS.NORMAL, "x" * 60),
+                                          (_CONTROLS.NORMAL, "y" * 60)])
+
+
+    def testCloseFlushes(self):
+        """
+        Frames queued when the connection is closed go out before the closing
+        frame.
+        """
+        protocol = self._connect(coalesceDelay=1)
+        protocol.write("last words")
+        protocol.loseConnection()
+        self.assertEqual(self._frames(), [(_CONTROLS.NORMAL, "last words"),
+                                          (_CONTROLS.CLOSE, (1000, "No reason given"))])
+        self.assertTrue(self.transport.disconnecting)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def testNoCoalescing(self):
+        """
+        Without a C{coalesceDelay} every frame is written straight away.
+        """
+        protocol = self._connect(coalesceDelay=None)
+        protocol.write("first")
+        protocol.write("second")
+        self.assertEqual(len(self.transport.writes), 2)
+        self.assertEqual(self.resource.writeStats(),
+                         {"frames": 2, "writes": 2, "saved": 0})
@@ -1,4 +1,4 @@
-# -*- test-case-name: twisted.web.test.test_websockets -*-
+# -*- test-case-name: tests.test_websockets -*-
 # Copyright (c) Twisted Matrix Laboratories.
 #               2011-2012 Oregon State University Open Source Lab
 #               2011-2012 Corbin Simpson
@@ -10,11 +10,12 @@ The WebSockets protocol (RFC 6455), provided as a resource which wraps a
 factory.
 """
 
-__all__ = ["WebSocketsResource"]
+__all__ = ["WebSocketsResource", "PreparedFrame", "PerMessageDeflateOptions"]
 
 from base64 import b64encode, b64decode
 from hashlib import sha1
 from struct import pack, unpack
+import zlib
 
 from zope.interface import implementer
 
@@ -29,7 +30,18 @@ from twisted.web.server import NOT_DONE_YET
 class _WSException(Exception):
     """
     Internal exception for control flow inside the WebSockets frame parser.
+
+    @ivar code: The status code to close the connection with.
     """
+    code = 1002
+
+
+
+class _WSMessageTooBig(_WSException):
+    """
+    A frame or message is larger than the parser is willing to buffer.
+    """
+    code = 1009
 
 
 
@@ -42,15 +54,17 @@ class _CONTROLS(Names):
     """
 
     NORMAL = NamedConstant()
+    BINARY = NamedConstant()
+    CONTINUATION = NamedConstant()
     CLOSE = NamedConstant()
     PING = NamedConstant()
     PONG = NamedConstant()
 
 
 _opcodeTypes = {
-    0x0: _CONTROLS.NORMAL,
+    0x0: _CONTROLS.CONTINUATION,
     0x1: _CONTROLS.NORMAL,
-    0x2: _CONTROLS.NORMAL,
+    0x2: _CONTROLS.BINARY,
     0x8: _CONTROLS.CLOSE,
     0x9: _CONTROLS.PING,
     0xa: _CONTROLS.PONG}
@@ -58,6 +72,7 @@ _opcodeTypes = {
 
 _opcodeForType = {
     _CONTROLS.NORMAL: 0x1,
+    _CONTROLS.BINARY: 0x2,
     _CONTROLS.CLOSE: 0x8,
     _CONTROLS.PING: 0x9,
     _CONTROLS.PONG: 0xa}
@@ -77,6 +92,12 @@ _protocol_headers = {
     "binary, base64" : "base64",
 }
 
+# The largest incoming message accepted by default, in bytes.
+_MAX_MESSAGE_SIZE = 16 * 1024 * 1024
+
+# How many bytes of coalesced frames may wait for a flush by default.
+_COALESCE_BYTES = 64 * 1024
+
 # Authentication for WS.
 
 # The GUID for WebSockets, from RFC 6455.
@@ -104,12 +125,23 @@ def _makeAccept(key):
 # Separated out to make unit testing a lot easier.
 # Frames are bonghits in newer WS versions, so helpers are appreciated.
 
+# Buffers shorter than this are masked byte by byte; below it, the slicing
+# done by the translation tables costs more than the loop.
+_MASK_WIDE_MINIMUM = 16
+
+# Translation tables XORing every byte with a constant, one per key byte.
+_maskTables = ["".join(chr(i ^ k) for i in xrange(256)) for k in xrange(256)]
+
 
 
 def _mask(buf, key):
     """
     Mask or unmask a buffer of bytes with a masking key.
 
+    Every fourth byte is masked with the same key byte, so anything but the
+    tiniest buffers is masked as four strided slices, each run through a
+    translation table in one go.
+
     @type buf: C{str}
     @param buf: A buffer of bytes.
 
@@ -119,17 +151,22 @@ def _mask(buf, key):
     @rtype: C{str}
     @return: A masked buffer of bytes.
     """
+    buf = bytearray(buf)
+    key = bytearray(key)
 
-    # This is super-secure, I promise~
-    key = [ord(i) for i in key]
-    buf = list(buf)
-    for i, char in enumerate(buf):
-        buf[i] = chr(ord(char) ^ key[i % 4])
-    return "".join(buf)
+    if len(buf) < _MASK_WIDE_MINIMUM:
+        # This is super-secure, I promise~
+        for i in xrange(len(buf)):
+            buf[i] ^= key[i & 3]
+    else:
+        for i in xrange(4):
+            buf[i::4] = buf[i::4].translate(_maskTables[key[i]])
+
+    return str(buf)
 
 
 
-def _makeFrame(buf, _opcode=_CONTROLS.NORMAL):
+def _makeFrame(buf, _opcode=_CONTROLS.NORMAL, _compressed=False):
     """
     Make a frame.
 
@@ -142,6 +179,10 @@ def _makeFrame(buf, _opcode=_CONTROLS.NORMAL):
     @type _opcode: C{_CONTROLS}
     @param _opcode: Which type of frame to create.
 
+    @type _compressed: C{bool}
+    @param _compressed: Whether the buffer was compressed with
+        permessage-deflate, which is flagged with the first reserved bit.
+
     @rtype: C{str}
     @return: A packed frame.
     """
@@ -155,36 +196,436 @@ def _makeFrame(buf, _opcode=_CONTROLS.NORMAL):
         length = chr(bufferLength)
 
     # Always make a normal packet.
-    header = chr(0x80 | _opcodeForType[_opcode])
-    frame = "%s%s%s" % (header, length, buf)
+    header = 0x80 | _opcodeForType[_opcode]
+    if _compressed:
+        header |= 0x40
+    frame = "%s%s%s" % (chr(header), length, buf)
     return frame
 
 
 
-def _parseFrames(buf):
+# Compression extension helpers.
+
+# The name of the permessage-deflate extension, from RFC 7692.
+_DEFLATE_EXTENSION = "permessage-deflate"
+
+# 7.2.1 Every compressed message ends with an empty stored block, which is
+# stripped off before sending and appended again before inflating.
+_DEFLATE_TAIL = "\x00\x00\xff\xff"
+
+
+
+def _parseExtensions(header):
     """
-    Parse frames in a highly compliant manner.
+    Parse a C{Sec-WebSocket-Extensions} header.
 
-    @type buf: C{str}
-    @param buf: A buffer of bytes.
+    @type header: C{str}
+    @param header: The header value.
 
     @rtype: C{list}
-    @return: A list of frames.
+    @return: A list of C{(name, params)} offers, in order of preference.
+        Parameters without a value map to C{None}.
     """
-    start = 0
-    frames = []
+    offers = []
+    for offer in header.split(","):
+        parts = [part.strip() for part in offer.split(";")]
+        if not parts[0]:
+            continue
+        params = {}
+        for part in parts[1:]:
+            if not part:
+                continue
+            name, sep, value = part.partition("=")
+            params[name.strip()] = value.strip().strip('"') if sep else None
+        offers.append((parts[0], params))
+    return offers
+
+
+
+class PerMessageDeflateOptions(object):
+    """
+    Server settings for the permessage-deflate extension (RFC 7692).
+
+    An instance is shared by all connections of a L{WebSocketsResource}, and
+    keeps count of the connections which hold compression contexts. Once
+    C{maxContexts} is reached, new connections are served uncompressed until
+    others go away.
+
+    @ivar level: The zlib compression level.
+    @ivar memLevel: The zlib memory level of compression contexts.
+    @ivar serverMaxWindowBits: The largest LZ77 window used to compress.
+    @ivar clientMaxWindowBits: The largest LZ77 window requested of clients
+        which support the limit.
+    @ivar serverNoContextTakeover: Whether to compress every message on its
+        own, even if the client doesn't ask for it. This trades compression
+        ratio for memory, and lets a broadcast be compressed only once.
+    @ivar minimumSize: Messages shorter than this are not compressed.
+    @ivar maxContexts: The most connections which may use compression at the
+        same time, or C{None} for no limit.
+    """
+
+    def __init__(self, level=6, memLevel=8, serverMaxWindowBits=15,
+                 clientMaxWindowBits=15, serverNoContextTakeover=False,
+                 minimumSize=128, maxContexts=None):
+        self.level = level
+        self.memLevel = memLevel
+        self.serverMaxWindowBits = serverMaxWindowBits
+        self.clientMaxWindowBits = clientMaxWindowBits
+        self.serverNoContextTakeover = serverNoContextTakeover
+        self.minimumSize = minimumSize
+        self.maxContexts = maxContexts
+        self.liveContexts = 0
+
+
+    def negotiate(self, header, maxMessageSize=None):
+        """
+        Accept the first acceptable permessage-deflate offer in a
+        C{Sec-WebSocket-Extensions} header.
+
+        @type header: C{str}
+        @param header: The header sent by the client.
+
+        @param maxMessageSize: The largest message the connection accepts once
+            inflated, or C{None}.
+
+        @rtype: C{tuple} or C{None}
+        @return: The header to respond with and a L{_PerMessageDeflate} for
+            the connection, or C{None} if no offer was acceptable or there is
+            no room for another compression context.
+        """
+        if self.maxContexts is not None and (
+                self.liveContexts >= self.maxContexts):
+            return None
+
+        for name, params in _parseExtensions(header):
+            if name != _DEFLATE_EXTENSION:
+                continue
+            accepted = self._accept(params)
+            if accepted is None:
+                continue
+            response, serverWindowBits, clientWindowBits, noTakeover = accepted
+
+            self.liveContexts += 1
+            deflate = _PerMessageDeflate(self, serverWindowBits,
+                                         clientWindowBits, noTakeover,
+                                         maxMessageSize)
+            return "; ".join(response), deflate
+
+        return None
+
+
+    def _accept(self, params):
+        """
+        Work out the response to a single permessage-deflate offer.
+
+        @rtype: C{tuple} or C{None}
+        @return: The response parameters, the window sizes of our compressor
+            and of the client's, and whether we reset our compressor after
+            every message; or C{None} to decline the offer.
+        """
+        response = [_DEFLATE_EXTENSION]
+        serverWindowBits = self.serverMaxWindowBits
+        clientWindowBits = 15
+        noTakeover = self.serverNoContextTakeover
+
+        for key, value in params.iteritems():
+            if key == "server_no_context_takeover" and value is None:
+                noTakeover = True
+            elif key == "client_no_context_takeover" and value is None:
+                # The client resets its own context; nothing for us to do.
+                pass
+            elif key == "server_max_window_bits":
+                if not value or not value.isdigit():
+                    return None
+                # zlib can't produce raw deflate streams with an 8 bit window.
+                if not 9 <= int(value) <= 15:
+                    return None
+                serverWindowBits = min(serverWindowBits, int(value))
+                response.append("server_max_window_bits=%d" % serverWindowBits)
+            elif key == "client_max_window_bits":
+                if value is not None:
+                    if not value.isdigit() or not 8 <= int(value) <= 15:
+                        return None
+                    clientWindowBits = int(value)
+                clientWindowBits = min(clientWindowBits,
+                                       self.clientMaxWindowBits)
+                response.append("client_max_window_bits=%d" % clientWindowBits)
+            else:
+                # 7.1 Unknown parameters make the offer unacceptable.
+                return None
+
+        if noTakeover:
+            response.append("server_no_context_takeover")
+
+        # The inflater must be at least as large as the client's window, and
+        # zlib rounds 8 bit windows up to 9 anyway.
+        return response, serverWindowBits, max(clientWindowBits, 9), noTakeover
+
+
+
+class _PerMessageDeflate(object):
+    """
+    The permessage-deflate extension, as negotiated for one connection.
+
+    The zlib contexts are created on first use and then reused across
+    messages, unless context takeover was turned off for our side.
+
+    @ivar noContextTakeover: Whether every outgoing message is compressed on
+        its own.
+    """
+
+    def __init__(self, options, serverWindowBits, clientWindowBits,
+                 noContextTakeover, maxMessageSize=None):
+        self._options = options
+        self.serverWindowBits = serverWindowBits
+        self.clientWindowBits = clientWindowBits
+        self.noContextTakeover = noContextTakeover
+        self.maxMessageSize = maxMessageSize
+        self._compressor = None
+        self._decompressor = None
+        # Bytes inflated so far of the message in progress.
+        self._inflated = 0
+
+
+    def shouldCompress(self, data):
+        """
+        Decide whether an outgoing message is worth compressing.
+        """
+        return len(data) >= self._options.minimumSize
+
+
+    def compress(self, data):
+        """
+        Compress an outgoing message.
+
+        @type data: C{str}
+        @param data: The message.
+
+        @rtype: C{str}
+        @return: The compressed payload, without its trailing empty block.
+        """
+        if self._compressor is None:
+            self._compressor = zlib.compressobj(
+                self._options.level, zlib.DEFLATED, -self.serverWindowBits,
+                self._options.memLevel)
+        payload = self._compressor.compress(data)
+        payload += self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        if self.noContextTakeover:
+            self._compressor = None
+        return payload[:-len(_DEFLATE_TAIL)]
+
+
+    def decompress(self, payload, fin):
+        """
+        Inflate (part of) an incoming compressed message.
+
+        @type payload: C{str} or C{memoryview}
+        @param payload: A compressed message, or a fragment of one.
+
+        @type fin: C{bool}
+        @param fin: Whether this is the end of the message.
+
+        @rtype: C{str}
+        @return: The inflated data.
+        """
+        if self._decompressor is None:
+            self._decompressor = zlib.decompressobj(-self.clientWindowBits)
+        if isinstance(payload, memoryview):
+            payload = payload.tobytes()
+        if fin:
+            payload += _DEFLATE_TAIL
+
+        # Never inflate more than the message size limit allows, so that a
+        # small payload can't blow up in our face.
+        limit = 0
+        if self.maxMessageSize is not None:
+            limit = self.maxMessageSize - self._inflated + 1
+        data = self._decompressor.decompress(payload, limit)
+        self._inflated += len(data)
+        if self._decompressor.unconsumed_tail or (
+                self.maxMessageSize is not None and
+                self._inflated > self.maxMessageSize):
+            raise _WSMessageTooBig("Message is too big once inflated")
+
+        if fin:
+            self._inflated = 0
+        return data
+
+
+    def close(self):
+        """
+        Release the compression contexts of the connection.
+        """
+        self._compressor = self._decompressor = None
+        self._options.liveContexts -= 1
+
+
+
+class PreparedFrame(object):
+    """
+    A message which is framed once and written to many connections.
+
+    The frame is built lazily for each codec in use among the receiving
+    connections, and the same immutable string is handed to every transport.
+    Connections which compress every message on its own share a compressed
+    frame; those keeping a compression context compress for themselves.
+
+    @ivar data: The unframed message.
+    @type data: C{str}
+
+    @ivar binary: Whether the message goes out in a binary frame.
+    @type binary: C{bool}
+    """
+
+    def __init__(self, data, binary=False):
+        self.data = data
+        self.binary = binary
+        self._frames = {}
+
+
+    def frameFor(self, codec, deflate=None):
+        """
+        Return the frame for connections using the given codec.
+
+        @type codec: C{str} or C{None}
+        @param codec: The codec negotiated by the connection.
+
+        @type deflate: L{_PerMessageDeflate} or C{None}
+        @param deflate: The compression extension of the connection, if any.
+
+        @rtype: C{str}
+        @return: A packed frame.
+        """
+        opcode = _CONTROLS.BINARY if self.binary else _CONTROLS.NORMAL
+        key = codec
+        if deflate is not None and deflate.shouldCompress(self.data):
+            if not deflate.noContextTakeover:
+                return _makeFrame(deflate.compress(self._encode(codec)),
+                                  _opcode=opcode, _compressed=True)
+            key = codec, deflate.serverWindowBits
+
+        try:
+            return self._frames[key]
+        except KeyError:
+            data = self._encode(codec)
+            if key is codec:
+                frame = _makeFrame(data, _opcode=opcode)
+            else:
+                frame = _makeFrame(deflate.compress(data), _opcode=opcode,
+                                   _compressed=True)
+            self._frames[key] = frame
+            return frame
+
+
+    def _encode(self, codec):
+        """
+        Encode the message with a codec.
+        """
+        if codec:
+            return _encoders[codec](self.data)
+        return self.data
+
+
+
+class _FrameParser(object):
+    """
+    Incremental parser for WebSockets frames.
+
+    Incoming data is appended to a single growable buffer, and a read offset
+    marks the start of the first frame which has not been handed out yet.
+    Once a frame header is complete it is remembered, so that a large payload
+    arriving in many segments only costs a length check per segment instead of
+    a re-parse (and a copy) of everything buffered so far.
+
+    Payloads are handed out as C{memoryview} slices of the buffer. A caller
+    which holds on to one keeps the buffer from being resized, in which case
+    the parser moves its unconsumed bytes to a fresh buffer and leaves the old
+    one to the views.
+
+    Fragmented messages are reassembled and handed out once their final
+    fragment arrives, unless the parser is streaming, in which case every
+    fragment is handed out as soon as it is complete. Size limits are checked
+    against the header, before any of an oversized payload is buffered.
+
+    @ivar maxFrameSize: The largest frame payload accepted, or C{None}.
+    @ivar maxMessageSize: The largest message accepted, summed over all of its
+        fragments, or C{None}.
+    @ivar streaming: Whether fragments are handed out as they arrive.
+    @ivar deflate: The permessage-deflate extension negotiated for the
+        connection, which compressed messages are inflated with, or C{None}.
+    """
+
+    # Don't bother reclaiming consumed bytes at the front of the buffer until
+    # there are at least this many of them.
+    _compactThreshold = 0x10000
+
+    def __init__(self, maxFrameSize=None, maxMessageSize=None,
+                 streaming=False, deflate=None):
+        self.maxFrameSize = maxFrameSize
+        self.maxMessageSize = maxMessageSize
+        self.streaming = streaming
+        self.deflate = deflate
+        self._buffer = bytearray()
+        self._offset = 0
+        # (opcode, fin, header length, payload length, mask key) of the frame
+        # at the read offset, once its header has been received.
+        self._header = None
+        # Bytes received so far of the fragmented message in progress, or
+        # None between messages, its fragments if we're reassembling, its
+        # opcode, and whether it is compressed.
+        self._messageLength = None
+        self._fragments = []
+        self._messageOpcode = None
+        self._compressed = False
+
+
+    def pending(self):
+        """
+        Return the bytes of the incomplete frame at the end of the buffer.
+
+        @rtype: C{str}
+        """
+        return str(self._buffer[self._offset:])
+
+
+    def _compact(self):
+        """
+        Drop consumed bytes from the front of the buffer.
+
+        Consumed bytes are only reclaimed once they make up at least half of
+        the buffer, which keeps the cost of the move linear overall.
+        """
+        if self._offset == len(self._buffer):
+            del self._buffer[:]
+            self._offset = 0
+        elif (self._offset >= self._compactThreshold and
+              self._offset * 2 >= len(self._buffer)):
+            del self._buffer[:self._offset]
+            self._offset = 0
+
+
+    def _parseHeader(self):
+        """
+        Parse the header of the frame at the read offset.
+
+        @rtype: C{tuple} or C{None}
+        @return: The opcode, final fragment flag, compressed flag, header
+            length, payload length and masking key of the frame, or C{None} if
+            the header is not complete yet.
+        """
+        buf = self._buffer
+        start = self._offset
+        available = len(buf) - start
 
-    while True:
         # If there's not at least two bytes in the buffer, bail.
-        if len(buf) - start < 2:
-            break
+        if available < 2:
+            return None
 
-        # Grab the header. This single byte holds some flags nobody cares
-        # about, and an opcode which nobody cares about.
-        header = ord(buf[start])
-        if header & 0x70:
-            # At least one of the reserved flags is set. Pork chop sandwiches!
-            raise _WSException("Reserved flag in frame (%d)" % header)
+        # Grab the header. This single byte holds the final fragment flag,
+        # some reserved flags which only extensions care about, and the
+        # opcode.
+        header = buf[start]
+        fin = bool(header & 0x80)
 
         # Get the opcode, and translate it to a local enum which we actually
         # care about.
@@ -194,9 +635,21 @@ def _parseFrames(buf):
         except KeyError:
             raise _WSException("Unknown opcode %d in frame" % opcode)
 
+        compressed = False
+        if header & 0x70:
+            if (header & 0x70 == 0x40 and self.deflate is not None and
+                    opcode in (_CONTROLS.NORMAL, _CONTROLS.BINARY)):
+                # RFC 7692 6.1 The first reserved flag marks the first frame
+                # of a compressed message.
+                compressed = True
+            else:
+                # One of the reserved flags is set, and nobody asked for it.
+                # Pork chop sandwiches!
+                raise _WSException("Reserved flag in frame (%d)" % header)
+
         # Get the payload length and determine whether we need to look for an
         # extra length.
-        length = ord(buf[start + 1])
+        length = buf[start + 1]
         masked = length & 0x80
         length &= 0x7f
 
@@ -207,54 +660,194 @@ def _parseFrames(buf):
 
         # Extra length fields.
         if length == 0x7e:
-            if len(buf) - start < 4:
-                break
+            if available < 4:
+                return None
 
-            length = buf[start + 2:start + 4]
-            length = unpack(">H", length)[0]
+            length = unpack(">H", str(buf[start + 2:start + 4]))[0]
             offset += 2
         elif length == 0x7f:
-            if len(buf) - start < 10:
-                break
+            if available < 10:
+                return None
 
             # Protocol bug: The top bit of this long long *must* be cleared;
             # that is, it is expected to be interpreted as signed. That's
             # fucking stupid, if you don't mind me saying so, and so we're
             # interpreting it as unsigned anyway. If you wanna send exabytes
             # of data down the wire, then go ahead!
-            length = buf[start + 2:start + 10]
-            length = unpack(">Q", length)[0]
+            length = unpack(">Q", str(buf[start + 2:start + 10]))[0]
             offset += 8
 
+        key = None
         if masked:
-            if len(buf) - (start + offset) < 4:
+            if available - offset < 4:
                 # This is not strictly necessary, but it's more explicit so
                 # that we don't create an invalid key.
-                break
+                return None
 
-            key = buf[start + offset:start + offset + 4]
+            key = str(buf[start + offset:start + offset + 4])
             offset += 4
 
-        if len(buf) - (start + offset) < length:
-            break
+        self._checkHeader(opcode, fin, length)
 
-        data = buf[start + offset:start + offset + length]
+        return opcode, fin, compressed, offset, length, key
 
-        if masked:
-            data = _mask(data, key)
 
-        if opcode == _CONTROLS.CLOSE:
-            if len(data) >= 2:
-                # Gotta unpack the opcode and return usable data here.
-                data = unpack(">H", data[:2])[0], data[2:]
-            else:
-                # No reason given; use generic data.
-                data = 1000, "No reason given"
+    def _checkHeader(self, opcode, fin, length):
+        """
+        Reject frames which are out of sequence or too large, before any of
+        their payload is buffered.
+        """
+        if opcode in (_CONTROLS.CLOSE, _CONTROLS.PING, _CONTROLS.PONG):
+            # 5.5 Control frames may be interleaved with fragments, but must
+            # not be fragmented themselves.
+            if not fin or length > 0x7d:
+                raise _WSException("Invalid control frame")
+            return
 
-        frames.append((opcode, data))
-        start += offset + length
+        if opcode == _CONTROLS.CONTINUATION:
+            if self._messageLength is None:
+                raise _WSException("Continuation frame outside of a message")
+            messageLength = self._messageLength + length
+        else:
+            if self._messageLength is not None:
+                raise _WSException("New message before final fragment")
+            messageLength = length
+
+        if self.maxFrameSize is not None and length > self.maxFrameSize:
+            raise _WSMessageTooBig("Frame of %d bytes is too big" % length)
+        if (self.maxMessageSize is not None and
+                messageLength > self.maxMessageSize):
+            raise _WSMessageTooBig(
+                "Message of %d bytes is too big" % messageLength)
+
+
+    def feed(self, data):
+        """
+        Add data to the buffer and parse any frames it completes.
+
+        @type data: C{str}
+        @param data: A buffer of bytes.
+
+        @rtype: C{list}
+        @return: A list of C{(opcode, payload)} frames. Payloads are
+            C{memoryview}s, except for close frames, which carry a
+            C{(code, reason)} tuple. Data frames are reported with the
+            opcode of their message, C{_CONTROLS.NORMAL} or
+            C{_CONTROLS.BINARY}, whether they hold a whole message or, when
+            streaming, a fragment of one.
+        """
+        try:
+            self._compact()
+            self._buffer.extend(data)
+        except BufferError:
+            # Somebody is still looking at payloads we handed out earlier.
+            self._buffer = self._buffer[self._offset:]
+            self._offset = 0
+            self._buffer.extend(data)
+
+        frames = []
+
+        while True:
+            if self._header is None:
+                self._header = self._parseHeader()
+                if self._header is None:
+                    break
+
+            opcode, fin, compressed, offset, length, key = self._header
+            start = self._offset + offset
+            end = start + length
+
+            if len(self._buffer) < end:
+                break
+
+            if key is not None:
+                # Unmask in place; the slice keeps its size, so any views
+                # still held on the buffer remain valid.
+                self._buffer[start:end] = _mask(
+                    memoryview(self._buffer)[start:end], key)
+
+            payload = memoryview(self._buffer)[start:end]
+
+            self._offset = end
+            self._header = None
+
+            if opcode in (_CONTROLS.NORMAL, _CONTROLS.BINARY,
+                          _CONTROLS.CONTINUATION):
+                if opcode != _CONTROLS.CONTINUATION:
+                    self._messageOpcode = opcode
+                    self._compressed = compressed
+                payload = self._reassemble(payload, fin)
+                if payload is not None:
+                    frames.append((self._messageOpcode, payload))
+                continue
+
+            if opcode == _CONTROLS.CLOSE:
+                if length >= 2:
+                    # Gotta unpack the opcode and return usable data here.
+                    payload = (unpack(">H", payload[:2].tobytes())[0],
+                               payload[2:].tobytes())
+                else:
+                    # No reason given; use generic data.
+                    payload = 1000, "No reason given"
+
+            frames.append((opcode, payload))
+
+        return frames
+
+
+    def _reassemble(self, payload, fin):
+        """
+        Account for a data frame and return what should be handed out for it.
+
+        @type payload: C{memoryview}
+        @param payload: The payload of the frame.
+
+        @type fin: C{bool}
+        @param fin: Whether this is the final fragment of its message.
+
+        @rtype: C{memoryview} or C{None}
+        @return: The payload, the reassembled message, or C{None} if the
+            message is not complete yet. Compressed data is inflated.
+        """
+        if fin:
+            self._messageLength = None
+        else:
+            self._messageLength = (self._messageLength or 0) + len(payload)
+
+        if self.streaming or (fin and not self._fragments):
+            # Either we're handing out fragments as they come, or this is an
+            # unfragmented message, by far the most common case.
+            message = payload
+        else:
+            self._fragments.append(payload.tobytes())
+            if not fin:
+                return None
+            message = memoryview("".join(self._fragments))
+            self._fragments = []
+
+        if self._compressed:
+            message = memoryview(self.deflate.decompress(message, fin))
+        return message
+
+
+
+def _parseFrames(buf):
+    """
+    Parse frames in a highly compliant manner.
+
+    @type buf: C{str}
+    @param buf: A buffer of bytes.
 
-    return frames, buf[start:]
+    @rtype: C{list}
+    @return: A list of frames.
+    """
+    parser = _FrameParser()
+    frames = []
+    for opcode, data in parser.feed(buf):
+        if opcode != _CONTROLS.CLOSE:
+            data = data.tobytes()
+        frames.append((opcode, data))
+    return frames, parser.pending()
 
 
 
@@ -262,38 +855,61 @@ class _WebSocketsProtocol(ProtocolWrapper):
     """
     Protocol which wraps another protocol to provide a WebSockets transport
     layer.
+
+    If the factory has a C{coalesceDelay}, outgoing frames are gathered and
+    handed to the transport in a single C{writeSequence} once that delay has
+    passed, or as soon as C{coalesceBytes} of them are waiting.
+
+    @ivar subprotocol: The subprotocol negotiated during the handshake, if
+        any, for the wrapped protocol to look at.
+    @ivar binary: Whether data written by the wrapped protocol goes out in
+        binary frames rather than text frames.
     """
-    _buffer = None
+    _parser = None
+    _outgoing = None
+    _outgoingBytes = 0
+    _flushCall = None
     codec = None
+    deflate = None
+    subprotocol = None
+    binary = False
 
 
     def connectionMade(self):
         """
-        Log the new connection and initialize the buffer list.
+        Log the new connection and initialize the frame parser.
         """
         ProtocolWrapper.connectionMade(self)
         log.msg("Opening connection with %s" % self.transport.getPeer())
-        self._buffer = []
+        self._outgoing = []
+        # Fragments can't be streamed through a codec, which has to see the
+        # whole message at once.
+        self._parser = _FrameParser(
+            maxFrameSize=self.factory.maxFrameSize,
+            maxMessageSize=self.factory.maxMessageSize,
+            streaming=self.factory.streamFragments and not self.codec,
+            deflate=self.deflate)
 
 
-    def _parseFrames(self):
+    def _parseFrames(self, data):
         """
         Find frames in incoming data and pass them to the underlying protocol.
         """
         try:
-            frames, rest = _parseFrames("".join(self._buffer))
-        except _WSException:
+            frames = self._parser.feed(data)
+        except _WSException as e:
             # Couldn't parse all the frames, something went wrong, let's bail.
             log.err()
-            self.loseConnection()
+            self.loseConnection(e.code)
             return
 
-        self._buffer[:] = [rest]
-
         for frame in frames:
             opcode, data = frame
-            if opcode == _CONTROLS.NORMAL:
-                # Business as usual. Decode the frame, if we have a decoder.
+            if opcode in (_CONTROLS.NORMAL, _CONTROLS.BINARY):
+                # Business as usual. The payload is a view on the parser's
+                # buffer, so take our own copy for the underlying protocol.
+                data = data.tobytes()
+                # Decode the frame, if we have a decoder.
                 if self.codec:
                     data = _decoders[self.codec](data)
                 # Pass the frame to the underlying protocol.
@@ -310,7 +926,15 @@ class _WebSocketsProtocol(ProtocolWrapper):
                 # 5.5.2 PINGs must be responded to with PONGs.
                 # 5.5.3 PONGs must contain the data that was sent with the
                 # provoking PING.
-                self.transport.write(_makeFrame(data, _opcode=_CONTROLS.PONG))
+                self._writeFrame(
+                    _makeFrame(data.tobytes(), _opcode=_CONTROLS.PONG))
+            elif opcode == _CONTROLS.PONG:
+                # An answer to one of our PINGs. The underlying protocol may
+                # be keeping track of those.
+                pongReceived = getattr(self.wrappedProtocol, "pongReceived",
+                                       None)
+                if pongReceived is not None:
+                    pongReceived(data.tobytes())
 
 
     def _sendFrames(self, frames):
@@ -320,21 +944,101 @@ class _WebSocketsProtocol(ProtocolWrapper):
         @param frames: A list of byte strings to send.
         @type frames: C{list}
         """
+        opcode = _CONTROLS.BINARY if self.binary else _CONTROLS.NORMAL
         for frame in frames:
             # Encode the frame before sending it.
             if self.codec:
                 frame = _encoders[self.codec](frame)
-            packet = _makeFrame(frame)
+            if self.deflate is not None and self.deflate.shouldCompress(frame):
+                packet = _makeFrame(self.deflate.compress(frame),
+                                    _opcode=opcode, _compressed=True)
+            else:
+                packet = _makeFrame(frame, _opcode=opcode)
+            self._writeFrame(packet)
+
+
+    def _writeFrame(self, packet):
+        """
+        Write a packed frame, or queue it for the next flush if writes are
+        being coalesced.
+        """
+        factory = self.factory
+        factory.framesWritten += 1
+
+        if factory.coalesceDelay is None:
+            factory.transportWrites += 1
             self.transport.write(packet)
+            return
 
+        self._outgoing.append(packet)
+        self._outgoingBytes += len(packet)
+        if self._outgoingBytes >= factory.coalesceBytes:
+            self._flush()
+        elif self._flushCall is None:
+            self._flushCall = factory.reactor.callLater(
+                factory.coalesceDelay, self._flush)
 
-    def dataReceived(self, data):
+
+    def _flush(self):
+        """
+        Write all queued frames to the transport at once.
+        """
+        if self._flushCall is not None:
+            if self._flushCall.active():
+                self._flushCall.cancel()
+            self._flushCall = None
+
+        if self._outgoing:
+            outgoing, self._outgoing = self._outgoing, []
+            self._outgoingBytes = 0
+            self.factory.transportWrites += 1
+            if len(outgoing) == 1:
+                self.transport.write(outgoing[0])
+            else:
+                self.transport.writeSequence(outgoing)
+
+
+    def ping(self, data=""):
+        """
+        Send a PING to the other side, which should answer with a PONG
+        carrying the same data.
+
+        @type data: C{str}
+        @param data: Application data for the PING, at most 125 bytes.
+        """
+        self._writeFrame(_makeFrame(data, _opcode=_CONTROLS.PING))
+
+
+    def writePrepared(self, prepared):
         """
-        Append the data to the buffer list and parse the whole.
+        Write a message which has already been framed.
+
+        @type prepared: L{PreparedFrame}
         """
-        self._buffer.append(data)
+        self._writeFrame(prepared.frameFor(self.codec, self.deflate))
+
 
-        self._parseFrames()
+    def connectionLost(self, reason):
+        """
+        Drop any frames still waiting to be flushed, and release the
+        compression contexts of the connection, if any.
+        """
+        if self._flushCall is not None:
+            if self._flushCall.active():
+                self._flushCall.cancel()
+            self._flushCall = None
+        self._outgoing = []
+        if self.deflate is not None:
+            self.deflate.close()
+            self.deflate = None
+        ProtocolWrapper.connectionLost(self, reason)
+
+
+    def dataReceived(self, data):
+        """
+        Feed the data to the frame parser.
+        """
+        self._parseFrames(data)
 
 
     def write(self, data):
@@ -355,7 +1059,7 @@ class _WebSocketsProtocol(ProtocolWrapper):
         self._sendFrames(data)
 
 
-    def loseConnection(self):
+    def loseConnection(self, code=None, reason=""):
         """
         Close the connection.
 
@@ -365,11 +1069,23 @@ class _WebSocketsProtocol(ProtocolWrapper):
         then we might not see their last message, but since their last message
         should, according to the spec, be a simple acknowledgement, it
         shouldn't be a problem.
+
+        @type code: C{int} or C{None}
+        @param code: The status code to send in the closing frame, if any.
+
+        @type reason: C{str}
+        @param reason: The reason to send along with the status code.
         """
         # Send a closing frame. It's only polite. (And might keep the browser
         # from hanging.)
         if not self.disconnecting:
-            frame = _makeFrame("", _opcode=_CONTROLS.CLOSE)
+            payload = ""
+            if code is not None:
+                # 5.5.1 The body starts with the status code, if any.
+                payload = pack(">H", code) + reason
+            frame = _makeFrame(payload, _opcode=_CONTROLS.CLOSE)
+            # Anything queued before the close has to go out first.
+            self._flush()
             self.transport.write(frame)
 
             ProtocolWrapper.loseConnection(self)
@@ -383,9 +1099,41 @@ class _WebSocketsFactory(WrappingFactory):
 
     This factory does not provide the HTTP headers required to perform a
     WebSockets handshake; see C{WebSocketsResource}.
+
+    @ivar maxFrameSize: The largest incoming frame payload accepted, or
+        C{None} for no limit.
+    @ivar maxMessageSize: The largest incoming message accepted, or C{None}
+        for no limit.
+    @ivar streamFragments: Whether the fragments of incoming messages are
+        passed to the wrapped protocols as they arrive, instead of once the
+        whole message has been reassembled.
+    @ivar coalesceDelay: How long, in seconds, outgoing frames may wait to be
+        written together with later ones, or C{None} to write every frame
+        straight away. Zero gathers the frames written during one reactor
+        iteration.
+    @ivar coalesceBytes: How many bytes of frames may wait before they are
+        written regardless of the delay.
+    @ivar framesWritten: The number of frames written by all protocols.
+    @ivar transportWrites: The number of writes those frames took.
     """
     protocol = _WebSocketsProtocol
 
+    def __init__(self, wrappedFactory, maxFrameSize=None,
+                 maxMessageSize=None, streamFragments=False,
+                 coalesceDelay=None, coalesceBytes=_COALESCE_BYTES,
+                 reactor=None):
+        WrappingFactory.__init__(self, wrappedFactory)
+        self.maxFrameSize = maxFrameSize
+        self.maxMessageSize = maxMessageSize
+        self.streamFragments = streamFragments
+        self.coalesceDelay = coalesceDelay
+        self.coalesceBytes = coalesceBytes
+        self.framesWritten = 0
+        self.transportWrites = 0
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+
 
 
 @implementer(IResource)
@@ -399,12 +1147,43 @@ class WebSocketsResource(object):
     Due to unresolved questions of logistics, this resource cannot have
     children.
 
+    Incoming frames and messages larger than C{maxFrameSize} and
+    C{maxMessageSize} make the connection close with status 1009. With
+    C{streamFragments}, fragmented messages are passed on to the protocol one
+    fragment at a time.
+
+    Passing L{PerMessageDeflateOptions} as C{deflate} enables compression for
+    clients which offer permessage-deflate.
+
+    With a C{coalesceDelay}, frames written to a connection within that many
+    seconds of each other are handed to its transport in one write; see
+    L{writeStats}.
+
     @since: 13.0
     """
     isLeaf = True
 
-    def __init__(self, factory):
-        self._factory = _WebSocketsFactory(factory)
+    def __init__(self, factory, maxFrameSize=None,
+                 maxMessageSize=_MAX_MESSAGE_SIZE, streamFragments=False,
+                 deflate=None, coalesceDelay=None,
+                 coalesceBytes=_COALESCE_BYTES):
+        self._factory = _WebSocketsFactory(factory, maxFrameSize,
+                                           maxMessageSize, streamFragments,
+                                           coalesceDelay, coalesceBytes)
+        self._deflate = deflate
+
+
+    def writeStats(self):
+        """
+        Report how many transport writes coalescing has saved.
+
+        @rtype: C{dict}
+        @return: The number of frames written, the number of transport writes
+            they took, and the difference.
+        """
+        frames = self._factory.framesWritten
+        writes = self._factory.transportWrites
+        return {"frames": frames, "writes": writes, "saved": frames - writes}
 
 
     def getChildWithDefault(self, name, request):
@@ -481,7 +1260,24 @@ class WebSocketsResource(object):
         # We probably should remove this altogether, but I'd rather leave it
         # because it will prove to be a useful reference if/when extensions
         # are added, and it *does* work as advertised.
+        #
+        # Anything which isn't a codec is a list of subprotocols in order of
+        # preference, of which we pick the first one the wrapped factory
+        # lists in its C{subprotocols}.
         codec = request.getHeader("Sec-WebSocket-Protocol")
+        subprotocol = None
+
+        if codec and codec not in _encoders:
+            supported = getattr(self._factory.wrappedFactory, "subprotocols",
+                                ())
+            for offered in codec.split(","):
+                if offered.strip() in supported:
+                    subprotocol = offered.strip()
+                    break
+            else:
+                log.msg("Codec %s is not implemented" % codec)
+                failed = True
+            codec = None
 
         if codec:
             if codec not in _encoders or codec not in _decoders:
@@ -508,11 +1304,23 @@ class WebSocketsResource(object):
         request.setHeader("Connection", "Upgrade")
         # 4.2.2.5.4 Response to the key challenge
         request.setHeader("Sec-WebSocket-Accept", _makeAccept(key))
-        # 4.2.2.5.5 Optional codec declaration
+        # 4.2.2.5.5 Optional codec or subprotocol declaration; the two are
+        # exclusive, so the header is set at most once
         if codec:
             request.setHeader("Sec-WebSocket-Protocol", _protocol_headers[codec])
-        if codec:
             protocol.codec = codec
+        elif subprotocol:
+            request.setHeader("Sec-WebSocket-Protocol", subprotocol)
+            protocol.subprotocol = subprotocol
+        # 4.2.2.5.6 Optional extension declaration. Only permessage-deflate is
+        # supported, and only while there's room for its contexts.
+        extensions = request.getHeader("Sec-WebSocket-Extensions")
+        if extensions and self._deflate is not None:
+            negotiated = self._deflate.negotiate(
+                extensions, self._factory.maxMessageSize)
+            if negotiated is not None:
+                response, protocol.deflate = negotiated
+                request.setHeader("Sec-WebSocket-Extensions", response)
 
         # Provoke request into flushing headers and finishing the handshake.
         request.write("")
@@ -521,6 +1329,11 @@ class WebSocketsResource(object):
         # transport's lifecycle.
         transport, request.transport = request.transport, None
 
+        # The HTTP channel may still be registered as the transport's
+        # producer; the connection's protocols will want to register their own.
+        if getattr(transport, "producer", None) is not None:
+            transport.unregisterProducer()
+
         # Connect the transport to our factory, and make things go. We need to
         # do some stupid stuff here; see #3204, which could fix it.
         if request.isSecure():
@@ -1,6 +1,6 @@
 from django.core.exceptions import ValidationError
 from django.contrib.auth.forms import UserCreationForm
-from django.forms import ModelForm, CharField
+from django.forms import ModelForm, CharField, ModelMultipleChoiceField
 from django.contrib.auth.models import User
 from .models import Profile, Conversation, Message
 
@@ -63,9 +63,11 @@ class MessageForm(ModelForm):
 class ConversationCreateForm(ModelForm):
 	''' Form for validation the creation of conversation objects
 	'''
+	messages = ModelMultipleChoiceField(queryset=Message.objects.all(), required=False)
+
 	class Meta:
 		model = Conversation
-		fields = ('participants', 'messages', )
+		fields = ('participants', )
 
 	def clean(self):
 		''' we want to make sure people don't attempt to get unauthorized access to messages.
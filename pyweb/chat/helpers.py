@@ -1,4 +1,4 @@
-import traceback, json, re
+import traceback, json, re, base64
 from datetime import datetime
 from contextlib import contextmanager
 from .errors import OperationError
@@ -51,4 +51,28 @@ class DateTimeAwareDecoder(json.JSONDecoder):
 			return datetime(**d)
 		else:
 			d['__type__'] = type
-			return d
\ No newline at end of file
+			return d
+
+
+# Format of the timestamps in pagination cursors
+CURSOR_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+def encode_cursor(timestamp, pk):
+	'''	Opaque pagination cursor for a position in a (timestamp, id) ordering
+		@input timestamp (datetime): Timestamp of the row at the position
+		@input pk (string): Primary key of the row at the position
+	'''
+	return base64.urlsafe_b64encode('%s|%s' % (timestamp.strftime(CURSOR_TIME_FORMAT),
+		pk)).rstrip('=')
+
+def decode_cursor(cursor):
+	'''	Position in a (timestamp, id) ordering encoded by encode_cursor
+		@return: (timestamp, id) tuple
+		@raise ValueError if the cursor is not valid
+	'''
+	try:
+		cursor = str(cursor)
+		timestamp, pk = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).split('|', 1)
+		return datetime.strptime(timestamp, CURSOR_TIME_FORMAT), pk
+	except (TypeError, ValueError, UnicodeError):
+		raise ValueError('Invalid cursor: %s' % cursor)
@@ -0,0 +1,98 @@
+import os, time, uuid, threading
+
+from django.conf import settings
+from django.utils.module_loading import import_by_path
+
+# Crockford's base32 alphabet, which sorts in the same order as the values it encodes
+BASE32 = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+
+
+def encode_base32(value, length):
+	'''	Encode a non-negative integer as exactly length base32 characters
+	'''
+	chars = []
+	for i in xrange(length):
+		chars.append(BASE32[value & 31])
+		value >>= 5
+	return ''.join(reversed(chars))
+
+
+class Uuid4Generator(object):
+	'''	Random 32 character hexadecimal ids, as generated before sortable ids
+	'''
+
+	def __call__(self):
+		return uuid.uuid4().hex
+
+class UlidGenerator(object):
+	'''	ULIDs: a 48 bit millisecond timestamp followed by 80 random bits, as 26 base32
+		characters. Ids generated within the same millisecond increment the random
+		part of the previous one, so the ids of a process are strictly increasing and
+		sort in the order they were generated.
+	'''
+
+	def __init__(self, clock=time.time):
+		self.clock = clock
+		self.lock = threading.Lock()
+		self.last = (0, 0)
+
+	def __call__(self):
+		with self.lock:
+			timestamp, randomness = int(self.clock() * 1000), 0
+			if timestamp > self.last[0]:
+				randomness = int(os.urandom(10).encode('hex'), 16)
+			else:
+				# Same millisecond, or the clock went back
+				timestamp, randomness = self.last[0], self.last[1] + 1
+				if randomness >> 80: timestamp, randomness = timestamp + 1, 0
+			self.last = (timestamp, randomness)
+		return encode_base32(timestamp << 80 | randomness, 26)
+
+class SnowflakeGenerator(object):
+	'''	Snowflake ids: a 41 bit millisecond timestamp since epoch, a 10 bit node id and
+		a 12 bit sequence, as 13 base32 characters. Ids are unique as long as each
+		process generating them has its own node id. When more than 4096 ids are
+		asked for in a millisecond, the following millisecond is used.
+	'''
+	# 2014-01-01T00:00:00Z in milliseconds
+	EPOCH = 1388534400000
+
+	def __init__(self, node=0, clock=time.time):
+		''' @input node (int, default=0): Node id between 0 and 1023, unique to the
+				process
+		'''
+		if not 0 <= int(node) < 1024: raise ValueError('Invalid node id: %s' % node)
+		self.node = int(node)
+		self.clock = clock
+		self.lock = threading.Lock()
+		self.last = (0, 0)
+
+	def __call__(self):
+		with self.lock:
+			timestamp, sequence = int(self.clock() * 1000) - self.EPOCH, 0
+			if timestamp <= self.last[0]:
+				timestamp, sequence = self.last[0], self.last[1] + 1
+				if sequence >> 12: timestamp, sequence = timestamp + 1, 0
+			self.last = (timestamp, sequence)
+		return encode_base32(timestamp << 22 | self.node << 12 | sequence, 13)
+
+
+_generator = None
+_generator_lock = threading.Lock()
+
+def id_generator():
+	'''	Id generator configured by the ID_GENERATOR setting, a dotted path to a class
+		called with the ID_GENERATOR_OPTIONS keyword arguments
+	'''
+	global _generator
+	if _generator is None:
+		with _generator_lock:
+			if _generator is None:
+				factory = import_by_path(getattr(settings, 'ID_GENERATOR', 'chat.ids.UlidGenerator'))
+				_generator = factory(**getattr(settings, 'ID_GENERATOR_OPTIONS', {}))
+	return _generator
+
+def new_id():
+	'''	Generate a primary key for a message or conversation
+	'''
+	return id_generator()()
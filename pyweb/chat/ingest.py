@@ -0,0 +1,143 @@
+import threading, time, logging
+
+from django.conf import settings
+from django.db import transaction
+
+from .models import Message
+from .relay import push_requests
+from .errors import OperationError
+
+logger = logging.getLogger(__name__)
+
+
+class PendingMessage(object):
+	'''	A message waiting for its group commit
+	'''
+
+	def __init__(self, message, request=None):
+		self.message = message
+		self.request = request
+		self.done = False
+		self.error = None
+
+
+class GroupCommit(object):
+	'''	Insert messages from concurrent requests in shared transactions, so that one
+		commit (and one fsync on SQLite) covers several messages. There is no writer
+		thread: each request queues its message, and when no commit is running it
+		commits everything queued by then itself, on its own connection. Requests
+		queueing while a commit runs wait for it, and the first of them to find its
+		message still queued commits the next group. While the last commit held more
+		than one message, the committing request waits delay seconds for more
+		messages before taking the queue.
+
+		The group is inserted with one statement and its relay requests are pushed in
+		the same transaction. If that fails, each message is retried in a transaction
+		of its own, so one bad message only fails its own request. Requests already
+		inside a transaction commit their message alone, as it could still be rolled
+		back with their transaction.
+	'''
+
+	def __init__(self, delay=0.002, size=100):
+		''' @input delay (float, default=0.002): Seconds waited for more messages under
+				concurrent load
+			@input size (int, default=100): Most messages committed together
+		'''
+		self.delay = delay
+		self.size = size
+		self.condition = threading.Condition()
+		self.committing = False
+		self.pending = []
+		# Size of the last group, telling whether there are concurrent writers
+		self.last = 0
+		self.commits = 0
+		self.written = 0
+
+	def write(self, message, request=None):
+		'''	Insert a new message, returning once it is committed
+			@input message (Message): Unsaved message, given an id if it has none
+			@input request (dictionary, default=None): Control request for the relay,
+				pushed in the transaction inserting the message
+			@raise The error the insert or the push raised
+		'''
+		item = PendingMessage(message, request)
+		if transaction.get_connection().in_atomic_block:
+			self.commit([item])
+			if item.error is not None: raise item.error
+			return message
+
+		with self.condition:
+			self.pending.append(item)
+			while not item.done:
+				if self.committing:
+					self.condition.wait()
+					continue
+				self.committing = True
+				self.condition.release()
+				try:
+					if self.delay and self.last > 1: time.sleep(self.delay)
+					with self.condition:
+						group, self.pending = self.pending[:self.size], self.pending[self.size:]
+					self.commit(group)
+				finally:
+					self.condition.acquire()
+					self.committing = False
+					self.condition.notify_all()
+		if item.error is not None: raise item.error
+		return message
+
+	def commit(self, group):
+		'''	Commit a group of messages. Whatever happens, every message of the group is
+			done afterwards, with the error which kept it from being committed if it
+			was not, so that no request waits for it forever.
+		'''
+		committed = set()
+		try:
+			try:
+				with transaction.atomic():
+					for item in group:
+						if not item.message.id: item.message.id = item.message.generateMessageId()
+					Message.objects.bulk_create([item.message for item in group])
+					requests = [item.request for item in group if item.request is not None]
+					if requests: push_requests(requests)
+				committed.update(group)
+			except Exception as err:
+				if len(group) == 1: raise
+				logger.warning('Group commit of %d messages failed, committing them one by '
+					'one: %s' % (len(group), err))
+				for item in group:
+					try:
+						with transaction.atomic():
+							if not item.message.id: item.message.id = item.message.generateMessageId()
+							item.message.save(force_insert=True)
+							if item.request is not None: push_requests([item.request])
+						committed.add(item)
+					except Exception as err: item.error = err
+		except Exception as err:
+			for item in group:
+				if item not in committed and item.error is None: item.error = err
+		finally:
+			for item in group:
+				if item not in committed and item.error is None:
+					item.error = OperationError('The message was not committed')
+				item.done = True
+			self.last = len(group)
+			self.commits += 1
+			self.written += len(committed)
+
+_writer = None
+_writer_lock = threading.Lock()
+
+def message_writer():
+	'''	Shared group commit, configured by the MESSAGE_GROUP_COMMIT_* settings, or None
+		when MESSAGE_GROUP_COMMIT is off
+	'''
+	global _writer
+	if not getattr(settings, 'MESSAGE_GROUP_COMMIT', True): return None
+	if _writer is None:
+		with _writer_lock:
+			if _writer is None:
+				_writer = GroupCommit(
+					delay=getattr(settings, 'MESSAGE_GROUP_COMMIT_DELAY', 0.002),
+					size=getattr(settings, 'MESSAGE_GROUP_COMMIT_SIZE', 100))
+	return _writer
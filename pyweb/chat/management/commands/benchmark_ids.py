@@ -0,0 +1,60 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+
+from chat.ids import Uuid4Generator, UlidGenerator, SnowflakeGenerator
+from chat.models import Message
+
+GENERATORS = {
+	'uuid4' : Uuid4Generator,
+	'ulid' : UlidGenerator,
+	'snowflake' : SnowflakeGenerator,
+}
+
+# Text of the messages inserted, which are deleted again afterwards
+MARKER = 'benchmark_ids'
+
+
+class Command(BaseCommand):
+	'''	Compare the message insert throughput of the id generators on a database.
+		Point --database at a PostgreSQL alias of DATABASES to compare it with SQLite.
+	'''
+	help = 'Insert messages with each id scheme and report the rows inserted per second'
+	option_list = BaseCommand.option_list + (
+		make_option('--database', default='default',
+			help='Database alias to insert into'),
+		make_option('--count', type='int', default=100000,
+			help='Messages inserted with each id scheme'),
+		make_option('--batch', type='int', default=500,
+			help='Messages inserted per transaction'),
+		make_option('--generators', default='uuid4,ulid,snowflake',
+			help='Comma separated id schemes: %s' % ', '.join(sorted(GENERATORS))),
+	)
+
+	def handle(self, *args, **options):
+		database, count, batch = options['database'], options['count'], options['batch']
+		names = options['generators'].split(',')
+		for name in names:
+			if name not in GENERATORS: raise CommandError('Unknown id scheme: %s' % name)
+		if count < 1 or batch < 1: raise CommandError('--count and --batch must be positive')
+
+		vendor = connections[database].vendor
+		for name in names:
+			generate = GENERATORS[name]()
+			elapsed = 0.0
+			try:
+				for start in xrange(0, count, batch):
+					messages = [Message(id=generate(), text=MARKER)
+						for i in xrange(min(batch, count - start))]
+					began = time.time()
+					with transaction.atomic(using=database):
+						Message.objects.using(database).bulk_create(messages)
+					elapsed += time.time() - began
+			finally:
+				with transaction.atomic(using=database):
+					connections[database].cursor().execute('DELETE FROM %s WHERE text = %%s' %
+						connections[database].ops.quote_name(Message._meta.db_table), [MARKER])
+			self.stdout.write('%s %-9s %8d rows/s (%d rows in %.2fs)' % (vendor, name,
+				count / elapsed, count, elapsed))
@@ -0,0 +1,94 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connection, transaction, DatabaseError
+
+from chat.models import Message, Conversation
+
+# Link table of the former Conversation.messages many-to-many field
+LINK_TABLE = 'chat_conversation_messages'
+
+
+class Command(BaseCommand):
+	'''	Move messages from the conversation/message link table onto the
+		Message.conversation foreign key. Run it once after upgrading a database
+		created by syncdb before Message.conversation existed; it can be run again
+		to carry on after being interrupted.
+	'''
+	help = 'Copy conversation/message links onto Message.conversation, in chunks'
+	option_list = BaseCommand.option_list + (
+		make_option('--chunk-size', type='int', default=5000, metavar='LINKS',
+			help='Links copied per transaction'),
+		make_option('--keep-links', action='store_true', default=False,
+			help='Keep the link table once the links are copied'),
+	)
+
+	def handle(self, *args, **options):
+		if options['chunk_size'] < 1: raise CommandError('--chunk-size must be positive')
+		cursor = connection.cursor()
+		qn = connection.ops.quote_name
+		messages, field = Message._meta.db_table, Message._meta.get_field('conversation')
+
+		if field.column not in [column.name for column in
+				connection.introspection.get_table_description(cursor, messages)]:
+			cursor.execute('ALTER TABLE %s ADD COLUMN %s %s NULL REFERENCES %s (%s)%s' % (
+				qn(messages), qn(field.column), field.db_type(connection),
+				qn(Conversation._meta.db_table), qn(Conversation._meta.pk.column),
+				connection.ops.deferrable_sql()))
+			self.stdout.write('Added %s.%s' % (messages, field.column))
+
+		if LINK_TABLE in connection.introspection.table_names(cursor):
+			self.copyLinks(cursor, options['chunk_size'])
+			if not options['keep_links']: self.dropLinks(cursor)
+
+		# Created once the links are copied, which is quicker than updating it
+		index = [Message._meta.get_field(name) for name in Message._meta.index_together[0]]
+		try:
+			with transaction.atomic():
+				for sql in connection.creation.sql_indexes_for_fields(Message, index, no_style()):
+					cursor.execute(sql)
+			self.stdout.write('Indexed %s by %s' % (messages,
+				', '.join(field.column for field in index)))
+		except DatabaseError:
+			# The index already exists
+			pass
+
+	def copyLinks(self, cursor, chunk_size):
+		'''	Set the conversation of the linked messages a chunk of links at a time, so
+			that no transaction holds more than chunk_size rows. Messages linked to
+			several conversations keep the first one.
+		'''
+		qn = connection.ops.quote_name
+		messages = qn(Message._meta.db_table)
+		cursor.execute('SELECT MIN(id), MAX(id) FROM %s' % LINK_TABLE)
+		first, last = cursor.fetchone()
+		if first is None: return
+
+		copied = 0
+		for start in xrange(first - 1, last, chunk_size):
+			with transaction.atomic():
+				cursor.execute('UPDATE %(messages)s SET conversation_id = ('
+					'SELECT link.conversation_id FROM %(links)s link '
+					'WHERE link.message_id = %(messages)s.id AND link.id > %%s AND link.id <= %%s '
+					'ORDER BY link.id LIMIT 1) '
+					'WHERE conversation_id IS NULL AND id IN ('
+					'SELECT message_id FROM %(links)s WHERE id > %%s AND id <= %%s)' % {
+						'messages' : messages, 'links' : LINK_TABLE },
+					[start, start + chunk_size] * 2)
+				copied += max(cursor.rowcount, 0)
+			self.stdout.write('Copied links up to %d of %d' % (min(start + chunk_size, last), last))
+		self.stdout.write('Moved %d message(s) onto their conversation' % copied)
+
+	def dropLinks(self, cursor):
+		'''	Drop the link table, unless it holds links the foreign key cannot keep
+		'''
+		cursor.execute('SELECT COUNT(*) FROM (SELECT message_id FROM %s GROUP BY message_id '
+			'HAVING COUNT(*) > 1) shared' % LINK_TABLE)
+		shared = cursor.fetchone()[0]
+		if shared:
+			self.stderr.write('%d message(s) are linked to several conversations and only '
+				'kept the first; %s was left in place' % (shared, LINK_TABLE))
+			return
+		with transaction.atomic(): cursor.execute('DROP TABLE %s' % LINK_TABLE)
+		self.stdout.write('Dropped %s' % LINK_TABLE)
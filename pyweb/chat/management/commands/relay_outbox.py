@@ -0,0 +1,38 @@
+import datetime
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from chat.relay import outbox_dispatcher
+
+
+class Command(BaseCommand):
+	'''	Stream the outbox to the message relay until interrupted
+	'''
+	help = 'Deliver committed outbox events to the message relay, in order'
+	option_list = BaseCommand.option_list + (
+		make_option('--replay', type='float', default=None, metavar='SECONDS',
+			help='Send the events written in the last SECONDS again before continuing'),
+		make_option('--once', action='store_true', default=False,
+			help='Send the pending events and exit'),
+	)
+
+	def handle(self, *args, **options):
+		dispatcher = outbox_dispatcher()
+		if options['replay'] is not None:
+			position = dispatcher.rewind(datetime.datetime.utcnow() -
+				datetime.timedelta(seconds=options['replay']))
+			self.stdout.write('Replaying outbox events after %d' % position)
+
+		if options['once']:
+			sent = 0
+			while True:
+				count = dispatcher.dispatch()
+				if not count: break
+				sent += count
+			dispatcher.release()
+			self.stdout.write('Sent %d outbox event(s)' % sent)
+			return
+
+		try: dispatcher.run()
+		except KeyboardInterrupt: dispatcher.release()
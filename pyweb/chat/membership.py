@@ -0,0 +1,99 @@
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.signals import request_started
+from django.db.models.signals import m2m_changed, pre_delete, post_delete
+from django.dispatch import receiver
+from django.contrib.auth.models import User
+
+from .models import Conversation
+
+# Through table of the participants of conversations. Its unique index on
+# (conversation_id, user_id) answers membership checks without reading the
+# participant list.
+Participant = Conversation.participants.through
+
+# Memberships checked during the current request, keyed by cache key
+_checked = threading.local()
+
+
+def membership_key(conversation_pk, user_pk):
+	return 'chat:member:%s:%s' % (conversation_pk, user_pk)
+
+def checked():
+	'''	Memberships checked by the current thread since its request started
+	'''
+	if not hasattr(_checked, 'members'): _checked.members = {}
+	return _checked.members
+
+def is_participant(conversation, user):
+	'''	Check whether a user is a participant of a conversation with an indexed EXISTS
+		query, caching the answer for the rest of the request and for
+		MEMBERSHIP_CACHE_TTL seconds across requests
+		@input conversation: Conversation, or its primary key
+		@input user: User, or its primary key
+	'''
+	cpk = getattr(conversation, 'pk', conversation)
+	upk = getattr(user, 'pk', user)
+	if cpk is None or upk is None: return False
+
+	key = membership_key(cpk, upk)
+	members = checked()
+	if key in members: return members[key]
+
+	ttl = getattr(settings, 'MEMBERSHIP_CACHE_TTL', 5)
+	member = cache.get(key) if ttl else None
+	if member is None:
+		member = Participant.objects.filter(conversation_id=cpk, user_id=upk).exists()
+		if ttl: cache.set(key, member, ttl)
+	members[key] = member
+	return member
+
+def forget_memberships(pairs):
+	'''	Drop cached membership answers
+		@input pairs: (conversation pk, user pk) tuples whose membership changed
+	'''
+	keys = [membership_key(cpk, upk) for cpk, upk in pairs]
+	if not keys: return
+	members = checked()
+	for key in keys: members.pop(key, None)
+	cache.delete_many(keys)
+
+
+@receiver(request_started)
+def start_request(sender, **kwargs):
+	_checked.members = {}
+
+@receiver(m2m_changed, sender=Participant)
+def participants_changed(sender, instance, action, reverse, pk_set, **kwargs):
+	'''	Forget the memberships changed through Conversation.participants, or through
+		its reverse accessor on User
+	'''
+	if action == 'pre_clear':
+		# The rows cleared are only known before they are deleted
+		field = 'user_id' if reverse else 'conversation_id'
+		instance._cleared_participants = list(Participant.objects.filter(
+			**{field : instance.pk}).values_list('conversation_id', 'user_id'))
+	elif action == 'post_clear':
+		forget_memberships(getattr(instance, '_cleared_participants', ()))
+		instance._cleared_participants = ()
+	elif action in ('post_add', 'post_remove'):
+		if reverse: forget_memberships((cpk, instance.pk) for cpk in pk_set)
+		else: forget_memberships((instance.pk, upk) for upk in pk_set)
+
+@receiver(pre_delete, sender=Conversation)
+@receiver(pre_delete, sender=User)
+def member_deleting(sender, instance, **kwargs):
+	'''	Deleting a conversation or a user cascades to the through table without
+		sending m2m_changed, so its rows are read before they are deleted
+	'''
+	field = 'user_id' if sender is User else 'conversation_id'
+	instance._deleted_participants = list(Participant.objects.filter(
+		**{field : instance.pk}).values_list('conversation_id', 'user_id'))
+
+@receiver(post_delete, sender=Conversation)
+@receiver(post_delete, sender=User)
+def member_deleted(sender, instance, **kwargs):
+	forget_memberships(getattr(instance, '_deleted_participants', ()))
+	instance._deleted_participants = ()
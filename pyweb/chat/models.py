@@ -1,13 +1,13 @@
-import uuid
+import json
 import datetime
 
 from django.utils import timezone
-from django.db import models, IntegrityError
+from django.db import models
 
 from django.core.urlresolvers import reverse
 from django.contrib.auth.models import User
 
-from .helpers import retry_action
+from .ids import new_id
 
 
 class Profile(models.Model):
@@ -21,28 +21,34 @@ class Profile(models.Model):
 
 class Message(models.Model):
 	''' This represents a single message sent during chat.  It has a unique alpha numeric
-		pseudorandom message_id, the text of the actual message, the timestamp of when the
-		message was sent, and a foreign key linking it to the sender
-		@raise IntegrityError if the pseudorandom message_id is not unique
+		message_id, sortable by the time it was generated (see chat.ids), the text of the
+		actual message, the timestamp of when the message was sent, and foreign keys
+		linking it to the sender and to the conversation it was sent to
 	'''
 	id = models.CharField(primary_key=True, max_length=36, unique=True)
 	text = models.CharField(max_length=256)
 	timestamp = models.DateTimeField(default=datetime.datetime.now, verbose_name='Date Sent', 
 		blank=True, null=True)
 	sender = models.ForeignKey(User, blank=True, null=True)
+	# Indexed together with the timestamp below
+	conversation = models.ForeignKey('Conversation', related_name='messages', blank=True,
+		null=True, db_index=False)
 
 	class Meta:
 		ordering = ('timestamp', )
+		# History pages are range scans over the messages of one conversation
+		index_together = (('conversation', 'timestamp', 'id'), )
 
-	def generateMessageId(self): return uuid.uuid4().hex
+	def generateMessageId(self): return new_id()
 
 	def save(self, *args, **kwargs):
-		# Generate message id if the model does not already have one
-		if not self.id: self.id = self.generateMessageId()
-		# Save model instance, in cases with duplicate IDs, generate new ID and resave
-		def messagesave(): super(self.__class__, self).save(*args, **kwargs)
-		def duplicateid(): self.id = self.generateMessageId()
-		retry_action(messagesave, exception_actions={ IntegrityError : duplicateid })
+		# Generate message id if the model does not already have one, and insert new
+		# messages without first trying to update them. Generated ids are unique, so
+		# the insert is not retried.
+		if not self.id:
+			self.id = self.generateMessageId()
+			kwargs.setdefault('force_insert', True)
+		super(Message, self).save(*args, **kwargs)
 
 	def __str__(self):
 		return ' : '.join([str(s) for s in (self.sender.username, self.text, self.id) \
@@ -50,24 +56,76 @@ class Message(models.Model):
 
 class Conversation(models.Model):
 	''' Conversation represents one conversation that's taking place.  It has many
-		participants and many messages.
+		participants and many messages (Message.conversation).
 	'''
 	id = models.CharField(primary_key=True, max_length=36)
 	participants = models.ManyToManyField(User, blank=True)
-	messages = models.ManyToManyField(Message, blank=True)
 	ctime = models.DateTimeField(default=datetime.datetime.utcnow, 
 		verbose_name='Date Created', editable=False)
 
 	def __str__(self):
 		return ' : '.join(["Conversation", str(self.pk)])
 
-	def generateConversationId(self): return uuid.uuid4().hex
+	def generateConversationId(self): return new_id()
 
 	def save(self, *args, **kwargs):
-		# Generate conversation id if the model does not already have one
-		if not self.id: self.id = self.generateConversationId()
-		# Save model instance, in cases with duplicate IDs, generate a new ID and resave
-		def conversationsave():	super(self.__class__, self).save(*args, **kwargs)
-		def duplicateid(): self.id = self.generateConversationId()
-		retry_action(conversationsave, exception_actions={ IntegrityError : duplicateid })
+		# Generate conversation id if the model does not already have one, and insert
+		# new conversations without first trying to update them
+		if not self.id:
+			self.id = self.generateConversationId()
+			kwargs.setdefault('force_insert', True)
+		super(Conversation, self).save(*args, **kwargs)
+
+
+class OutboxEvent(models.Model):
+	'''	Control request for the message relay, written in the same transaction as the
+		change it announces, so that the relay hears about every committed change and
+		nothing else. The outbox dispatcher sends committed events in id order.
+	'''
+	id = models.AutoField(primary_key=True)
+	payload = models.TextField()
+	created = models.DateTimeField(default=datetime.datetime.utcnow, db_index=True,
+		editable=False)
+	# Conversation the event belongs to, and the id of its previous event
+	conversation = models.CharField(max_length=36, blank=True)
+	previous = models.IntegerField(blank=True, null=True)
+
+	class Meta:
+		ordering = ('id', )
+		# Delta sync reads the events of a user's conversations after a cursor
+		index_together = (('conversation', 'id'), )
+
+	def request(self):
+		'''	The control request, as built by BaseView.relayRequest
+		'''
+		return json.loads(self.payload)
+
+	def __str__(self):
+		return ' : '.join(['OutboxEvent', str(self.pk)])
+
+class OutboxCursor(models.Model):
+	'''	High-water mark of an outbox dispatcher: the id of the last event the relay
+		has acknowledged. The dispatcher holding the lease is the only one sending
+		events, and it must renew the lease before lease_until.
+	'''
+	name = models.CharField(primary_key=True, max_length=64)
+	position = models.BigIntegerField(default=0)
+	owner = models.CharField(max_length=128, blank=True)
+	lease_until = models.DateTimeField(blank=True, null=True)
 
+	def __str__(self):
+		return ' : '.join([self.name, str(self.position)])
+
+class ConversationTombstone(models.Model):
+	'''	Record that a user was a participant of a deleted conversation, so that delta
+		sync can send them the deletion. event is the outbox id of the deletion.
+	'''
+	conversation = models.CharField(max_length=36)
+	user = models.ForeignKey(User)
+	event = models.IntegerField()
+
+	class Meta:
+		index_together = (('user', 'event'), )
+
+	def __str__(self):
+		return ' : '.join(['ConversationTombstone', self.conversation, str(self.event)])
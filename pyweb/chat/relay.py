@@ -0,0 +1,702 @@
+import os, socket, select, struct, json, threading, itertools, time, logging, urlparse, uuid
+import datetime
+from Queue import Queue, LifoQueue, Empty, Full
+
+import requests
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import Q, Min, Max
+
+from .helpers import DateTimeAwareEncoder
+from .errors import OperationError
+from .models import OutboxEvent, OutboxCursor, ConversationTombstone
+
+logger = logging.getLogger(__name__)
+
+# Frame header: length of the JSON document as a 32 bit big-endian integer
+FRAME_HEADER = struct.Struct('!I')
+
+# What RelayDispatcher.push does when the queue is full
+DROP_NEWEST = 'drop-newest'
+DROP_OLDEST = 'drop-oldest'
+BLOCK = 'block'
+
+# Prefix of the relay topics publishing to the participants of a conversation
+CONVERSATION_TOPIC = 'conversation:'
+
+# RELAY_TOKEN of the development settings, refused unless DEBUG is on
+DEVELOPMENT_TOKEN = 'development-relay-token'
+
+
+def relay_token():
+	'''	Shared secret Django and the relay identify each other with, the RELAY_TOKEN
+		setting (relay_token in webrtc-python.config)
+		@raise ImproperlyConfigured if it is not set, or is the development token
+			while DEBUG is off
+	'''
+	token = getattr(settings, 'RELAY_TOKEN', None)
+	if not token: raise ImproperlyConfigured('RELAY_TOKEN must be set')
+	if token == DEVELOPMENT_TOKEN and not settings.DEBUG:
+		raise ImproperlyConfigured('RELAY_TOKEN is the development token: set a secret '
+			'one, or turn DEBUG on for development')
+	return token
+
+
+class RelayConnection(object):
+	'''	One persistent control connection to the message relay, which Django
+		identifies itself on with the relay token before sending requests
+	'''
+
+	def __init__(self, address, token, timeout=None):
+		''' @input address: Path of a Unix domain socket, or a (host, port) tuple
+			@input token (string): Relay token, sent in the handshake
+			@input timeout (float, default=None): Socket timeout in seconds
+			@raise OperationError if the relay refuses the token
+		'''
+		if isinstance(address, basestring):
+			self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		else:
+			self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+			self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		self.sock.settimeout(timeout)
+		try:
+			self.sock.connect(address)
+			self.handshake(token)
+		except Exception:
+			self.close()
+			raise
+
+	def handshake(self, token):
+		'''	Send the relay token, and wait for the relay to accept it
+		'''
+		self.send(json.dumps({ 'opcode' : 'control-auth', 'token' : token }))
+		response = json.loads(self.receive())
+		if response.get('status') != 'success':
+			raise OperationError('The relay refused the control channel token: %s' %
+				response.get('error'))
+
+	def send(self, payload):
+		'''	Write one frame
+		'''
+		self.sock.sendall(FRAME_HEADER.pack(len(payload)) + payload)
+
+	def receive(self):
+		'''	Read one frame
+		'''
+		header = self.read(FRAME_HEADER.size)
+		return self.read(FRAME_HEADER.unpack(header)[0])
+
+	def read(self, size):
+		chunks = []
+		while size:
+			chunk = self.sock.recv(size)
+			if not chunk: raise socket.error('Control channel closed by the relay')
+			chunks.append(chunk)
+			size -= len(chunk)
+		return ''.join(chunks)
+
+	def closed(self):
+		'''	Check whether the relay has closed an idle connection. The relay only
+			writes acknowledgements, so an idle connection is readable only once it
+			has been closed.
+		'''
+		try: return bool(select.select([self.sock], [], [], 0)[0])
+		except (socket.error, select.error, ValueError): return True
+
+	def close(self):
+		try: self.sock.close()
+		except socket.error: pass
+
+
+class RelayClient(object):
+	'''	Client for the relay's persistent control channel. Requests are written to
+		a pooled connection without waiting for the relay unless an acknowledgement
+		is asked for; connections which fail are discarded and the request is
+		retried once on a fresh connection.
+	'''
+
+	def __init__(self, address, token, pool_size=4, timeout=5.0):
+		''' @input address: Path of a Unix domain socket, or a (host, port) tuple
+			@input token (string): Relay token, sent on every new connection
+			@input pool_size (int, default=4): Most idle connections kept open
+			@input timeout (float, default=5.0): Socket timeout in seconds
+		'''
+		self.address = address
+		self.token = token
+		self.timeout = timeout
+		self.pool = LifoQueue(maxsize=pool_size)
+		self.acks = itertools.count(1)
+
+	def acquire(self):
+		while True:
+			try: connection = self.pool.get_nowait()
+			except Empty: return RelayConnection(self.address, self.token, self.timeout)
+			if not connection.closed(): return connection
+			connection.close()
+
+	def release(self, connection):
+		try: self.pool.put_nowait(connection)
+		except Exception: connection.close()
+
+	def send(self, rdata, ack=False):
+		'''	Send a control request to the relay
+			@input rdata (dictionary): Control request, as posted to the control resource
+			@input ack (bool, default=False): Wait for the relay to process the request
+			@return: The relay's response if ack was asked for, otherwise None
+			@raise OperationError if the relay can't be reached or refuses the token
+		'''
+		if ack: rdata = dict(rdata, ack=next(self.acks))
+		payload = json.dumps(rdata, cls=DateTimeAwareEncoder)
+
+		errors = []
+		for attempt in xrange(2):
+			connection = None
+			try:
+				connection = self.acquire()
+				connection.send(payload)
+				response = json.loads(connection.receive()) if ack else None
+				self.release(connection)
+				return response
+			except (socket.error, ValueError) as err:
+				if connection is not None: connection.close()
+				errors.append(str(err))
+		raise OperationError('Unable to reach the message relay control channel',
+			details=errors)
+
+	def close(self):
+		'''	Close the idle connections
+		'''
+		while True:
+			try: self.pool.get_nowait().close()
+			except Empty: return
+
+
+_client = None
+_client_lock = threading.Lock()
+
+def relay_client():
+	'''	Shared client for the control channel configured by RELAY_CONTROL_SOCKET or
+		RELAY_CONTROL_ADDRESS, or None if neither is set
+	'''
+	global _client
+	if _client is None:
+		address = getattr(settings, 'RELAY_CONTROL_SOCKET', None) or \
+			getattr(settings, 'RELAY_CONTROL_ADDRESS', None)
+		if not address: return None
+		with _client_lock:
+			if _client is None:
+				_client = RelayClient(address if isinstance(address, basestring) else tuple(address),
+					relay_token(), getattr(settings, 'RELAY_CONTROL_POOL', 4))
+	return _client
+
+
+
+class RelayDispatcher(object):
+	'''	Delivers control requests to the relay from a background thread, so that
+		views never wait for the relay. Requests go onto a bounded queue; the worker
+		sends the requests which arrive within batch_delay of each other as one
+		batch, and retries failed deliveries with exponential backoff. When the
+		queue is full the policy decides whether the new request is dropped, the
+		oldest one is dropped, or the caller waits up to block_timeout.
+	'''
+
+	def __init__(self, send, queue_size=10000, policy=DROP_OLDEST, block_timeout=0.05,
+			batch_size=100, batch_delay=0.005, retry_limit=5, retry_backoff=0.1,
+			retry_backoff_max=5.0):
+		''' @input send: Callable delivering a control request to the relay, raising
+				an exception if it could not
+			@input queue_size (int, default=10000): Most requests waiting for delivery
+			@input policy (default=DROP_OLDEST): DROP_NEWEST, DROP_OLDEST or BLOCK
+			@input batch_size (int, default=100): Most requests sent in one batch
+			@input batch_delay (float, default=0.005): Seconds to wait for more requests
+				before sending a batch
+			@input retry_limit (int, default=5): Retries of a failed delivery before the
+				batch is dropped
+			@input retry_backoff (float, default=0.1): Seconds before the first retry,
+				doubled for each retry up to retry_backoff_max
+		'''
+		self.send = send
+		self.queue = Queue(maxsize=queue_size)
+		self.policy = policy
+		self.block_timeout = block_timeout
+		self.batch_size = batch_size
+		self.batch_delay = batch_delay
+		self.retry_limit = retry_limit
+		self.retry_backoff = retry_backoff
+		self.retry_backoff_max = retry_backoff_max
+		self.worker = None
+		self.lock = threading.Lock()
+		self.counters = dict.fromkeys(('enqueued', 'delivered', 'dropped', 'batches',
+			'retries', 'failures'), 0)
+		# Seconds between queueing and delivery: last, largest, and moving average
+		self.lag = {'last' : 0.0, 'max' : 0.0, 'average' : 0.0}
+
+	def count(self, counter, number=1):
+		with self.lock: self.counters[counter] += number
+
+	def push(self, rdata):
+		'''	Queue a control request for delivery
+			@return: False if the request was dropped
+		'''
+		self.start()
+		item = (time.time(), rdata)
+		try:
+			if self.policy == BLOCK: self.queue.put(item, timeout=self.block_timeout)
+			else: self.queue.put_nowait(item)
+		except Full:
+			if self.policy != DROP_OLDEST:
+				self.count('dropped', request_count(rdata))
+				logger.warning('Relay queue full, dropping %s' % rdata.get('opcode', 'batch'))
+				return False
+			try:
+				self.count('dropped', request_count(self.queue.get_nowait()[1]))
+				self.queue.task_done()
+				logger.warning('Relay queue full, dropping the oldest request')
+			except Empty: pass
+			try: self.queue.put_nowait(item)
+			except Full:
+				self.count('dropped', request_count(rdata))
+				return False
+		self.count('enqueued', request_count(rdata))
+		return True
+
+	def start(self):
+		'''	Start the worker thread, if it is not running
+		'''
+		if self.worker is not None and self.worker.is_alive(): return
+		with self.lock:
+			if self.worker is not None and self.worker.is_alive(): return
+			self.worker = threading.Thread(target=self.run, name='relay-dispatcher')
+			self.worker.daemon = True
+			self.worker.start()
+
+	def run(self):
+		while True:
+			batch = [self.queue.get()]
+			deadline = time.time() + self.batch_delay
+			while len(batch) < self.batch_size:
+				try: batch.append(self.queue.get(timeout=max(deadline - time.time(), 0)))
+				except Empty: break
+			try: self.deliver(batch)
+			except Exception: logger.exception('Relay delivery failed')
+			finally:
+				for item in batch: self.queue.task_done()
+
+	def deliver(self, batch):
+		'''	Send queued requests as one control request, retrying with backoff
+			@input batch (list): (time queued, control request) tuples
+		'''
+		events = []
+		for queued, rdata in batch: events.extend(rdata.get('events', [rdata]))
+		rdata = events[0] if len(events) == 1 else { 'events' : events }
+
+		for attempt in xrange(self.retry_limit + 1):
+			try:
+				self.send(rdata)
+				break
+			except Exception as err:
+				self.count('failures')
+				if attempt == self.retry_limit:
+					self.count('dropped', len(events))
+					logger.error('Unable to deliver %d request(s) to the relay: %s' % (
+						len(events), err))
+					return
+				self.count('retries')
+				time.sleep(min(self.retry_backoff * 2 ** attempt, self.retry_backoff_max))
+
+		now = time.time()
+		with self.lock:
+			self.counters['delivered'] += len(events)
+			self.counters['batches'] += 1
+			for queued, rdata in batch:
+				lag = now - queued
+				self.lag['last'] = lag
+				self.lag['max'] = max(self.lag['max'], lag)
+				self.lag['average'] += (lag - self.lag['average']) * 0.1
+
+	def metrics(self):
+		'''	Queue depth, delivery counters, and delivery lag in seconds
+		'''
+		with self.lock:
+			return dict(self.counters, depth=self.queue.qsize(), lag=dict(self.lag))
+
+	def flush(self, timeout=5.0):
+		'''	Wait until every queued request has been delivered or dropped
+			@return: False if requests are still waiting after timeout seconds
+		'''
+		deadline = time.time() + timeout
+		while self.queue.unfinished_tasks:
+			if time.time() > deadline: return False
+			time.sleep(0.001)
+		return True
+
+
+def request_count(rdata):
+	'''	Number of control requests in a request or batch
+	'''
+	return len(rdata['events']) if 'events' in rdata else 1
+
+
+def control_url():
+	'''	URL of the relay's HTTP control resource
+	'''
+	return urlparse.urlunparse((
+		getattr(settings, 'CONTROL_SCHEME', 'http'),
+		':'.join([str(s) for s in (getattr(settings, 'MESSAGE_SERVER', 'localhost'),
+			getattr(settings, 'MESSAGE_PORT', '1789')) if s is not None]),
+		'control', '', '', ''))
+
+
+def http_sender(timeout=5.0):
+	'''	Deliver control requests by posting them to the relay's control resource,
+		over a keep-alive connection pool
+	'''
+	session = requests.Session()
+	session.headers['X-Relay-Token'] = relay_token()
+	url = control_url()
+
+	def send(rdata):
+		response = session.post(url, data=json.dumps(rdata, cls=DateTimeAwareEncoder),
+			timeout=timeout)
+		response.raise_for_status()
+		if response.json().get('status') != 'success':
+			raise OperationError('Relay rejected control request: %s' % response.json().get('error'))
+
+	return send
+
+
+def channel_sender(client):
+	'''	Deliver control requests over the persistent control channel, waiting for
+		the relay to acknowledge each one
+	'''
+	def send(rdata):
+		response = client.send(rdata, ack=True)
+		if response.get('status') != 'success':
+			raise OperationError('Relay rejected control request: %s' % response.get('error'))
+
+	return send
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+def relay_dispatcher():
+	'''	Shared dispatcher, configured by the RELAY_QUEUE_* and RELAY_RETRY_* settings.
+		It delivers over the persistent control channel when one is configured.
+	'''
+	global _dispatcher
+	if _dispatcher is None:
+		with _dispatcher_lock:
+			if _dispatcher is None:
+				client = relay_client()
+				_dispatcher = RelayDispatcher(
+					channel_sender(client) if client is not None else http_sender(),
+					queue_size=getattr(settings, 'RELAY_QUEUE_SIZE', 10000),
+					policy=getattr(settings, 'RELAY_QUEUE_POLICY', DROP_OLDEST),
+					batch_size=getattr(settings, 'RELAY_BATCH_SIZE', 100),
+					batch_delay=getattr(settings, 'RELAY_BATCH_DELAY', 0.005),
+					retry_limit=getattr(settings, 'RELAY_RETRY_LIMIT', 5),
+					retry_backoff=getattr(settings, 'RELAY_RETRY_BACKOFF', 0.1))
+	return _dispatcher
+
+
+def request_conversation(rdata):
+	'''	Id of the conversation whose topic a control request, or the first request
+		of a batch, publishes to, or an empty string
+	'''
+	for event in rdata.get('events', [rdata]):
+		topic = event.get('topic') or ''
+		if topic.startswith(CONVERSATION_TOPIC): return topic[len(CONVERSATION_TOPIC):]
+	return ''
+
+
+def outbox_push(rdata):
+	'''	Write a control request to the outbox. Called inside the transaction which
+		makes the change, the request is committed or rolled back with it. Requests
+		publishing to a conversation are linked to the previous event of the
+		conversation, which lets clients notice the events they missed.
+	'''
+	return outbox_push_many([rdata])[0]
+
+def outbox_push_many(requests):
+	'''	Write control requests to the outbox in order, as outbox_push does, reading
+		the previous events of all their conversations with one query
+		@return: The OutboxEvents written
+	'''
+	conversations = map(request_conversation, requests)
+	previous = dict(OutboxEvent.objects.filter(conversation__in=set(filter(None, conversations)))
+		.order_by().values_list('conversation').annotate(Max('id'))) if any(conversations) else {}
+	events = []
+	for rdata, conversation in zip(requests, conversations):
+		event = OutboxEvent.objects.create(payload=json.dumps(rdata, cls=DateTimeAwareEncoder),
+			conversation=conversation, previous=previous.get(conversation))
+		if conversation: previous[conversation] = event.pk
+		events.append(event)
+	return events
+
+def push_requests(requests):
+	'''	Queue control requests for delivery to the relay, in order. With RELAY_OUTBOX
+		they are written to the outbox, and must be pushed inside the transaction
+		making the changes they announce; otherwise they are sent from a background
+		thread once pushed.
+		@return: The OutboxEvents written, or None without RELAY_OUTBOX
+	'''
+	if getattr(settings, 'RELAY_OUTBOX', True): return outbox_push_many(requests)
+	dispatcher = relay_dispatcher()
+	for rdata in requests: dispatcher.push(rdata)
+
+
+class OutboxDispatcher(object):
+	'''	Streams committed outbox events to the relay in id order, in batches. The id
+		of the last event the relay acknowledged is kept as a high-water mark in an
+		OutboxCursor, so a dispatcher which restarts, or a relay which was down, picks
+		up where delivery stopped; events are delivered at least once.
+
+		Ids are allocated when an event is written but only become visible once its
+		transaction commits, so a transaction can commit after a later one. The
+		dispatcher stops at a missing id until gap_timeout has passed, after which the
+		id is taken to belong to a rolled back transaction and skipped. Skipped ids
+		are looked up again for late_timeout seconds, and an event committed that late
+		is still sent, out of order, rather than lost.
+
+		Only the dispatcher holding the cursor's lease sends events, so several can
+		run for failover without delivering every event twice.
+	'''
+
+	def __init__(self, send, name='relay', batch_size=100, poll_interval=0.05, lease=10.0,
+			gap_timeout=5.0, late_timeout=600.0, retention=86400, retry_backoff=0.1,
+			retry_backoff_max=5.0):
+		''' @input send: Callable delivering a control request to the relay, raising
+				an exception if it could not
+			@input name (string, default='relay'): Name of the cursor
+			@input batch_size (int, default=100): Most events sent in one batch
+			@input poll_interval (float, default=0.05): Seconds between polls of an
+				empty outbox
+			@input lease (float, default=10.0): Seconds the lease is held for
+			@input gap_timeout (float, default=5.0): Seconds to wait for a missing id
+			@input late_timeout (float, default=600.0): Seconds a skipped id is looked
+				up again for
+			@input retention (float, default=86400): Seconds delivered events are kept
+				for replay
+			@input retry_backoff (float, default=0.1): Seconds before the first retry of
+				a failed delivery, doubled for each retry up to retry_backoff_max
+		'''
+		self.send = send
+		self.name = name
+		self.batch_size = batch_size
+		self.poll_interval = poll_interval
+		self.lease = lease
+		self.gap_timeout = gap_timeout
+		self.late_timeout = late_timeout
+		self.retention = retention
+		self.retry_backoff = retry_backoff
+		self.retry_backoff_max = retry_backoff_max
+		self.owner = '%s:%d:%s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+		# First missing id, and when it was first seen missing
+		self.gap = None
+		# Skipped ids which could still be committed, and when they were skipped
+		self.skipped = {}
+		# Ids skipped, and skipped events which were sent once committed
+		self.skips = 0
+		self.late = 0
+		# When the lease has to be renewed
+		self.renew_at = 0
+		self.stopped = threading.Event()
+
+	def cursor(self):
+		return OutboxCursor.objects.get_or_create(name=self.name)[0]
+
+	def acquire(self):
+		'''	Take the lease on the cursor, renewing it once half of it has passed
+			@return: False if another dispatcher holds it
+		'''
+		if time.time() < self.renew_at: return True
+		now = datetime.datetime.utcnow()
+		lease = OutboxCursor.objects.filter(name=self.name) \
+			.filter(Q(owner=self.owner) | Q(lease_until=None) | Q(lease_until__lt=now))
+		held = lease.update(owner=self.owner,
+			lease_until=now + datetime.timedelta(seconds=self.lease))
+		if not held and not OutboxCursor.objects.filter(name=self.name).exists():
+			self.cursor()
+			held = lease.update(owner=self.owner,
+				lease_until=now + datetime.timedelta(seconds=self.lease))
+		self.renew_at = time.time() + self.lease / 2 if held else 0
+		return bool(held)
+
+	def release(self):
+		self.renew_at = 0
+		OutboxCursor.objects.filter(name=self.name, owner=self.owner) \
+			.update(owner='', lease_until=None)
+
+	def advance(self, position):
+		'''	Move the high-water mark, provided the lease is still held
+		'''
+		if not OutboxCursor.objects.filter(name=self.name, owner=self.owner) \
+				.update(position=position):
+			self.renew_at = 0
+			raise OperationError('Outbox cursor %s was taken over by another dispatcher' % self.name)
+
+	def pending(self, position):
+		'''	Committed events after position which can be sent in order
+		'''
+		ready, expected = [], position + 1
+		for event in OutboxEvent.objects.filter(id__gt=position).order_by('id')[:self.batch_size]:
+			if event.id != expected:
+				if not self.gapExpired(expected): break
+				self.skip(expected, event.id)
+			ready.append(event)
+			expected = event.id + 1
+		return ready
+
+	def gapExpired(self, missing):
+		now = time.time()
+		if self.gap is None or self.gap[0] != missing: self.gap = (missing, now)
+		return now - self.gap[1] >= self.gap_timeout
+
+	def skip(self, first, end):
+		'''	Give up waiting for the ids from first up to end, which are looked up again
+			by recheck
+		'''
+		now = time.time()
+		for missing in xrange(first, end):
+			logger.warning('Skipping outbox event %d, which was never committed' % missing)
+			self.skipped[missing] = now
+		self.skips += end - first
+
+	def recheck(self):
+		'''	Send the skipped events which have been committed since, and forget the ids
+			skipped more than late_timeout ago
+			@return: The number of events sent
+			@raise the sender's exception if the relay could not be reached
+		'''
+		if not self.skipped: return 0
+		events = list(OutboxEvent.objects.filter(id__in=list(self.skipped)).order_by('id'))
+		if events:
+			for event in events:
+				logger.warning('Outbox event %d was committed after being skipped, sending it '
+					'out of order' % event.id)
+			self.send(self.requests(events))
+			for event in events: del self.skipped[event.id]
+			self.late += len(events)
+		cutoff = time.time() - self.late_timeout
+		for missing, skipped in self.skipped.items():
+			if skipped < cutoff: del self.skipped[missing]
+		return len(events)
+
+	def requests(self, events):
+		'''	The control request sending a batch of events
+		'''
+		requests = []
+		for event in events:
+			rdata = event.request()
+			for request in rdata.get('events', [rdata]):
+				# Messages published to clients carry the outbox id as the delta sync cursor
+				if 'topic' in request: request.update(cursor=event.id, previous=event.previous)
+				requests.append(request)
+		return requests[0] if len(requests) == 1 else { 'events' : requests }
+
+	def dispatch(self):
+		'''	Send one batch of pending events and advance the high-water mark
+			@return: The number of events sent, or None without the lease
+			@raise the sender's exception if the relay could not be reached
+		'''
+		if not self.acquire(): return None
+		late = self.recheck()
+		events = self.pending(self.cursor().position)
+		if not events: return late
+		self.send(self.requests(events))
+		self.advance(events[-1].id)
+		return late + len(events)
+
+	def rewind(self, since):
+		'''	Move the high-water mark back, so that the events written since a time
+			are sent again
+			@input since (datetime): Oldest event to replay
+			@return: The new position
+		'''
+		first = OutboxEvent.objects.filter(created__gte=since).aggregate(first=Min('id'))['first']
+		position = self.cursor().position if first is None else min(first - 1, self.cursor().position)
+		OutboxCursor.objects.filter(name=self.name).update(position=position)
+		return position
+
+	def prune(self):
+		'''	Delete delivered events older than the retention period. The event at the
+			high-water mark is kept, so that databases which reuse the highest id of a
+			table never hand out an id below it. Skipped events committed since they
+			were skipped are sent first, so that none is deleted unsent.
+			@return: The number of events deleted
+			@raise the sender's exception if the relay could not be reached
+		'''
+		self.recheck()
+		cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.retention)
+		events = OutboxEvent.objects.filter(id__lt=self.cursor().position, created__lt=cutoff)
+		count = events.count()
+		events.delete()
+		first = OutboxEvent.objects.aggregate(first=Min('id'))['first']
+		if first is not None: ConversationTombstone.objects.filter(event__lt=first).delete()
+		return count
+
+	def run(self, prune_interval=60.0):
+		'''	Dispatch events until stop is called
+		'''
+		failures, pruned = 0, 0
+		while not self.stopped.is_set():
+			try:
+				sent = self.dispatch()
+				if sent is not None and time.time() - pruned > prune_interval:
+					pruned = time.time()
+					self.prune()
+				failures = 0
+			except Exception as err:
+				failures += 1
+				logger.error('Unable to deliver outbox events to the relay: %s' % err)
+				self.stopped.wait(min(self.retry_backoff * 2 ** (failures - 1),
+					self.retry_backoff_max))
+				continue
+			if not sent: self.stopped.wait(self.poll_interval if sent == 0 else self.lease / 2)
+		self.release()
+
+	def stop(self):
+		self.stopped.set()
+
+	def metrics(self):
+		'''	High-water mark, number of events waiting and age of the oldest in seconds,
+			with the number of ids this dispatcher skipped, of skipped events it sent
+			once they were committed and of skipped ids it still looks up
+		'''
+		return dict(outbox_metrics(self.name), skipped=self.skips, late=self.late,
+			rechecking=len(self.skipped))
+
+
+def outbox_metrics(name='relay'):
+	'''	State of an outbox cursor: its high-water mark, the number of events waiting
+		to be sent and the age of the oldest one in seconds
+	'''
+	try: position = OutboxCursor.objects.get(name=name).position
+	except OutboxCursor.DoesNotExist: position = 0
+	waiting = OutboxEvent.objects.filter(id__gt=position)
+	oldest = waiting.order_by('id').values_list('created', flat=True)[:1]
+	return {
+		'position' : position,
+		'pending' : waiting.count(),
+		'lag' : (datetime.datetime.utcnow() - oldest[0]).total_seconds() if oldest else 0.0,
+	}
+
+
+def outbox_dispatcher(**kwargs):
+	'''	Outbox dispatcher configured by the RELAY_OUTBOX_* settings, delivering over
+		the persistent control channel when one is configured
+	'''
+	client = relay_client()
+	options = {
+		'batch_size' : getattr(settings, 'RELAY_BATCH_SIZE', 100),
+		'poll_interval' : getattr(settings, 'RELAY_OUTBOX_POLL_INTERVAL', 0.05),
+		'lease' : getattr(settings, 'RELAY_OUTBOX_LEASE', 10.0),
+		'gap_timeout' : getattr(settings, 'RELAY_OUTBOX_GAP_TIMEOUT', 5.0),
+		'late_timeout' : getattr(settings, 'RELAY_OUTBOX_LATE_TIMEOUT', 600.0),
+		'retention' : getattr(settings, 'RELAY_OUTBOX_RETENTION', 86400),
+		'retry_backoff' : getattr(settings, 'RELAY_RETRY_BACKOFF', 0.1),
+	}
+	options.update(kwargs)
+	return OutboxDispatcher(channel_sender(client) if client is not None else http_sender(),
+		**options)
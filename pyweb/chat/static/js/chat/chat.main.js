@@ -16,6 +16,7 @@ WebsocketMessenger.Views.ChatManager = WebsocketMessenger.Views.BaseView.extend(
 	user: undefined,
 
 	url_create_conversation: undefined,
+	url_sync: undefined,
 
 	$modalcontent: undefined,
 	$conversations: undefined,
@@ -33,11 +34,19 @@ WebsocketMessenger.Views.ChatManager = WebsocketMessenger.Views.BaseView.extend(
 
 	conversations: undefined,
 
+	// Delta sync cursors: the newest change seen, the cursor of the last sync, and
+	// the newest change seen in each conversation
+	cursor: undefined,
+	synced: undefined,
+	seen: undefined,
+
 	initialize: function(options) {
 		options = options || {};
 
 		// Set view options
 		this.url_create_conversation = options.url_create_conversation;
+		this.url_sync = options.url_sync;
+		this.seen = {};
 		this.$modalcontent = options.modalcontent;
 
 		this.user = options.user;
@@ -61,6 +70,7 @@ WebsocketMessenger.Views.ChatManager = WebsocketMessenger.Views.BaseView.extend(
 		// Websocket messenger and events
 		this.messenger = options.messenger;
 		this.listenTo(this.messenger, 'server:open', this.hideReconnectButton.bind(this));
+		this.listenTo(this.messenger, 'server:open', function() { this.syncChanges(this.cursor); });
 		this.listenTo(this.messenger, 'server:message', this.socketServerMessage.bind(this));
 		this.listenTo(this.messenger, 'websocket:closed', this.clearUserList.bind(this));
 		this.listenTo(this.messenger, 'websocket:closed', this.showReconnectButton.bind(this));
@@ -138,8 +148,13 @@ WebsocketMessenger.Views.ChatManager = WebsocketMessenger.Views.BaseView.extend(
 			case 'user-activelist':
 				if (_.has(sdata, 'users')) {
 					this.trigger('socket:userlist', sdata.users)
+					this.presence_version = sdata.version;
 				}
 				break;
+			// Apply the users who joined or left since the last presence version
+			case 'user-presence':
+				this.userPresence(sdata);
+				break;
 			// Create a new conversation
 			case 'conversation-create':
 				if (_.has(sdata, 'message')) {
@@ -172,13 +187,98 @@ WebsocketMessenger.Views.ChatManager = WebsocketMessenger.Views.BaseView.extend(
 				}
 				break;
 		}
+		this.trackCursor(sdata);
+	},
+
+	trackCursor: function(sdata) {
+		// Follow the sync cursor carried by relay messages. Each message names the
+		// previous change to its conversation; when that change was never seen,
+		// the missed changes are fetched from the sync API.
+		if (!_.has(sdata, 'cursor') || !_.isObject(sdata.message)) return;
+		var cid = sdata.message.cid || sdata.message.id;
+		var seen = this.seen[cid] || this.synced;
+		if (sdata.previous && !_.isUndefined(seen) && sdata.previous > seen)
+			this.syncChanges(seen);
+		this.seen[cid] = Math.max(this.seen[cid] || 0, sdata.cursor);
+		this.cursor = Math.max(this.cursor || 0, sdata.cursor);
+	},
+
+	syncChanges: function(cursor) {
+		// Fetch the changes to the user's conversations since a cursor. Without a
+		// cursor this only records where the conversations loaded at startup are.
+		if (_.isUndefined(this.url_sync)) return;
+		var manager = this;
+		$.getJSON(this.url_sync, _.isUndefined(cursor) ? {} : { cursor: cursor },
+			function(changes) { manager.applyChanges(changes, cursor); });
+	},
+
+	applyChanges: function(changes, cursor) {
+		// Apply the changes returned by the sync API
+		var manager = this;
+		if (changes.reset) {
+			// The changes since the cursor are no longer kept, reload everything
+			if (!_.isUndefined(cursor)) {
+				this.conversations.fetch();
+				this.conversations.each(function(cmodel) { cmodel.getConversationMessages(); });
+			}
+		} else {
+			_.each(changes.conversations, function(cdata) {
+				if (_.isUndefined(manager.conversations.get(cdata.id)))
+					manager.conversations.add(cdata);
+			});
+			_.each(changes.messages, function(mdata) {
+				var cmodel = manager.conversations.get(mdata.cid);
+				if (_.isObject(cmodel)) cmodel.related.messages.add(mdata.message);
+			});
+			_.each(changes.tombstones, function(tombstone) {
+				var cmodel = manager.conversations.get(tombstone.cid || tombstone.id);
+				if (!_.isObject(cmodel)) return;
+				if (tombstone.type == 'conversation') cmodel.trigger('destroy');
+				else {
+					var mmodel = cmodel.related.messages.get(tombstone.id);
+					if (_.isObject(mmodel)) mmodel.trigger('destroy');
+				}
+			});
+		}
+		this.synced = Math.max(this.synced || 0, changes.cursor);
+		this.cursor = Math.max(this.cursor || 0, changes.cursor);
+		if (changes.more) this.syncChanges(changes.cursor);
 	},
 
 	activeUserList: function(userlist) {
+		// Replace the active user list with a full list from the relay
 		var mview = this;
+		this.clearUserList();
 		_.each(userlist, function(udata) { mview.active_users.add(udata); });
 	},
 
+	userPresence: function(sdata) {
+		// Apply presence changes. Changes starting after the version last seen mean
+		// some were missed, so the relay is asked for everything since that version.
+		if (!_.isArray(sdata.changes)) return;
+		if (!_.isUndefined(this.presence_version) && sdata.since > this.presence_version) {
+			this.messenger.sendSocketData(JSON.stringify({
+				'opcode' : 'user-active',
+				'since' : this.presence_version,
+			}));
+			return;
+		}
+		var mview = this;
+		_.each(sdata.changes, function(change) {
+			if (!_.isObject(change.user)) return;
+			if (change.opcode == 'user-join') {
+				mview.active_users.add(change.user, { merge: true });
+			} else if (change.opcode == 'user-leave') {
+				var umodel = mview.active_users.get(change.user.id);
+				if (_.isObject(umodel)) {
+					umodel.trigger('destroy');
+					mview.active_users.remove(umodel);
+				}
+			}
+		});
+		this.presence_version = Math.max(this.presence_version || 0, sdata.version);
+	},
+
 	initActiveUser: function(auser) {
 		var aview = new WebsocketMessenger.Views.UserView({
 			model: auser,
@@ -192,6 +292,7 @@ WebsocketMessenger.Views.ChatManager = WebsocketMessenger.Views.BaseView.extend(
 		// Clear the active user list
 		this.active_users.forEach(function(umodel){ umodel.trigger('destroy'); });
 		this.active_users.reset();
+		this.presence_version = undefined;
 	},
 
 	hideReconnectButton: function() {
@@ -275,6 +376,7 @@ $(document).ready(function() {
 		
 		messenger: wsmessenger,		// Websocket connection
 		url_create_conversation: $apiref.attr('conversation-create'), // API conversation endpoint
+		url_sync: $apiref.attr('sync'), // API delta sync endpoint
 	});
 
 });
\ No newline at end of file
@@ -8,6 +8,14 @@ var WebsocketMessenger = WebsocketMessenger || {
 // Conversation Model
 
 WebsocketMessenger.Models.ChatModel = WebsocketMessenger.Models.BaseModel.extend({
+
+	//	@property older: Cursor of the messages before the oldest one loaded, undefined
+	//		when there are none
+	//	@signal 'messages:older': Triggered with whether there are older messages to
+	//		load, each time a page of messages is retrieved
+
+	older: undefined,
+	paged: false,
 	
 	initialize: function(attributes, options) {
 		attributes = attributes || {};
@@ -17,10 +25,10 @@ WebsocketMessenger.Models.ChatModel = WebsocketMessenger.Models.BaseModel.extend
 		WebsocketMessenger.Models.BaseModel.prototype.initialize.apply(this, [attributes, options, ]);
 		
 		// Add related models for participants and messages
-		var pcollection = new WebsocketMessenger.Collections.BaseModelCollection({
+		var pcollection = new WebsocketMessenger.Collections.BaseModelCollection([], {
 			model: WebsocketMessenger.Models.BaseModel,
 		});
-		var mcollection = new WebsocketMessenger.Collections.BaseModelCollection({
+		var mcollection = new WebsocketMessenger.Collections.BaseModelCollection([], {
 			model: WebsocketMessenger.Models.BaseModel,
 		});
 		this.addRelatedCollection('participants', pcollection);
@@ -37,10 +45,11 @@ WebsocketMessenger.Models.ChatModel = WebsocketMessenger.Models.BaseModel.extend
 			this.unset('participants');
 		}
 		if (_.has(attributes, 'messages')) {
-			// Create a message object for each message in conversation
+			// Create a message object for each message in conversation. Messages
+			// only given by their id are retrieved a page at a time instead.
 			_.each(attributes.messages, function(message){
 				console.log(JSON.stringify(message));
-				mcollection.add(message);
+				if (_.isObject(message)) mcollection.add(message);
 			});
 			// Remove messages from the primary set of properties
 			this.unset('messages');
@@ -53,12 +62,38 @@ WebsocketMessenger.Models.ChatModel = WebsocketMessenger.Models.BaseModel.extend
 	}, 
 
 	getConversationMessages: function() {
-		// Retrieve messages in the conversation
+		// Retrieve the latest messages in the conversation
 		if (_.isUndefined(this.updateurl)) 
 			throw new Error('Unable to retrieve conversation messages, no update url specified');
 		if (_.isUndefined(this.related.messages.collectionurl))
 			this.related.messages.collectionurl = this.updateurl;
-		this.related.messages.fetch();
+		this.fetchMessages({});
+	},
+
+	getOlderMessages: function() {
+		// Retrieve the page of messages before the oldest one loaded
+		if (_.isUndefined(this.older)) return;
+		this.paged = true;
+		this.fetchMessages({ before: this.older }, { at: 0 });
+	},
+
+	fetchMessages: function(params, options) {
+		// 	Retrieve a page of messages, keeping the ones already loaded
+		//	@input params: Query parameters of the page, "before" holds a cursor
+		//	@input options: Options passed on to the collection when adding the messages
+		var cmodel = this;
+		this.related.messages.fetch(_.extend({
+			data: params,
+			remove: false,
+			success: function(collection, response, options) {
+				// The cursor of the older messages comes back in the X-Cursor-Before
+				// header. Once older pages have been loaded, reloading the latest
+				// messages does not move it.
+				if (!_.has(params, 'before') && cmodel.paged) return;
+				cmodel.older = options.xhr.getResponseHeader('X-Cursor-Before') || undefined;
+				cmodel.trigger('messages:older', !_.isUndefined(cmodel.older));
+			},
+		}, options));
 	},
 
 });
\ No newline at end of file
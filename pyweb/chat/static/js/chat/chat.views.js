@@ -26,11 +26,13 @@ WebsocketMessenger.Views.ConversationView = WebsocketMessenger.Views.BaseModelVi
 			this.initMessage.bind(this));
 		this.listenTo(this.model, 'related:collection:messages:change',
 			this.updatePlaceholderMessage.bind(this))
+		this.listenTo(this.model, 'messages:older', this.updateOlderMessages.bind(this));
 	},
 
 	events: {
 		'click .conversation-controls a.remove-conversation' : 'removeConversation',
 		'click .btn-send-message' : 'sendMessageButtonClick',
+		'click .load-older-messages' : 'loadOlderMessages',
 	},
 
 	render: function() {
@@ -69,7 +71,12 @@ WebsocketMessenger.Views.ConversationView = WebsocketMessenger.Views.BaseModelVi
 			model: cmessage,
 			template: this.tmpl_message,
 		});
-		this.$messages.append(mview.render().$el);
+		mview.render().$el.addClass('conversation-message');
+		// Keep the views in the order of the messages, older pages are added first
+		var $next = this.$messages.children('.conversation-message')
+			.eq(this.model.related.messages.indexOf(cmessage));
+		if ($next.length > 0) $next.before(mview.$el);
+		else this.$messages.append(mview.$el);
 	},
 
 	initUserInterface: function() {
@@ -88,6 +95,17 @@ WebsocketMessenger.Views.ConversationView = WebsocketMessenger.Views.BaseModelVi
 		this.sendMessage();
 	},
 
+	loadOlderMessages: function(event) {
+		event.preventDefault();
+		this.model.getOlderMessages();
+	},
+
+	updateOlderMessages: function(older) {
+		// Offer to load older messages while there are some
+		if (older) this.$('.older-messages').removeClass('hidden');
+		else this.$('.older-messages').addClass('hidden');
+	},
+
 	updatePlaceholderMessage: function(event) {
 		if (this.$('.message-text').length > 0) this.$('.placeholder').hide();
 		else this.$('.placeholder').show();
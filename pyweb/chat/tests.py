@@ -1,11 +1,17 @@
-import uuid, datetime, posixpath, logging, json
+import uuid, datetime, posixpath, logging, json, socket, threading, time, re
+from StringIO import StringIO
 
 from django.utils import timezone
 from django.db import models, transaction, IntegrityError
 
 from django.core import serializers
+from django.core.exceptions import ImproperlyConfigured
 from django.core.urlresolvers import reverse
 from django.test import TestCase
+from django.test.utils import override_settings, CaptureQueriesContext
+from django.db import connection
+from django.core.cache import cache
+from django.core.management import call_command
 from django.test.client import RequestFactory, Client
 
 from django.contrib.auth.models import User, UserManager
@@ -13,11 +19,15 @@ from django.forms.models import model_to_dict
 
 from .helpers import DateTimeAwareEncoder, DateTimeAwareDecoder
 
-from .models import Profile, Message, Conversation
+from .models import Profile, Message, Conversation, OutboxEvent, OutboxCursor
 from .forms import ProfileForm, UserForm, MessageForm
+from .relay import (RelayClient, RelayConnection, RelayDispatcher, OutboxDispatcher,
+	outbox_push, outbox_metrics, DROP_NEWEST, DROP_OLDEST)
+from .errors import OperationError
+from . import views, membership, ids, ingest, relay
 from .views import (UserCreateView, UserAuthenticateView, UserRestView, ProfileRestView,
 	MessageRestView, MessageCreateView, ConversationRestView,
-	ConversationCreateView, API_RESULT, API_SUCCESS, API_FAIL, API_ERROR)
+	ConversationCreateView, API_RESULT, API_SUCCESS, API_FAIL, API_ERROR, user_contacts)
 
 logger = logging.getLogger(__name__)
 
@@ -97,6 +107,78 @@ class DatabaseTests(TestCase):
 		self.assertFalse((msg.id == '') or (msg.id is None), "Something isn't working"
 			+ " with message id generation")
 
+	def testMigrateMessageConversations(self):
+		''' Links of the former Conversation.messages table are copied onto
+			Message.conversation, a chunk at a time
+		'''
+		user = User.objects.create(username=username)
+		conversations = [Conversation(), Conversation()]
+		for conversation in conversations: conversation.save()
+		messages = [Message(sender=user, text='message %d' % i) for i in range(5)]
+		for message in messages: message.save()
+
+		cursor = connection.cursor()
+		cursor.execute('CREATE TABLE chat_conversation_messages (id integer PRIMARY KEY, '
+			'conversation_id varchar(36), message_id varchar(36))')
+		for i, message in enumerate(messages):
+			cursor.execute('INSERT INTO chat_conversation_messages (conversation_id, message_id) '
+				'VALUES (%s, %s)', [conversations[i % 2].pk, message.pk])
+
+		call_command('migrate_message_conversations', chunk_size=2, stdout=StringIO())
+		for i, message in enumerate(messages):
+			self.assertEquals(Message.objects.get(pk=message.pk).conversation, conversations[i % 2])
+		self.assertNotIn('chat_conversation_messages', connection.introspection.table_names())
+
+
+class IdTests(TestCase):
+	''' Sortable message and conversation ids
+	'''
+
+	def testUlid(self):
+		''' ULIDs sort in the order they were generated, within a millisecond and when
+			the clock goes back
+		'''
+		now = [1400000000.0]
+		generate = ids.UlidGenerator(clock=lambda: now[0])
+		generated = [generate() for i in range(100)]
+		now[0] += 1
+		generated.append(generate())
+		now[0] -= 10
+		generated.append(generate())
+		self.assertEquals(generated, sorted(set(generated)))
+		self.assertTrue(all(len(generated_id) == 26 for generated_id in generated))
+		self.assertEquals(generated[0][:10], ids.encode_base32(1400000000000, 10))
+
+	def testSnowflake(self):
+		''' Snowflake ids hold the node id, and move to the next millisecond when the
+			sequence runs out
+		'''
+		now = [1400000000.0]
+		generate = ids.SnowflakeGenerator(node=5, clock=lambda: now[0])
+		generated = [generate() for i in range(5000)]
+		self.assertEquals(generated, sorted(set(generated)))
+		self.assertEquals(generated[0],
+			ids.encode_base32((1400000000000 - generate.EPOCH) << 22 | 5 << 12, 13))
+		self.assertEquals(generate.last, (1400000000001 - generate.EPOCH, 5000 - 4097))
+		self.assertRaises(ValueError, ids.SnowflakeGenerator, node=1024)
+
+	def testConfigured(self):
+		''' Models take their ids from the configured generator
+		'''
+		with override_settings(ID_GENERATOR='chat.ids.SnowflakeGenerator',
+				ID_GENERATOR_OPTIONS={'node' : 7}):
+			ids._generator = None
+			try:
+				conversation = Conversation()
+				conversation.save()
+				messages = [Message(text='message %d' % i) for i in range(3)]
+				for message in messages: message.save()
+			finally: ids._generator = None
+		self.assertEquals(len(conversation.pk), 13)
+		self.assertEquals([message.pk for message in messages],
+			sorted(message.pk for message in messages))
+		self.assertEquals(Message.objects.get(pk=messages[0].pk).text, 'message 0')
+
 
 class GenericViewTests(TestCase):
 
@@ -639,6 +721,23 @@ class MessageViewTest(TestCase):
 			self.assertTrue(false, "error with message post")
 		self.assertTrue(Message.objects.get(pk=rdata['id']).text == msg.text)
 
+	def testPostWrites(self):
+		''' A new message is added to its conversation with a single row write
+		'''
+		login(self.client, user=self.user, password='work')
+		with CaptureQueriesContext(connection) as queries:
+			response = self.client.post(reverse('chat:api:message-create',
+				args=(self.conversation.pk, )), data=json.dumps({'text' : 'new message'}),
+				content_type='application/json')
+		writes = [query['sql'] for query in queries
+			if re.search('(INSERT INTO|UPDATE|DELETE FROM) "chat_(message|conversation)', query['sql'])]
+		self.assertEquals(len(writes), 1)
+		self.assertIn('INSERT INTO "chat_message"', writes[0])
+
+		message = Message.objects.get(pk=json.loads(response.content)['id'])
+		self.assertEquals(message.conversation, self.conversation)
+		self.assertEquals(message.sender, self.user)
+
 	def testPostFailure(self):
 		'''
 			test unsuccessful Message creation - id already taken
@@ -663,6 +762,60 @@ class MessageViewTest(TestCase):
 		self.assertEquals(count, len(Message.objects.all()))
 
 
+	def pageOf(self, **params):
+		response = self.client.get(reverse('chat:api:message-create',
+			args=(self.conversation.pk, )), params)
+		self.assertEquals(response.status_code, 200)
+		return ([message['id'] for message in json.loads(response.content)],
+			response.get('X-Cursor-Before'), response.get('X-Cursor-After'))
+
+	def testGetPages(self):
+		''' Message history is paged through with cursors, oldest message first, and
+			messages sharing a timestamp are neither skipped nor repeated
+		'''
+		start = datetime.datetime(2014, 1, 1)
+		for i in xrange(8):
+			message = Message(sender=self.user, text='message %d' % i,
+				timestamp=start + datetime.timedelta(seconds=i // 2))
+			message.save()
+			self.conversation.messages.add(message)
+		history = [message.pk for message in self.conversation.messages.order_by('timestamp', 'id')]
+		# Messages without a timestamp are never paged
+		undated = Message(sender=self.user, text='undated', timestamp=None)
+		undated.save()
+		self.conversation.messages.add(undated)
+		login(self.client, user=self.user)
+
+		ids, before, after = self.pageOf(limit=3)
+		self.assertEquals(ids, history[-3:])
+		pages = [ids]
+		while before:
+			ids, before, ignored = self.pageOf(limit=3, before=before)
+			pages.insert(0, ids)
+		self.assertEquals(sum(pages, []), history)
+		self.assertEquals(map(len, pages), [1, 3, 3, 3])
+		self.assertEquals(self.pageOf(limit=20)[0], history)
+
+		ids, ignored, after = self.pageOf(limit=4, after=self.pageOf(limit=3)[1])
+		self.assertEquals(ids, history[-2:])
+		self.assertEquals(self.pageOf(after=after), ([], None, after))
+
+		# The conversation view pages the same way
+		response = self.client.get(reverse('chat:api:conversation-rest',
+			args=(self.conversation.pk, )), {'limit' : 2})
+		self.assertEquals([message['id'] for message in json.loads(response.content)],
+			history[-2:])
+
+	def testGetPageErrors(self):
+		''' Invalid cursors and limits are rejected
+		'''
+		login(self.client, user=self.user)
+		url = reverse('chat:api:message-create', args=(self.conversation.pk, ))
+		for params in ({'before' : 'not a cursor'}, {'after' : 'YWJj'}, {'limit' : 0},
+				{'limit' : 'all'}, {'limit' : 10000}):
+			self.assertEquals(self.client.get(url, params).status_code, 400)
+
+
 class ConversationViewTests(TestCase):
 	def __init__(self, *args, **kwargs):
 		self.factory = RequestFactory()
@@ -793,6 +946,678 @@ class ConversationViewTests(TestCase):
 		self.assertEquals(count - 1, len(Conversation.objects.all()))
 		self.assertEquals(response.status_code, 200)
 
+	def listingQueries(self, count):
+		''' Create conversations until the user has count of them, and return the
+			number of queries taken to list them with the listing
+		'''
+		other = User.objects.get_or_create(username='other')[0]
+		while Conversation.objects.filter(participants=self.user).count() < count:
+			conversation = Conversation()
+			conversation.save()
+			conversation.participants.add(self.user, other)
+			message = Message(sender=other, text='hello')
+			message.save()
+			conversation.messages.add(message)
+		with CaptureQueriesContext(connection) as queries:
+			response = self.client.get(reverse('chat:api:conversation-create'))
+		return len(queries), json.loads(response.content)
+
+	def testListQueries(self):
+		''' Listing conversations takes the same number of queries however many
+			conversations there are, and gives the same data as conversation_data did
+		'''
+		login(self.client, user=self.user, password='work')
+		few, listing = self.listingQueries(3)
+		many, listing = self.listingQueries(30)
+		self.assertEquals(few, many)
+		self.assertEquals(len(listing), 30)
+
+		for cdata in listing:
+			conversation = Conversation.objects.get(pk=cdata['id'])
+			expected = model_to_dict(conversation)
+			expected['participants'] = map(views.user_data, conversation.participants.all())
+			expected['messages'] = [message.pk for message in conversation.messages.all()]
+			self.assertEquals(sorted(cdata['participants']), sorted(expected['participants']))
+			self.assertEquals(cdata['messages'], expected['messages'])
+			self.assertEquals(sorted(cdata.keys()), sorted(expected.keys()))
+
+	def testPushBatches(self):
+		''' Creating and deleting a conversation each write a single batch of control
+			requests to the outbox
+		'''
+		login(self.client, user=self.user, password='work')
+		other = User.objects.create_user(username='other', password='work')
+		response = self.client.post(reverse('chat:api:conversation-create'),
+			data=json.dumps({'participants' : [username, 'other']}),
+			content_type='application/json')
+		cid = json.loads(response.content)['id']
+		self.client.delete(reverse('chat:api:conversation-rest', args=(cid, )))
+
+		sent = [event.request() for event in OutboxEvent.objects.all()]
+		self.assertEquals(len(sent), 2)
+		self.assertEquals([rdata['opcode'] for rdata in sent[0]['events']],
+			['room-join', 'conversation-create', 'presence-contacts'])
+		self.assertEquals(sent[0]['events'][1]['topic'], 'conversation:%s' % cid)
+		self.assertEquals(sorted(sent[0]['events'][2]['message']['other']), [username])
+		self.assertEquals([rdata['opcode'] for rdata in sent[1]['events']],
+			['conversation-delete', 'room-delete', 'presence-contacts'])
+		self.assertEquals(sent[1]['events'][2]['message']['other'], [])
+
+	def testPushRolledBack(self):
+		''' A change which fails leaves nothing in the outbox
+		'''
+		login(self.client, user=self.user, password='work')
+		conversations = Conversation.objects.count()
+		with CaptureQueriesContext(connection) as queries:
+			response = self.client.post(reverse('chat:api:conversation-create'),
+				data=json.dumps({'participants' : [username, 'nobody']}),
+				content_type='application/json')
+		self.assertEquals(response.status_code, 400)
+		# The unknown participant is found before anything is written
+		self.assertFalse([query for query in queries.captured_queries
+			if 'INSERT' in query['sql'] or 'DELETE' in query['sql']])
+		self.assertEquals(Conversation.objects.count(), conversations)
+		self.assertEquals(OutboxEvent.objects.count(), 0)
+
+		try:
+			with transaction.atomic():
+				views.BaseView().pushData('message-create', topic='conversation:x')
+				raise IntegrityError('write failed')
+		except IntegrityError: pass
+		self.assertEquals(OutboxEvent.objects.count(), 0)
+
+class RelayViewTests(TestCase):
+	def setUp(self):
+		self.users = {}
+		for name in ('alice', 'bob', 'carol', 'dave'):
+			self.users[name] = User.objects.create_user(username=name, password='work')
+		# alice talks with bob and carol, dave talks with nobody
+		for names in (('alice', 'bob'), ('alice', 'bob', 'carol')):
+			conversation = Conversation()
+			conversation.save()
+			for name in names: conversation.participants.add(self.users[name])
+
+	def testUserContacts(self):
+		''' Contacts are the other participants of a user's conversations, once each
+		'''
+		self.assertEquals(sorted(user_contacts('alice')), ['bob', 'carol'])
+		self.assertEquals(sorted(user_contacts('carol')), ['alice', 'bob'])
+		self.assertEquals(user_contacts('dave'), [])
+
+	@override_settings(RELAY_TOKEN='secret')
+	def testContactsRequiresToken(self):
+		''' Only the message relay may ask for a user's contacts
+		'''
+		url = reverse('chat:api:presence-contacts')
+		self.assertEquals(self.client.get(url, {'user' : 'alice'}).status_code, 403)
+		self.assertEquals(self.client.get(url, {'user' : 'alice'},
+			HTTP_X_RELAY_TOKEN='wrong').status_code, 403)
+
+	@override_settings(RELAY_TOKEN='secret')
+	def testContactsSuccess(self):
+		''' The relay receives the contacts of the user it asked for
+		'''
+		response = self.client.get(reverse('chat:api:presence-contacts'), {'user' : 'bob'},
+			HTTP_X_RELAY_TOKEN='secret')
+		self.assertEquals(response.status_code, 200)
+		rdata = json.loads(response.content)
+		self.assertEquals(rdata['user'], 'bob')
+		self.assertEquals(sorted(rdata['contacts']), ['alice', 'carol'])
+
+	@override_settings(RELAY_TOKEN='secret')
+	def testRelayRooms(self):
+		''' The relay can load the participants of every conversation
+		'''
+		url = reverse('chat:api:relay-rooms')
+		self.assertEquals(self.client.get(url).status_code, 403)
+		response = self.client.get(url, HTTP_X_RELAY_TOKEN='secret')
+		rooms = json.loads(response.content)['rooms']
+		self.assertEquals(sorted(sorted(participants) for participants in rooms.values()),
+			[['alice', 'bob'], ['alice', 'bob', 'carol']])
+		for conversation in Conversation.objects.all():
+			self.assertEquals(sorted(rooms[conversation.pk]),
+				sorted(user.username for user in conversation.participants.all()))
+
+
+class RelayClientTests(TestCase):
+	''' Persistent control channel client, against a relay stand-in which checks the
+		handshake, records the requests it receives and closes each connection after
+		closeAfter frames
+	'''
+
+	def setUp(self):
+		self.server = socket.socket()
+		self.server.bind(('127.0.0.1', 0))
+		self.server.listen(5)
+		self.requests = []
+		self.accepted = 0
+		self.closeAfter = None
+		self.thread = threading.Thread(target=self.serve)
+		self.thread.daemon = True
+		self.thread.start()
+		self.client = RelayClient(self.server.getsockname(), 'secret', pool_size=2, timeout=2)
+
+	def tearDown(self):
+		self.client.close()
+		self.server.close()
+
+	def serve(self):
+		while True:
+			try: sock, address = self.server.accept()
+			except socket.error: return
+			self.accepted += 1
+			connection = RelayConnection.__new__(RelayConnection)
+			connection.sock = sock
+			try:
+				handshake = json.loads(connection.receive())
+				if handshake != {'opcode' : 'control-auth', 'token' : 'secret'}:
+					connection.send(json.dumps({'status' : 'fail', 'error' : 'Invalid relay token'}))
+					raise socket.error('invalid token')
+				connection.send(json.dumps({'status' : 'success'}))
+				for count in xrange(self.closeAfter or 1000):
+					rdata = json.loads(connection.receive())
+					self.requests.append(rdata)
+					if 'ack' in rdata:
+						connection.send(json.dumps({'ack' : rdata['ack'], 'status' : 'success'}))
+			except socket.error: pass
+			connection.close()
+
+	def testPipelinedSends(self):
+		''' Requests without acks share one connection and arrive in order
+		'''
+		for i in xrange(5): self.client.send({'opcode' : 'message-create', 'n' : i})
+		response = self.client.send({'opcode' : 'message-create', 'n' : 5}, ack=True)
+		self.assertEquals(response['status'], 'success')
+		self.assertEquals([rdata['n'] for rdata in self.requests], range(6))
+		self.assertEquals(self.accepted, 1)
+
+	def testReconnect(self):
+		''' Connections closed by the relay are replaced
+		'''
+		self.closeAfter = 1
+		for i in xrange(3):
+			response = self.client.send({'opcode' : 'message-create', 'n' : i}, ack=True)
+			self.assertEquals(response['ack'], i + 1)
+		self.assertEquals([rdata['n'] for rdata in self.requests], range(3))
+		self.assertEquals(self.accepted, 3)
+
+	def testRefusedToken(self):
+		''' A connection whose token the relay refuses sends nothing
+		'''
+		client = RelayClient(self.server.getsockname(), 'wrong', timeout=2)
+		self.assertRaises(OperationError, client.send, {'opcode' : 'message-create', 'n' : 0})
+		self.assertEquals(self.requests, [])
+
+	def testDevelopmentToken(self):
+		''' The development token is refused unless DEBUG is on
+		'''
+		with override_settings(RELAY_TOKEN=relay.DEVELOPMENT_TOKEN, DEBUG=False):
+			self.assertRaises(ImproperlyConfigured, relay.relay_token)
+		with override_settings(RELAY_TOKEN=relay.DEVELOPMENT_TOKEN, DEBUG=True):
+			self.assertEquals(relay.relay_token(), relay.DEVELOPMENT_TOKEN)
+		with override_settings(RELAY_TOKEN=''):
+			self.assertRaises(ImproperlyConfigured, relay.relay_token)
+
+
+class RelayDispatcherTests(TestCase):
+	''' Background delivery of control requests, with a stand-in for the relay which
+		fails a given number of deliveries before accepting them
+	'''
+
+	def setUp(self):
+		self.sent = []
+		self.failures = 0
+		self.gate = threading.Event()
+		self.gate.set()
+
+	def send(self, rdata):
+		self.gate.wait()
+		if self.failures:
+			self.failures -= 1
+			raise socket.error('relay unavailable')
+		self.sent.append(rdata)
+
+	def testBatching(self):
+		''' Requests queued close together are delivered as one batch, in order
+		'''
+		dispatcher = RelayDispatcher(self.send, batch_delay=0.2)
+		for i in xrange(5): dispatcher.push({'opcode' : 'message-create', 'n' : i})
+		dispatcher.push({'events' : [{'opcode' : 'room-join'}, {'opcode' : 'presence-contacts'}]})
+		self.assertTrue(dispatcher.flush())
+		self.assertEquals(len(self.sent), 1)
+		self.assertEquals([event.get('n', event['opcode']) for event in self.sent[0]['events']],
+			[0, 1, 2, 3, 4, 'room-join', 'presence-contacts'])
+		metrics = dispatcher.metrics()
+		self.assertEquals((metrics['enqueued'], metrics['delivered'], metrics['depth']), (7, 7, 0))
+
+	def testRetry(self):
+		''' Failed deliveries are retried with backoff, then dropped
+		'''
+		self.failures = 2
+		dispatcher = RelayDispatcher(self.send, retry_limit=2, retry_backoff=0.01)
+		dispatcher.push({'opcode' : 'message-create'})
+		self.assertTrue(dispatcher.flush())
+		self.assertEquals(self.sent, [{'opcode' : 'message-create'}])
+		self.assertEquals(dispatcher.metrics()['retries'], 2)
+
+		self.failures = 3
+		dispatcher.push({'opcode' : 'message-create'})
+		self.assertTrue(dispatcher.flush())
+		self.assertEquals(len(self.sent), 1)
+		self.assertEquals(dispatcher.metrics()['dropped'], 1)
+
+	def testDropPolicies(self):
+		''' A full queue drops the newest or the oldest request, without blocking
+		'''
+		for policy, kept in ((DROP_NEWEST, [0, 1]), (DROP_OLDEST, [0, 3])):
+			self.sent = []
+			self.gate.clear()
+			dispatcher = RelayDispatcher(self.send, queue_size=1, policy=policy, batch_delay=0)
+			dispatcher.push({'n' : 0})
+			# Wait for the worker to take the first request and block on the relay
+			while dispatcher.queue.qsize(): time.sleep(0.001)
+			started = time.time()
+			for i in xrange(1, 4): dispatcher.push({'n' : i})
+			self.assertTrue(time.time() - started < 0.1)
+			self.gate.set()
+			self.assertTrue(dispatcher.flush())
+			self.assertEquals([rdata['n'] for rdata in self.sent], kept)
+			self.assertEquals(dispatcher.metrics()['dropped'], 2)
+
+
+class OutboxDispatcherTests(TestCase):
+	''' Delivery of outbox events, with a stand-in for the relay which fails a given
+		number of deliveries before accepting them
+	'''
+
+	def setUp(self):
+		self.sent = []
+		self.failures = 0
+
+	def send(self, rdata):
+		if self.failures:
+			self.failures -= 1
+			raise socket.error('relay unavailable')
+		self.sent.append(rdata)
+
+	def sentNumbers(self):
+		numbers = []
+		for rdata in self.sent:
+			numbers.extend(event['n'] for event in rdata.get('events', [rdata]))
+		return numbers
+
+	def testBatches(self):
+		''' Events are sent in order, in batches, and the high-water mark follows them
+		'''
+		events = [outbox_push({'opcode' : 'message-create', 'n' : i}) for i in xrange(5)]
+		dispatcher = OutboxDispatcher(self.send, batch_size=2)
+		self.assertEquals([dispatcher.dispatch() for i in xrange(4)], [2, 2, 1, 0])
+		self.assertEquals(self.sentNumbers(), range(5))
+		self.assertEquals(OutboxCursor.objects.get(name='relay').position, events[-1].id)
+		self.assertEquals(outbox_metrics()['pending'], 0)
+
+	def testRelayDown(self):
+		''' Events the relay did not acknowledge stay in the outbox and are sent later
+		'''
+		outbox_push({'opcode' : 'message-create', 'n' : 0})
+		dispatcher = OutboxDispatcher(self.send)
+		self.failures = 1
+		self.assertRaises(socket.error, dispatcher.dispatch)
+		self.assertEquals(outbox_metrics()['pending'], 1)
+		outbox_push({'opcode' : 'message-create', 'n' : 1})
+		self.assertEquals(dispatcher.dispatch(), 2)
+		self.assertEquals(self.sentNumbers(), [0, 1])
+
+	def testGap(self):
+		''' A missing id holds back later events until it times out
+		'''
+		first = outbox_push({'opcode' : 'message-create', 'n' : 0})
+		OutboxEvent.objects.create(id=first.id + 2, payload=json.dumps({'n' : 2}))
+		dispatcher = OutboxDispatcher(self.send, gap_timeout=0.05)
+		self.assertEquals(dispatcher.dispatch(), 1)
+		self.assertEquals(dispatcher.dispatch(), 0)
+		time.sleep(0.05)
+		self.assertEquals(dispatcher.dispatch(), 1)
+		self.assertEquals(self.sentNumbers(), [0, 2])
+
+	def testLateCommit(self):
+		''' Every skipped id is counted, and a skipped event committed later is still
+			sent, before pruning can delete it
+		'''
+		first = outbox_push({'opcode' : 'message-create', 'n' : 0})
+		OutboxEvent.objects.create(id=first.id + 3, payload=json.dumps({'n' : 3}))
+		dispatcher = OutboxDispatcher(self.send, gap_timeout=0, retention=0)
+		self.assertEquals(dispatcher.dispatch(), 2)
+		self.assertEquals(dispatcher.metrics()['skipped'], 2)
+		OutboxEvent.objects.create(id=first.id + 2, payload=json.dumps({'n' : 2}))
+		OutboxEvent.objects.update(created=datetime.datetime.utcnow() - datetime.timedelta(hours=1))
+		dispatcher.prune()
+		self.assertEquals(self.sentNumbers(), [0, 3, 2])
+		metrics = dispatcher.metrics()
+		self.assertEquals((metrics['late'], metrics['rechecking']), (1, 1))
+		dispatcher.late_timeout = 0
+		self.assertEquals(dispatcher.dispatch(), 0)
+		self.assertEquals(dispatcher.metrics()['rechecking'], 0)
+
+	def testLease(self):
+		''' Only one dispatcher sends events, until it releases its lease
+		'''
+		outbox_push({'opcode' : 'message-create', 'n' : 0})
+		first, second = OutboxDispatcher(self.send), OutboxDispatcher(self.send)
+		self.assertEquals(first.dispatch(), 1)
+		outbox_push({'opcode' : 'message-create', 'n' : 1})
+		self.assertEquals(second.dispatch(), None)
+		first.release()
+		self.assertEquals(second.dispatch(), 1)
+		self.assertEquals(self.sentNumbers(), [0, 1])
+
+	def testReplay(self):
+		''' Rewinding sends events again, and pruning keeps the event at the mark
+		'''
+		for i in xrange(3): outbox_push({'opcode' : 'message-create', 'n' : i})
+		dispatcher = OutboxDispatcher(self.send, retention=0)
+		dispatcher.dispatch()
+		OutboxEvent.objects.update(created=datetime.datetime.utcnow() - datetime.timedelta(hours=1))
+		dispatcher.rewind(datetime.datetime.utcnow() - datetime.timedelta(hours=2))
+		self.assertEquals(dispatcher.dispatch(), 3)
+		self.assertEquals(self.sentNumbers(), [0, 1, 2, 0, 1, 2])
+		self.assertEquals(dispatcher.prune(), 2)
+		self.assertEquals(OutboxEvent.objects.count(), 1)
+
+
+class RecordingGroupCommit(ingest.GroupCommit):
+	''' Group commit recording its groups instead of writing them. The first commit
+		waits until the other writers have queued their messages.
+	'''
+
+	def __init__(self, writers, *args, **kwargs):
+		super(RecordingGroupCommit, self).__init__(*args, **kwargs)
+		self.writers = writers
+		self.groups = []
+
+	def commit(self, group):
+		if not self.groups:
+			while len(self.pending) < self.writers - 1: time.sleep(0.001)
+		self.groups.append([item.message.text for item in group])
+		for item in group: item.done = True
+
+
+class GroupCommitTests(TestCase):
+	''' Messages of concurrent requests inserted in shared transactions
+	'''
+
+	def setUp(self):
+		self.user = User.objects.create_user(username='alice', password='work')
+		self.conversation = Conversation()
+		self.conversation.save()
+
+	def message(self, text):
+		return Message(text=text, sender=self.user, conversation=self.conversation)
+
+	def request(self, n):
+		return {'opcode' : 'message-create', 'n' : n,
+			'topic' : views.conversation_topic(self.conversation)}
+
+	def testGroup(self):
+		''' A group is inserted with a single statement, with its relay requests in the
+			same transaction, linked to the previous events of the conversation
+		'''
+		writer = ingest.GroupCommit()
+		first = outbox_push(self.request(-1))
+		group = [ingest.PendingMessage(self.message('message %d' % i), self.request(i))
+			for i in range(3)]
+		with CaptureQueriesContext(connection) as queries:
+			writer.commit(group)
+		inserts = [query['sql'] for query in queries if 'INSERT INTO "chat_message"' in query['sql']]
+		self.assertEquals(len(inserts), 1)
+		self.assertTrue(all(item.done and item.error is None for item in group))
+		self.assertEquals(self.conversation.messages.count(), 3)
+
+		events = list(OutboxEvent.objects.filter(pk__gt=first.pk))
+		self.assertEquals([event.request()['n'] for event in events], [0, 1, 2])
+		self.assertEquals([event.previous for event in events],
+			[first.pk] + [event.pk for event in events[:-1]])
+
+	def testFailure(self):
+		''' When a group fails, its messages are committed one by one and only the
+			failing one is rolled back
+		'''
+		# Requests which cannot be serialized fail to be pushed
+		fail = {'opcode' : 'message-create', 'n' : object()}
+		writer = ingest.GroupCommit()
+		group = [ingest.PendingMessage(self.message('message %d' % i),
+			fail if i == 1 else self.request(i)) for i in range(3)]
+		writer.commit(group)
+		self.assertEquals([type(item.error) for item in group], [type(None), TypeError, type(None)])
+		self.assertEquals(sorted(self.conversation.messages.values_list('text', flat=True)),
+			['message 0', 'message 2'])
+		self.assertEquals([event.request()['n'] for event in OutboxEvent.objects.all()], [0, 2])
+
+		self.assertRaises(TypeError, writer.write, self.message('message 3'), fail)
+		self.assertEquals(self.conversation.messages.count(), 2)
+
+	def testConcurrent(self):
+		''' Messages queued while a commit is running are committed together by one
+			of the waiting writers
+		'''
+		writer = RecordingGroupCommit(10, delay=0)
+		threads = [threading.Thread(target=writer.write, args=(Message(text=str(i)), ))
+			for i in range(10)]
+		threads[0].start()
+		while not writer.committing: time.sleep(0.001)
+		for thread in threads[1:]: thread.start()
+		for thread in threads: thread.join(5)
+		self.assertEquals(map(len, writer.groups), [1, 9])
+		self.assertEquals(sorted(sum(writer.groups, []), key=int), map(str, range(10)))
+
+	def testFollowersFail(self):
+		''' Writers whose group fails before it is inserted are told so, rather than
+			waiting forever for a commit which already happened
+		'''
+		class UnidentifiedMessage(object):
+			id = None
+			def generateMessageId(self): raise RuntimeError('no id')
+
+		class BlockingGroupCommit(ingest.GroupCommit):
+			def commit(self, group):
+				while not self.commits and len(self.pending) < 2: time.sleep(0.001)
+				super(BlockingGroupCommit, self).commit(group)
+
+		writer = BlockingGroupCommit(delay=0)
+		errors = []
+		def write():
+			try: writer.write(UnidentifiedMessage())
+			except Exception as err: errors.append(err)
+		threads = [threading.Thread(target=write) for i in range(3)]
+		for thread in threads: thread.daemon = True
+		threads[0].start()
+		while not writer.committing: time.sleep(0.001)
+		for thread in threads[1:]: thread.start()
+		for thread in threads: thread.join(5)
+		self.assertFalse(any(thread.is_alive() for thread in threads))
+		self.assertEquals(map(type, errors), [RuntimeError] * 3)
+		self.assertEquals(writer.commits, 2)
+		self.assertEquals(writer.written, 0)
+
+
+class MembershipTests(TestCase):
+	''' Participant membership checks, and the invalidation of their cache
+	'''
+
+	def setUp(self):
+		cache.clear()
+		membership.start_request(None)
+		self.alice = User.objects.create_user(username='alice', password='work')
+		self.bob = User.objects.create_user(username='bob', password='work')
+		self.conversation = Conversation()
+		self.conversation.save()
+		self.conversation.participants.add(self.alice)
+
+	def assertMember(self, user, member=True):
+		membership.start_request(None)
+		self.assertEquals(membership.is_participant(self.conversation, user), member)
+
+	def testCached(self):
+		''' Answers are kept for the rest of the request and across requests
+		'''
+		with self.assertNumQueries(2):
+			self.assertTrue(membership.is_participant(self.conversation, self.alice))
+			self.assertFalse(membership.is_participant(self.conversation.pk, self.bob.pk))
+			self.assertFalse(membership.is_participant(self.conversation, self.bob))
+		with self.assertNumQueries(0):
+			self.assertTrue(membership.is_participant(self.conversation, self.alice))
+			self.assertMember(self.alice)
+		with override_settings(MEMBERSHIP_CACHE_TTL=0), self.assertNumQueries(1):
+			self.assertMember(self.alice)
+
+	def testInvalidated(self):
+		''' Cached answers are dropped when the participants change
+		'''
+		self.assertMember(self.bob, False)
+		self.conversation.participants.add(self.bob)
+		self.assertMember(self.bob)
+		self.conversation.participants.remove(self.bob)
+		self.assertMember(self.bob, False)
+		self.bob.conversation_set.add(self.conversation)
+		self.assertMember(self.bob)
+		self.bob.conversation_set.clear()
+		self.assertMember(self.bob, False)
+		self.assertMember(self.alice)
+		self.conversation.participants.clear()
+		self.assertMember(self.alice, False)
+
+		self.conversation.participants.add(self.alice)
+		self.assertMember(self.alice)
+		self.conversation.delete()
+		self.assertMember(self.alice, False)
+
+	def testLargeConversation(self):
+		''' Posting to a conversation does not read its participants
+		'''
+		users = [User(username='member%d' % i) for i in range(500)]
+		User.objects.bulk_create(users)
+		self.conversation.participants.add(*User.objects.filter(username__startswith='member'))
+		login(self.client, user=self.alice, password='work')
+		cache.clear()
+
+		with CaptureQueriesContext(connection) as queries:
+			response = self.client.post(reverse('chat:api:message-create',
+				args=(self.conversation.pk, )), data=json.dumps({'text' : 'hello'}),
+				content_type='application/json')
+		self.assertEquals(response.status_code, 200)
+		participants = [query['sql'] for query in queries
+			if 'chat_conversation_participants' in query['sql']]
+		self.assertEquals(len(participants), 1)
+		self.assertIn('LIMIT 1', participants[0])
+
+
+class SyncTests(TestCase):
+	''' Delta sync of the changes to a user's conversations, read from the outbox
+	'''
+
+	def setUp(self):
+		for name in ('alice', 'bob', 'carol'):
+			User.objects.create_user(username=name, password='work')
+		login(self.client, user=User.objects.get(username='alice'), password='work')
+
+	def createConversation(self, *participants):
+		response = self.client.post(reverse('chat:api:conversation-create'),
+			data=json.dumps({'participants' : list(participants)}), content_type='application/json')
+		return json.loads(response.content)['id']
+
+	def createMessage(self, cid, text):
+		response = self.client.post(reverse('chat:api:message-create', args=(cid, )),
+			data=json.dumps({'text' : text}), content_type='application/json')
+		return json.loads(response.content)['id']
+
+	def sync(self, **params):
+		response = self.client.get(reverse('chat:api:sync'), params)
+		self.assertEquals(response.status_code, 200)
+		return json.loads(response.content)
+
+	def testChanges(self):
+		''' Only changes after the cursor to the user's own conversations are returned,
+			with deletions as tombstones
+		'''
+		old = self.createConversation('alice', 'bob')
+		self.createMessage(old, 'before the cursor')
+		changes = self.sync()
+		self.assertTrue(changes['reset'])
+		cursor = changes['cursor']
+
+		kept = self.createMessage(old, 'kept')
+		deleted = self.createMessage(old, 'deleted')
+		self.client.delete(reverse('chat:api:message-rest', args=(old, deleted)))
+		new = self.createConversation('alice', 'carol')
+		gone = self.createConversation('alice', 'bob')
+		self.createMessage(gone, 'in a deleted conversation')
+		self.client.delete(reverse('chat:api:conversation-rest', args=(gone, )))
+		# A conversation alice is not in
+		login(self.client, user=User.objects.get(username='bob'), password='work')
+		self.createConversation('bob', 'carol')
+
+		login(self.client, user=User.objects.get(username='alice'), password='work')
+		changes = self.sync(cursor=cursor)
+		self.assertFalse(changes['reset'])
+		self.assertEquals([cdata['id'] for cdata in changes['conversations']], [new])
+		self.assertEquals([(mdata['cid'], mdata['message']['id']) for mdata in changes['messages']],
+			[(old, kept)])
+		self.assertEquals([(tombstone['type'], tombstone['id']) for tombstone in changes['tombstones']],
+			[('message', deleted), ('conversation', gone)])
+		self.assertEquals(self.sync(cursor=changes['cursor'])['messages'], [])
+
+		# Bob was a participant of the deleted conversation, carol was not
+		login(self.client, user=User.objects.get(username='bob'), password='work')
+		self.assertEquals([tombstone['id'] for tombstone in self.sync(cursor=cursor)['tombstones']],
+			[deleted, gone])
+		login(self.client, user=User.objects.get(username='carol'), password='work')
+		self.assertEquals(self.sync(cursor=cursor)['tombstones'], [])
+
+	def testPages(self):
+		''' Long runs of changes are read a page at a time
+		'''
+		cursor = self.sync()['cursor']
+		cid = self.createConversation('alice', 'bob')
+		messages = [self.createMessage(cid, 'message %d' % i) for i in xrange(5)]
+		changes = self.sync(cursor=cursor, limit=4)
+		self.assertTrue(changes['more'])
+		rest = self.sync(cursor=changes['cursor'], limit=4)
+		self.assertFalse(rest['more'])
+		self.assertEquals([mdata['message']['id'] for mdata in changes['messages'] + rest['messages']],
+			messages)
+
+	def testReset(self):
+		''' Clients are told to reload when the changes after their cursor are gone
+		'''
+		cid = self.createConversation('alice', 'bob')
+		cursor = self.sync()['cursor']
+		self.createMessage(cid, 'pruned')
+		self.createMessage(cid, 'kept')
+		OutboxEvent.objects.filter(id__lte=cursor + 1).delete()
+		self.assertTrue(self.sync(cursor=cursor)['reset'])
+		self.assertTrue(self.sync(cursor=cursor + 100)['reset'])
+		self.assertEquals(self.client.get(reverse('chat:api:sync'), {'cursor' : 'x'}).status_code, 400)
+
+	def testRelayCursors(self):
+		''' Messages published by the relay carry their outbox id as the sync cursor,
+			and the id of the previous event of their conversation
+		'''
+		cid = self.createConversation('alice', 'bob')
+		first = self.createMessage(cid, 'first')
+		second = self.createMessage(cid, 'second')
+		sent = []
+		OutboxDispatcher(sent.append).dispatch()
+		published = [rdata for rdata in sent[0]['events'] if 'topic' in rdata]
+		self.assertEquals([rdata['opcode'] for rdata in published],
+			['conversation-create', 'message-create', 'message-create'])
+		self.assertEquals(published[0]['previous'], None)
+		self.assertEquals(published[1]['previous'], published[0]['cursor'])
+		self.assertEquals(published[2]['previous'], published[1]['cursor'])
+		self.assertEquals(self.sync(cursor=published[1]['cursor'])['messages'][0]['message']['id'],
+			second)
+		self.assertFalse(any('cursor' in rdata for rdata in sent[0]['events'] if 'topic' not in rdata))
+
+
 class TestFormValidation(TestCase):
 
 	def setUp(self):
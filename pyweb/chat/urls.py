@@ -3,7 +3,8 @@ from django.conf.urls import patterns, url, include
 
 from .views import UserAuthenticateView, UserCreateView, UserRestView, MessageCreateView, \
 	MessageRestView, ConversationCreateView, ConversationRestView, \
-	ProfileRestView, logout
+	ProfileRestView, PresenceContactsView, RelayRoomsView, SyncView, \
+	RelayMetricsView, logout
 	
 
 # Provides URLs to API endpoints
@@ -18,6 +19,9 @@ api_urlpatterns = patterns('',
 	url(r'^conversation/(?P<cpk>\w+)/message/$', MessageCreateView.as_view(),
 		name='message-create'),
 
+	# Changes to the user's conversations since a cursor
+	url(r'^sync/$', SyncView.as_view(), name='sync'),
+
 	# User REST URLs
 	url(r'^user/(?P<pk>\d+)/$', UserRestView.as_view(), name='user-rest'),
     url(r'^user/$', UserCreateView.as_view(), name='user-create'),
@@ -25,6 +29,13 @@ api_urlpatterns = patterns('',
 	# User Authentication View
 	url(r'^login/', UserAuthenticateView.as_view(), name='user-authenticate'),
 
+	# Contacts of a user, for the message relay
+	url(r'^presence/contacts/$', PresenceContactsView.as_view(), name='presence-contacts'),
+	# Participants of every conversation, for the message relay
+	url(r'^relay/rooms/$', RelayRoomsView.as_view(), name='relay-rooms'),
+	# Delivery queue metrics of the control requests sent to the relay
+	url(r'^relay/metrics/$', RelayMetricsView.as_view(), name='relay-metrics'),
+
 	# Profile REST URLs
 	url(r'^user/(?P<pk>\w+)/profile/$', ProfileRestView.as_view(), name='profile-rest'),
 	url(r'^test/(?P<pk>\d+)$', ProfileRestView.as_view(), name='login-test')
@@ -2,9 +2,11 @@ import logging, traceback
 import datetime
 import uuid
 import json
-import urlparse, requests
 
 from django.conf import settings
+from django.db import transaction
+from django.db.models import Q, Min, Max
+from django.db.models.query import QuerySet
 from django.shortcuts import render, render_to_response
 
 from django.core import serializers
@@ -12,12 +14,13 @@ from django.core.exceptions import ValidationError
 from django.core.urlresolvers import reverse
 
 from django.http import HttpResponse, HttpResponseBadRequest, \
-	HttpResponseNotFound, HttpResponseRedirect
+	HttpResponseNotFound, HttpResponseRedirect, HttpResponseForbidden
 
 from django.contrib.auth import logout
 
 from django.views.generic import View
 from django.template import Context, loader, RequestContext
+from django.utils.crypto import constant_time_compare
 from django.utils.decorators import method_decorator
 
 from django.contrib.auth import authenticate, login
@@ -27,13 +30,17 @@ from django.contrib.auth.decorators import login_required
 
 from django.forms.models import model_to_dict
 
-from .helpers import DateTimeAwareEncoder, DateTimeAwareDecoder
+from .helpers import DateTimeAwareEncoder, DateTimeAwareDecoder, encode_cursor, decode_cursor
 
-from .models import Profile, Message, Conversation
+from .models import Profile, Message, Conversation, OutboxEvent, ConversationTombstone
 from .forms import UserForm, ProfileForm, MessageForm, \
 	UserCreateForm, ConversationCreateForm
 
 from .errors import OperationError
+from .relay import (relay_dispatcher, relay_token, push_requests, outbox_metrics,
+	CONVERSATION_TOPIC)
+from .membership import is_participant
+from .ingest import message_writer
 
 logger = logging.getLogger(__name__)
 
@@ -60,7 +67,7 @@ def message_data(cmessage):
 		consumed by Backbone.js models
 		1. Substitute user names for primary keys
 	'''
-	cmessage_data = model_to_dict(cmessage)
+	cmessage_data = model_to_dict(cmessage, exclude=('conversation', ))
 	if cmessage.sender:
 		cmessage_data['sender'] = user_data(cmessage.sender)
 	return cmessage_data
@@ -72,10 +79,179 @@ def conversation_data(conversation):
 		1. Substitute user information for primary keys
 		2. Substitute message data for message IDs
 	'''
-	conversation_data = model_to_dict(conversation)
-	conversation_data['participants'] = map(user_data, conversation.participants.all())
-	
-	return conversation_data
+	return conversations_data([conversation])[0]
+
+
+def conversations_data(conversations):
+	'''	Convert conversations to the format of conversation_data with a fixed number
+		of queries, however many conversations there are: one for the conversations,
+		one for all of their participants and one for all of their message ids.
+		@input conversations: Conversation queryset, or list of conversations
+		@return: List of conversation data, in the order of the conversations
+	'''
+	if isinstance(conversations, QuerySet):
+		keys = conversations.values('pk')
+		conversations = list(conversations)
+	else:
+		conversations = list(conversations)
+		keys = [conversation.pk for conversation in conversations]
+	if not conversations: return []
+
+	participants, messages = {}, {}
+	for cid, username, first_name, last_name in Conversation.participants.through.objects \
+			.filter(conversation__in=keys).order_by('id') \
+			.values_list('conversation_id', 'user__username', 'user__first_name', 'user__last_name'):
+		participants.setdefault(cid, []).append(user_data(User(username=username,
+			first_name=first_name, last_name=last_name)))
+	for cid, mid in Message.objects.filter(conversation__in=keys) \
+			.order_by('timestamp').values_list('conversation_id', 'id'):
+		messages.setdefault(cid, []).append(mid)
+
+	data = []
+	for conversation in conversations:
+		cdata = model_to_dict(conversation, exclude=('participants', ))
+		cdata['participants'] = participants.get(conversation.pk, [])
+		cdata['messages'] = messages.get(conversation.pk, [])
+		data.append(cdata)
+	return data
+
+
+def message_cursor(cmessage):
+	'''	Opaque cursor for the position of a message in its conversation
+	'''
+	return encode_cursor(cmessage.timestamp, cmessage.pk)
+
+
+def message_page(conversation, before=None, after=None, limit=None):
+	'''	One page of the messages of a conversation, oldest first. Pages are found by
+		keyset pagination on (timestamp, id), so the cost of a page does not depend on
+		how far back it is. Without a cursor the most recent messages are returned.
+		Messages without a timestamp have no place in that order and no cursor, so
+		they are left out of every page; new messages are always given one.
+		@input before (string, default=None): Cursor; return the messages just before it
+		@input after (string, default=None): Cursor; return the messages just after it
+		@input limit (default=MESSAGE_PAGE_SIZE): Most messages returned, at most
+			MESSAGE_PAGE_MAX
+		@return: (messages, cursors) where cursors holds a "before" cursor if there are
+			older messages, and an "after" cursor to ask for newer ones
+		@raise ValueError if a cursor or the limit is not valid
+	'''
+	if limit is None: limit = getattr(settings, 'MESSAGE_PAGE_SIZE', 50)
+	limit = int(limit)
+	if not 0 < limit <= getattr(settings, 'MESSAGE_PAGE_MAX', 200):
+		raise ValueError('Invalid limit: %s' % limit)
+
+	# Left out explicitly: timestamp < x and timestamp > x are both false for NULL,
+	# so they would otherwise only turn up on the first page, depending on the
+	# database's NULL ordering
+	messages = conversation.messages.exclude(timestamp__isnull=True).select_related('sender')
+	if after is not None:
+		timestamp, pk = decode_cursor(after)
+		messages = messages.filter(Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, pk__gt=pk))
+		page = list(messages.order_by('timestamp', 'id')[:limit])
+		cursors = {'after' : message_cursor(page[-1]) if page else after}
+		if page: cursors['before'] = message_cursor(page[0])
+		return page, cursors
+
+	if before is not None:
+		timestamp, pk = decode_cursor(before)
+		messages = messages.filter(Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, pk__lt=pk))
+	page = list(messages.order_by('-timestamp', '-id')[:limit + 1])
+	more, page = len(page) > limit, page[:limit]
+	page.reverse()
+	cursors = {}
+	if more: cursors['before'] = message_cursor(page[0])
+	if page: cursors['after'] = message_cursor(page[-1])
+	elif before is not None: cursors['after'] = before
+	return page, cursors
+
+
+def sync_changes(user, cursor=None, limit=None):
+	'''	Changes to the conversations of a user since a cursor, read from the outbox.
+		The cursor is the id of an outbox event, the same one the relay's messages
+		carry. Conversations and messages created since the cursor are returned with
+		their data, deleted ones as tombstones; something created and deleted since
+		then only gets a tombstone. Without a cursor, or when the events after it
+		have been pruned, the client has to reload everything and is told to reset.
+		@input cursor (default=None): Outbox id the client is up to date with
+		@input limit (default=SYNC_PAGE_SIZE): Most outbox events read, "more" is set
+			when there are more to read after the returned cursor
+		@return: dictionary holding cursor, reset, more, conversations, messages and
+			tombstones
+		@raise ValueError if the cursor or the limit is not valid
+	'''
+	if limit is None: limit = getattr(settings, 'SYNC_PAGE_SIZE', 500)
+	limit = int(limit)
+	if not 0 < limit <= getattr(settings, 'SYNC_PAGE_MAX', 5000):
+		raise ValueError('Invalid limit: %s' % limit)
+	if cursor is not None: cursor = int(cursor)
+
+	changes = { 'cursor' : cursor, 'reset' : False, 'more' : False,
+		'conversations' : [], 'messages' : [], 'tombstones' : [] }
+	bounds = OutboxEvent.objects.aggregate(first=Min('id'), last=Max('id'))
+	last = bounds['last'] or 0
+	if cursor is None or cursor > last or not getattr(settings, 'RELAY_OUTBOX', True) or \
+			(bounds['first'] is not None and cursor < bounds['first'] - 1):
+		changes.update(cursor=last, reset=True)
+		return changes
+
+	# Conversations the user is in, or was in when it was deleted after the cursor
+	conversations = Conversation.objects.filter(participants=user).values('id')
+	deleted = ConversationTombstone.objects.filter(user=user, event__gt=cursor) \
+		.values('conversation')
+	events = list(OutboxEvent.objects.filter(id__gt=cursor)
+		.filter(Q(conversation__in=conversations) | Q(conversation__in=deleted))
+		.order_by('id')[:limit + 1])
+	changes['more'], events = len(events) > limit, events[:limit]
+	if events: changes['cursor'] = events[-1].id
+
+	created, messages, tombstones = {}, {}, []
+	for event in events:
+		rdata = event.request()
+		for request in rdata.get('events', [rdata]):
+			opcode, pdata = request.get('opcode'), request.get('message') or {}
+			if opcode == 'conversation-create':
+				created[pdata['id']] = (event.id, pdata)
+			elif opcode == 'message-create':
+				messages[pdata['message']['id']] = (event.id, pdata)
+			elif opcode == 'conversation-delete' and 'cid' in pdata:
+				messages.pop(pdata['id'], None)
+				tombstones.append({ 'type' : 'message', 'cid' : pdata['cid'], 'id' : pdata['id'],
+					'cursor' : event.id })
+			elif opcode == 'conversation-delete':
+				created.pop(pdata['id'], None)
+				for mid, (ignored, mdata) in messages.items():
+					if mdata['cid'] == pdata['id']: del messages[mid]
+				tombstones.append({ 'type' : 'conversation', 'id' : pdata['id'],
+					'cursor' : event.id })
+
+	changes['conversations'] = [pdata for eid, pdata in sorted(created.values(),
+		key=lambda change: change[0])]
+	changes['messages'] = [pdata for eid, pdata in sorted(messages.values(),
+		key=lambda change: change[0])]
+	changes['tombstones'] = tombstones
+	return changes
+
+
+def conversation_topic(conversation):
+	'''	Message relay topic which publishes to the participants of a conversation
+	'''
+	return CONVERSATION_TOPIC + conversation.pk
+
+
+def relay_authorized(request):
+	'''	Check that a request comes from the message relay, which identifies itself
+		with the RELAY_TOKEN setting, compared in constant time
+	'''
+	return constant_time_compare(request.META.get('HTTP_X_RELAY_TOKEN', ''), relay_token())
+
+
+def user_contacts(username):
+	'''	Usernames of everyone sharing a conversation with a user. The message relay
+		only shows a user the presence of their contacts.
+	'''
+	return list(User.objects.filter(conversation__participants__username=username) \
+		.exclude(username=username).distinct().values_list('username', flat=True))
 
 
 
@@ -101,18 +277,60 @@ class BaseView(View):
 	def invalidRequest(self):
 		return HttpResponseBadRequest()
 
-	def pushData(self, opcode, recipients=[], pdata={}):
-		'''	Push data to a remote server
+	def messagePageResponse(self, request, conversation, data):
+		'''	Respond with the page of messages asked for by the before, after and limit
+			parameters, as a list of message data. The cursors of the neighbouring pages
+			are sent in the X-Cursor-Before and X-Cursor-After headers.
+			@input data: Function converting a message to the data returned
+		'''
+		try: messages, cursors = message_page(conversation, request.GET.get('before'),
+			request.GET.get('after'), request.GET.get('limit'))
+		except ValueError as err: return HttpResponseBadRequest(json.dumps(str(err)))
+		response = HttpResponse(json.dumps(map(data, messages), cls=DateTimeAwareEncoder),
+			content_type='application/json')
+		for name, cursor in cursors.iteritems(): response['X-Cursor-%s' % name.title()] = cursor
+		return response
+
+	def relayRequest(self, opcode, recipients=[], pdata={}, topic=None):
+		'''	Build a control request for the message relay
+			@input topic (default=None): Relay topic to publish to instead of listing
+				the recipients, such as the conversation_topic of a conversation
 		'''
 		rdata = { 'opcode' : opcode, 'recipients' : recipients }
 		rdata['message'] = pdata
+		if topic is not None: rdata['topic'] = topic
+		return rdata
 
-		control_url = urlparse.urlunparse((
-			getattr(settings, 'CONTROL_SCHEME', 'http'), 
-			':'.join([str(s) for s in (getattr(settings, 'MESSAGE_SERVER', 'localhost'), 
-				getattr(settings, 'MESSAGE_PORT', '1789')) if s is not None]),
-			'control', '', '', ''))
-		r = requests.post(control_url, data=json.dumps(rdata, cls=DateTimeAwareEncoder))
+	def contactsRequest(self, usernames):
+		'''	Control request giving the message relay the contacts of users whose
+			conversations have changed, so that it can update the presence they see
+		'''
+		return self.relayRequest('presence-contacts',
+			pdata=dict((username, user_contacts(username)) for username in usernames))
+
+	def pushData(self, opcode, recipients=[], pdata={}, topic=None):
+		'''	Push data to a remote server
+		'''
+		return self.pushRequest(self.relayRequest(opcode, recipients, pdata, topic))
+
+	def pushBatch(self, requests):
+		'''	Push several control requests to the relay at once, to be carried out in order
+			@input requests (list): Control requests, as built by relayRequest
+		'''
+		return self.pushRequest({ 'events' : requests })
+
+	def pushContacts(self, usernames):
+		'''	Send the message relay the contacts of users whose conversations have changed
+		'''
+		return self.pushRequest(self.contactsRequest(usernames))
+
+	def pushRequest(self, rdata):
+		'''	Queue a control request for delivery to the relay, without waiting for it
+			(see relay.push_requests)
+			@return: The OutboxEvent written, or None without RELAY_OUTBOX
+		'''
+		events = push_requests([rdata])
+		if events is not None: return events[0]
 
 	def get(self, request, *args, **kwargs):
 		return self.invalidRequest()
@@ -322,27 +540,20 @@ class ConversationRestView(BaseView):
 	@method_decorator(login_required)
 	def get(self, request, *args, **kwargs):
 		'''
-			Get Message's in the conversation specified by pk.  Response is formatted as 
-				follows:
+			Get Message's in the conversation specified by pk, a page at a time (see
+				messagePageResponse).  Response is formatted as follows:
 						[
 							{'id' : 'alphanumericid', 'text' : 'Heres message text!'},
 							{...},
 							...
 						]
 		'''
-		try:			
+		try:
 			obj = Conversation.objects.get(pk=kwargs['pk'])
 
-			if request.user in obj.participants.all():
-
-				msgs = list(obj.messages.all())
-				response = []
-
-				for msg in msgs:
-					response.append({'id' : msg.pk, 'text' : msg.text})
-
-				return HttpResponse(json.dumps(response, cls=DateTimeAwareEncoder),
-					content_type='application/json')
+			if is_participant(obj, request.user):
+				return self.messagePageResponse(request, obj,
+					lambda msg: {'id' : msg.pk, 'text' : msg.text})
 			else:
 				return HttpResponseNotFound()
 
@@ -360,15 +571,23 @@ class ConversationRestView(BaseView):
 		try:
 			convoObj = Conversation.objects.get(pk=kwargs['pk'])
 			# make sure user is in the conversation
-			if request.user in convoObj.participants.all():
-
-				# Push change to connected clients
-				try: self.pushData('conversation-delete',
-					map(lambda user: user.get_username(), convoObj.participants.all()),
-					{'id' : convoObj.pk })
-				except Exception as err: logger.critical(str(err))
-
-				convoObj.delete()
+			if is_participant(convoObj, request.user):
+
+				cid, topic = convoObj.pk, conversation_topic(convoObj)
+				users = list(convoObj.participants.all())
+				participants = [user.get_username() for user in users]
+				with transaction.atomic():
+					convoObj.delete()
+					# Push change to connected clients, close the relay's room, and update
+					# the contacts of the participants
+					event = self.pushBatch([
+						self.relayRequest('conversation-delete', pdata={'id' : cid }, topic=topic),
+						self.relayRequest('room-delete', pdata={'conversation' : cid}),
+						self.contactsRequest(participants)])
+					# Let delta sync tell the former participants about the deletion
+					if event is not None: ConversationTombstone.objects.bulk_create([
+						ConversationTombstone(conversation=cid, user=user, event=event.pk)
+						for user in users])
 				response = self.getSuccessResponse(id=kwargs['pk'])
 
 				return HttpResponse(json.dumps(response))
@@ -390,7 +609,7 @@ class ConversationCreateView(BaseView):
 		''' Retrieve all active conversations for a user
 		'''
 		active_conversations = Conversation.objects.filter(participants=request.user)
-		return HttpResponse(json.dumps([conversation_data(conv) for conv in active_conversations],
+		return HttpResponse(json.dumps(conversations_data(active_conversations),
 			cls=DateTimeAwareEncoder))
 
 	@method_decorator(login_required)
@@ -402,29 +621,32 @@ class ConversationCreateView(BaseView):
 		try:
 			rdata = json.loads(request.body, cls=DateTimeAwareDecoder)
 			response = {}
+
+			# Look the users up first, so that nothing is written for an unknown one
+			usernames = set(rdata.get('participants', []))
+			users = list(User.objects.filter(username__in=usernames))
+			if len(users) != len(usernames):
+				response['error'] = 'Conversations user does not exst'
+				return HttpResponseBadRequest(json.dumps(response))
 			
-			# Create conversation
-			conversation = Conversation()
-			conversation.save()
-			
-			# Add users
-			for ruid in rdata.get('participants', []):
-				try:
-					cuser = User.objects.get(username=ruid)
-					conversation.participants.add(cuser)
-				except User.DoesNotExist:
-					conversation.delete()
-					response['error'] = 'Conversations user does not exst'
-					return HttpResponseBadRequest(json.dumps(response))
+			with transaction.atomic():
+				# Create conversation and add users
+				conversation = Conversation()
+				conversation.save()
+				conversation.participants.add(*users)
+
+				# Open the relay's room for the conversation, push data to client, and
+				# update the contacts of the participants
+				participants = [user.get_username() for user in conversation.participants.all()]
+				self.pushBatch([
+					self.relayRequest('room-join', pdata={'conversation' : conversation.pk,
+						'participants' : participants}),
+					self.relayRequest('conversation-create', pdata=conversation_data(conversation),
+						topic=conversation_topic(conversation)),
+					self.contactsRequest(participants)])
 			
 			response = self.getSuccessResponse(id=conversation.id)
 
-			# Push data to client
-			try: self.pushData('conversation-create',
-				map(lambda user: user.get_username(), conversation.participants.all()),
-				conversation_data(conversation))
-			except Exception as err: logger.critical(str(err))
-
 			return HttpResponse(json.dumps(response))
 
 		except Conversation.DoesNotExist as err:
@@ -445,10 +667,10 @@ class MessageRestView(BaseView):
 			convo = Conversation.objects.get(pk=kwargs['cpk'])
 
 			# ensure requesting user is participant in conversation
-			if request.user in convo.participants.all():
+			if is_participant(convo, request.user):
 				msg = convo.messages.get(pk=kwargs['pk'])
 
-				return HttpResponse(json.dumps(model_to_dict(msg),
+				return HttpResponse(json.dumps(model_to_dict(msg, exclude=('conversation', )),
 					cls=DateTimeAwareEncoder), content_type='application/json')
 			return HttpResponseNotFound()	
 
@@ -467,18 +689,16 @@ class MessageRestView(BaseView):
 		try:
 			convo = Conversation.objects.get(pk=kwargs['cpk'])
 			# ensure requesting user is participant in conversation
-			if request.user in convo.participants.all():
+			if is_participant(convo, request.user):
 				msg = convo.messages.get(pk=kwargs['pk'])
 
 				if(msg.sender == request.user):
 
-					# Push change to users
-					try: self.pushData('conversation-delete',
-						map(lambda user: user.get_username(), convo.participants.all()),
-						{ 'cid' : convo.pk, 'id' : msg.pk })
-					except Exception as err: logger.critical(str(err))
-
-					msg.delete()
+					with transaction.atomic():
+						# Push change to users
+						self.pushData('conversation-delete',
+							pdata={ 'cid' : convo.pk, 'id' : msg.pk }, topic=conversation_topic(convo))
+						msg.delete()
 					response = self.getSuccessResponse(id=kwargs['pk'])
 					return HttpResponse(json.dumps(response))
 
@@ -494,12 +714,13 @@ class MessageCreateView(BaseView):
 
 	@method_decorator(login_required)
 	def get(self, request, *args, **kwargs):
-		''' Retrieve all active conversations for a user
+		''' Retrieve the messages of a conversation, a page at a time (see
+			messagePageResponse)
 		'''
 		try: conversation = Conversation.objects.get(pk=kwargs.get('cpk'))
 		except Conversation.DoesNotExist: return HttpResponseNotFound()
-		return HttpResponse(json.dumps([message_data(message) 
-			for message in conversation.messages.all()], cls=DateTimeAwareEncoder))
+		if not is_participant(conversation, request.user): return HttpResponseNotFound()
+		return self.messagePageResponse(request, conversation, message_data)
 
 	@method_decorator(login_required)
 	def post(self, request, *args, **kwargs):
@@ -516,23 +737,26 @@ class MessageCreateView(BaseView):
 				return self.getFormErrorResponse(msgForm)
 
 			# Validate that the request user has permission to add messages to the conversation
-			elif request.user in conversation.participants.all():
-				obj = msgForm.save()
-				# Add the request user as the sender
+			elif is_participant(conversation, request.user):
+				# Add the request user as the sender, and insert the message into the
+				# conversation with a single row write
+				obj = msgForm.save(commit=False)
+				obj.id = obj.generateMessageId()
 				obj.sender = request.user
-				obj.save()
-				conversation.messages.add(obj)
-				conversation.save()
+				obj.conversation = conversation
+
+				# Push data to client in the transaction inserting the message
+				rdata = self.relayRequest('message-create',
+					pdata={'cid' : conversation.pk, 'message' : message_data(obj)},
+					topic=conversation_topic(conversation))
+				writer = message_writer()
+				if writer is not None: writer.write(obj, rdata)
+				else:
+					with transaction.atomic():
+						obj.save(force_insert=True)
+						self.pushRequest(rdata)
 				response = self.getSuccessResponse(id=obj.pk)
 				
-				# Push data to client
-				try: self.pushData('message-create',
-					map(lambda user: user.get_username(), conversation.participants.all()),
-					{'cid' : conversation.pk, 'message' : message_data(obj)})
-				except Exception as err:
-					print traceback.print_exc()
-					logger.critical(str(err))
-				
 				return HttpResponse(json.dumps(response))
 
 			else:
@@ -546,6 +770,71 @@ class MessageCreateView(BaseView):
 			return HttpResponseNotFound(json.dumps(err.message))
 
 
+class SyncView(BaseView):
+	'''	Delta sync: the changes to a user's conversations since a cursor, used by
+		clients catching up after a reconnect or a missed relay message
+	'''
+
+	@method_decorator(login_required)
+	def get(self, request, *args, **kwargs):
+		'''	Return the changes since the "cursor" parameter (see sync_changes):
+				{"cursor" : 1234, "reset" : false, "more" : false,
+				 "conversations" : [...], "messages" : [{"cid" : ..., "message" : ...}],
+				 "tombstones" : [{"type" : "message", "cid" : ..., "id" : ..., "cursor" : ...}]}
+		'''
+		try: changes = sync_changes(request.user, request.GET.get('cursor'),
+			request.GET.get('limit'))
+		except ValueError as err: return HttpResponseBadRequest(json.dumps(str(err)))
+		return HttpResponse(json.dumps(changes, cls=DateTimeAwareEncoder),
+			content_type='application/json')
+
+
+class PresenceContactsView(BaseView):
+	'''	Contacts of a user, requested by the message relay when the user connects.
+		The relay identifies itself with the RELAY_TOKEN setting.
+	'''
+
+	def get(self, request, *args, **kwargs):
+		'''	Return the contacts of the user given in the "user" parameter:
+				{"user" : "username", "contacts" : ["username", ...]}
+		'''
+		if not relay_authorized(request): return HttpResponseForbidden()
+		username = request.GET.get('user')
+		if not username: return self.invalidRequest()
+		return HttpResponse(json.dumps({'user' : username, 'contacts' : user_contacts(username)}),
+			content_type='application/json')
+
+
+class RelayRoomsView(BaseView):
+	'''	Participants of every conversation, loaded by the message relay on startup
+	'''
+
+	def get(self, request, *args, **kwargs):
+		'''	Return the usernames of the participants of each conversation:
+				{"rooms" : {"conversation id" : ["username", ...], ...}}
+		'''
+		if not relay_authorized(request): return HttpResponseForbidden()
+		rooms = {}
+		for cid, username in Conversation.participants.through.objects \
+				.values_list('conversation_id', 'user__username').iterator():
+			rooms.setdefault(cid, []).append(username)
+		return HttpResponse(json.dumps({'rooms' : rooms}), content_type='application/json')
+
+
+class RelayMetricsView(BaseView):
+	'''	State of the queue and of the outbox delivering control requests to the
+		message relay
+	'''
+
+	def get(self, request, *args, **kwargs):
+		'''	Return the queue depth, delivery counters and delivery lag in seconds, with
+			the outbox high-water mark, backlog and lag under "outbox"
+		'''
+		if not relay_authorized(request): return HttpResponseForbidden()
+		return HttpResponse(json.dumps(dict(relay_dispatcher().metrics(), outbox=outbox_metrics())),
+			content_type='application/json')
+
+
 def application_index(request):
 	'''	Index view for the chat application. Checks to see if a user is authenticated.
 		If a user is authenticated, the view returns the active user index page.
@@ -58,6 +58,64 @@ WSGI_APPLICATION = 'pyweb.wsgi.application'
 CONTROL_SCHEME = 'http'
 MESSAGE_SERVER = '127.0.0.1'
 MESSAGE_PORT = '1789'
+# Shared secret the message relay sends when asking for user contacts, and Django
+# sends on the relay's control channel and control resource. Must match
+# relay_token in webrtc-python.config; the development token below is refused
+# unless DEBUG is on.
+RELAY_TOKEN = 'development-relay-token'
+# Persistent control channel of the message relay (control_port or control_socket
+# in webrtc-python.config). Pushes fall back to HTTP when neither is set.
+RELAY_CONTROL_ADDRESS = ('127.0.0.1', 1790)
+# RELAY_CONTROL_SOCKET = '/tmp/webrtc-python-control.sock'
+RELAY_CONTROL_POOL = 4
+# Control requests are queued and delivered from a background thread. When the
+# queue is full, RELAY_QUEUE_POLICY drops the newest or oldest request, or blocks
+# briefly ('drop-newest', 'drop-oldest' or 'block'). Requests arriving within
+# RELAY_BATCH_DELAY seconds are sent as one batch, and failed deliveries are
+# retried RELAY_RETRY_LIMIT times, backing off from RELAY_RETRY_BACKOFF seconds.
+RELAY_QUEUE_SIZE = 10000
+RELAY_QUEUE_POLICY = 'drop-oldest'
+RELAY_BATCH_SIZE = 100
+RELAY_BATCH_DELAY = 0.005
+RELAY_RETRY_LIMIT = 5
+RELAY_RETRY_BACKOFF = 0.1
+# Control requests are written to an outbox table in the transaction of the change
+# they announce, and delivered in order by "manage.py relay_outbox", which the relay
+# starts itself when outbox_command is set in webrtc-python.config; otherwise it
+# has to be run alongside the relay. The dispatcher polls every
+# RELAY_OUTBOX_POLL_INTERVAL seconds, holds its cursor for RELAY_OUTBOX_LEASE
+# seconds, waits RELAY_OUTBOX_GAP_TIMEOUT seconds for events committed out of order
+# and, once it skips them, sends those committed within RELAY_OUTBOX_LATE_TIMEOUT
+# seconds out of order. Delivered events are kept RELAY_OUTBOX_RETENTION seconds for
+# replay. Without RELAY_OUTBOX they are queued in memory instead.
+RELAY_OUTBOX = True
+RELAY_OUTBOX_POLL_INTERVAL = 0.05
+RELAY_OUTBOX_LEASE = 10.0
+RELAY_OUTBOX_GAP_TIMEOUT = 5.0
+RELAY_OUTBOX_LATE_TIMEOUT = 600.0
+RELAY_OUTBOX_RETENTION = 86400
+
+# Messages returned per page of conversation history by default, and at most
+MESSAGE_PAGE_SIZE = 50
+MESSAGE_PAGE_MAX = 200
+# Outbox events read per delta sync request by default, and at most
+SYNC_PAGE_SIZE = 500
+SYNC_PAGE_MAX = 5000
+# Seconds a participant membership check is cached for across requests (0 turns
+# the cache off). Changes to participants invalidate it in this process; other
+# processes sharing a local memory cache may see them this much later.
+MEMBERSHIP_CACHE_TTL = 5
+# Class generating message and conversation ids, called with ID_GENERATOR_OPTIONS:
+# chat.ids.UlidGenerator, chat.ids.SnowflakeGenerator (give each process its own
+# 'node' between 0 and 1023) or chat.ids.Uuid4Generator for random ids
+ID_GENERATOR = 'chat.ids.UlidGenerator'
+ID_GENERATOR_OPTIONS = {}
+# New messages from concurrent requests are inserted in shared transactions of up to
+# MESSAGE_GROUP_COMMIT_SIZE messages. Under concurrent load the committing request
+# waits MESSAGE_GROUP_COMMIT_DELAY seconds for more messages to join its commit.
+MESSAGE_GROUP_COMMIT = True
+MESSAGE_GROUP_COMMIT_DELAY = 0.002
+MESSAGE_GROUP_COMMIT_SIZE = 100
 
 
 # Database